@@ -0,0 +1,224 @@
+import os
+import sqlite3
+import numpy as np
+from app.partitions import sources, read_source
+
+QOS_LEVELS = (0, 1, 2)
+
+
+def to_columns(rows, dtypes):
+    """Contiguous numpy arrays from an iterable of row tuples (e.g. a cursor), one per (name, dtype) in `dtypes`.
+
+    Rows are read straight into a typed record array, so no Python list of
+    tuples is built; NULL floats become NaN.
+    """
+    records = np.fromiter(rows, dtype=list(dtypes.items()))
+    return {name: np.ascontiguousarray(records[name]) for name in dtypes}
+
+
+def query_columns(sql, params, dtypes, start=None, end=None, limit=None):
+    """Run `sql` (which reads the table `mqtt_data`) on every source overlapping [start, end), as column arrays.
+
+    Sources are read oldest first; `limit` works as in query_partitions.
+    """
+    parts = [to_columns((), dtypes)]
+    rows = 0
+    for path in sources(start, end):
+        bound = list(params)
+        if limit is not None:
+            if rows >= limit:
+                break
+            bound.append(limit - rows)
+        try:
+            with read_source(path) as conn:
+                parts.append(to_columns(conn.execute(sql, bound), dtypes))
+        except sqlite3.OperationalError:
+            if os.path.exists(path):
+                raise
+            continue  # Dropped by compaction since it was listed
+        rows += len(parts[-1][next(iter(dtypes))])
+    return {name: np.concatenate([part[name] for part in parts]) for name in dtypes}
+
+
+def load_latencies(qos=None, start=None, end=None):
+    """qos_level and latency arrays of every row with a positive latency (archive first, then SQLite)."""
+    from app.archive import load_columns
+    columns = load_columns(("qos_level", "latency"), qos=qos, start=start, end=end)
+    keep = columns["latency"] > 0  # Also drops NaN (NULL) latencies
+    return {name: values[keep] for name, values in columns.items()}
+
+
+class RingBuffer:
+    """Fixed-capacity numpy buffer holding the newest values appended to it.
+
+    Every value is stored twice, `capacity` apart, so the contents are always
+    one contiguous slice: `values()` is a view, and appending never allocates.
+    """
+
+    def __init__(self, capacity, dtype=np.float64):
+        self.capacity = capacity
+        self.data = np.zeros(2 * capacity, dtype=dtype)
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def extend(self, values):
+        values = np.asarray(values)[-self.capacity:]
+        count = len(values)
+        if not count:
+            return
+        positions = (self.start + self.size + np.arange(count)) % self.capacity
+        self.data[positions] = values
+        self.data[positions + self.capacity] = values
+        overflow = max(0, self.size + count - self.capacity)
+        self.start = (self.start + overflow) % self.capacity
+        self.size = min(self.capacity, self.size + count)
+
+    def values(self):
+        """The buffered values, oldest first (a view that later appends overwrite)."""
+        return self.data[self.start:self.start + self.size]
+
+    def clear(self):
+        self.start = self.size = 0
+
+
+def group_by(keys, **columns):
+    """Split `columns` by the value of `keys`: {key: {name: array}}, keys ascending, row order kept within a group."""
+    keys = np.asarray(keys)
+    order = np.argsort(keys, kind="stable")
+    levels, firsts = np.unique(keys[order], return_index=True)
+    split = {name: np.split(np.asarray(values)[order], firsts[1:]) for name, values in columns.items()}
+    return {level.item(): {name: parts[i] for name, parts in split.items()} for i, level in enumerate(levels)}
+
+
+def _window_sums(values, window):
+    """Sum and count of the non-NaN values in each trailing window."""
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    filled = np.where(valid, values, 0.0)
+
+    def trailing(series):
+        total = np.concatenate(([0.0], np.cumsum(series)))
+        return total[window:] - total[:-window]
+
+    return trailing(filled), trailing(valid.astype(np.float64))
+
+
+def rolling_mean(values, window):
+    """Mean of each trailing `window` values, ignoring NaN; the first window - 1 entries are NaN."""
+    values = np.asarray(values, dtype=np.float64)
+    result = np.full(len(values), np.nan)
+    if window < 1 or len(values) < window:
+        return result
+    sums, counts = _window_sums(values, window)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        result[window - 1:] = sums / counts
+    return result
+
+
+def histogram(groups, bins=30):
+    """Counts of each group's values over shared bin edges: (edges, {key: counts})."""
+    filled = [values for values in groups.values() if len(values)]
+    if not filled:
+        return np.array([]), {}
+    edges = np.histogram_bin_edges(np.concatenate(filled), bins=bins)
+    return edges, {key: np.histogram(values, bins=edges)[0] for key, values in groups.items()}
+
+
+def percentiles(values, qs=(50, 95, 99)):
+    """{q: value} for each percentile in `qs`, ignoring NaN; None for an empty array."""
+    values = np.asarray(values, dtype=np.float64)
+    if not len(values):
+        return {q: None for q in qs}
+    return dict(zip(qs, (float(v) for v in np.nanpercentile(values, qs))))
+
+
+def box_stats(values, label=None, whis=1.5):
+    """Boxplot statistics for matplotlib's Axes.bxp, so the plot never gets the raw values."""
+    values = np.asarray(values, dtype=np.float64)
+    q1, med, q3 = np.percentile(values, (25, 50, 75))
+    iqr = q3 - q1
+    inside = values[(values >= q1 - whis * iqr) & (values <= q3 + whis * iqr)]
+    return {
+        "label": label,
+        "q1": q1, "med": med, "q3": q3,
+        "whislo": inside.min() if len(inside) else q1,
+        "whishi": inside.max() if len(inside) else q3,
+        "mean": values.mean(),
+        "fliers": np.array([]),
+    }
+
+
+def lttb(xs, ys, threshold):
+    """Largest-Triangle-Three-Buckets over arrays: indices of `threshold` points that keep the series' shape.
+
+    Each bucket's triangle areas are computed as one array operation instead
+    of a Python loop over its points.
+    """
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    every = (n - 2) / (threshold - 2)
+    bounds = np.array([int(i * every) + 1 for i in range(threshold)])
+    # Bucket i's third triangle vertex is the average of bucket i + 1; buckets are contiguous and
+    # never empty, so all of those averages come from one reduceat
+    starts = bounds[1:-1]
+    sizes = np.diff(np.append(starts, n))
+    avg_x = np.add.reduceat(xs, starts) / sizes
+    avg_y = np.add.reduceat(ys, starts) / sizes
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i, (start, end) in enumerate(zip(bounds[:-2].tolist(), bounds[1:-1].tolist())):
+        ax, ay = xs[a], ys[a]
+        area = np.abs((ax - avg_x[i]) * (ys[start:end] - ay) - (ax - xs[start:end]) * (avg_y[i] - ay))
+        a = start + int(area.argmax())
+        selected[i + 1] = a
+    return selected
+
+
+if __name__ == "__main__":
+    # Microbenchmark against the per-row Python code the graphs used before; run with `python -m app.analytics`
+    # (tests/test_analytics.py checks that the results agree)
+    import argparse
+    import timeit
+
+    parser = argparse.ArgumentParser(description="Benchmark the vectorized analytics against the list-based code")
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    qos = rng.integers(0, 3, args.rows).astype(np.int8)
+    latency = rng.gamma(2.0, 0.02, args.rows)
+    packet_size = rng.integers(16, 4096, args.rows).astype(np.int32)
+    rows = list(zip(qos.tolist(), latency.tolist(), packet_size.tolist()))
+
+    def group_lists():
+        qos_levels, latencies, packet_sizes = zip(*rows)
+        qos_data = {0: [], 1: [], 2: []}
+        packet_data = {0: [], 1: [], 2: []}
+        for q, lat, size in zip(qos_levels, latencies, packet_sizes):
+            qos_data[q].append(lat)
+            packet_data[q].append(size)
+        return qos_data, packet_data
+
+    def group_arrays():
+        return group_by(qos, latency=latency, packet_size=packet_size)
+
+    def rolling_lists(values=latency[:100000].tolist(), window=25):
+        return [sum(values[i - window + 1:i + 1]) / window for i in range(window - 1, len(values))]
+
+    def bench(name, old, new):
+        old_time = min(timeit.repeat(old, number=1, repeat=args.repeat))
+        new_time = min(timeit.repeat(new, number=1, repeat=args.repeat))
+        print(f"{name:<22} lists {old_time * 1000:9.1f} ms   numpy {new_time * 1000:9.1f} ms   {old_time / new_time:6.1f}x")
+
+    bench("group by QoS", group_lists, group_arrays)
+    bench("rolling mean (100k)", rolling_lists, lambda: rolling_mean(latency[:100000], 25))
@@ -4,20 +4,39 @@ import os
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
+import argparse
+import importlib
+import logging
+from app import log
+from app.bootstrap import bootstrap, startup_profiler
+from app.config import METRICS_HOST, METRICS_PORT
+from app.metrics import start_metrics_server
+
+# Must run before the GUI imports below so their cost shows up in the report
+if "--profile-startup" in sys.argv:
+    startup_profiler.enable()
+
 import ttkbootstrap as ttk
 from ttkbootstrap.constants import *
-from app.gui.homepage import HomePage
-from app.gui.topics import TopicsPage
-from app.gui.topic_data import TopicDataPage
-from app.mqtt_client import mqtt_client
-from app.gui.graphs import GraphsPage
+
+# page name -> module; a page's module (and what it imports) is only loaded when the page is first shown
+PAGES = {
+    "HomePage": "app.gui.homepage",
+    "TopicsPage": "app.gui.topics",
+    "TopicDataPage": "app.gui.topic_data",
+    "GraphsPage": "app.gui.graphs",
+    "DiagnosticsPage": "app.gui.diagnostics",
+}
+# Built at startup: the Topics page owns the `#` subscription that feeds ingest
+EAGER_PAGES = ("HomePage", "TopicsPage")
 
 class MQTTApp(ttk.Window):  # Use ttkbootstrap for modern UI
-    def __init__(self):
+    def __init__(self, feed):
         super().__init__(themename="superhero")  # Try themes: "solar", "darkly", "flatly"
 
         self.title("Smart Home MQTT")
         self.geometry("800x500")  # Increased size
+        self.feed = feed  # MQTTClient, or RemoteFeed when attached to an ingest daemon
 
         # Navigation Bar
         self.navbar = ttk.Frame(self, padding=10)
@@ -26,25 +45,55 @@ class MQTTApp(ttk.Window):  # Use ttkbootstrap for modern UI
         ttk.Button(self.navbar, text="Home", command=lambda: self.show_frame("HomePage")).pack(side="left", padx=10)
         ttk.Button(self.navbar, text="Topics", command=lambda: self.show_frame("TopicsPage")).pack(side="left", padx=10)
         ttk.Button(self.navbar, text="Graphs", command=lambda: self.show_frame("GraphsPage")).pack(side="left", padx=10)
+        ttk.Button(self.navbar, text="Diagnostics", command=lambda: self.show_frame("DiagnosticsPage")).pack(side="left", padx=10)
 
         # Create Pages
         self.frames = {}
-        for Page in (HomePage, TopicsPage, TopicDataPage, GraphsPage):
-            page_name = Page.__name__
+        for page_name in EAGER_PAGES:
+            self.get_frame(page_name)
+
+        self.show_frame("HomePage")
+
+        # Deliver MQTT callbacks on this (Tk) thread in batches
+        self.feed.dispatcher.attach(self)
+        self.bind("<Map>", self.on_first_map, add="+")
+
+    def get_frame(self, page_name):
+        """Return the page, importing and building it on first use."""
+        frame = self.frames.get(page_name)
+        if frame is None:
+            Page = getattr(importlib.import_module(PAGES[page_name]), page_name)
             frame = Page(parent=self, controller=self)
             self.frames[page_name] = frame
             frame.grid(row=1, column=0, sticky="nsew")
-
-        
-        self.show_frame("HomePage")
+            startup_profiler.mark(f"{page_name} built")
+        return frame
 
     def show_frame(self, page_name, topic=None):
-        frame = self.frames[page_name]
+        frame = self.get_frame(page_name)
         if page_name == "TopicDataPage" and topic:
             frame.set_topic(topic)  # Pass topic dynamically
         frame.tkraise()
 
+    def on_first_map(self, event):
+        if event.widget is self:
+            self.unbind("<Map>")
+            startup_profiler.mark("first frame")
+            startup_profiler.report()
+
 if __name__ == "__main__":
-    print("Starting MQTT Application")  # Debug
-    app = MQTTApp()
-    app.mainloop()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Smart Home MQTT")
+    parser.add_argument("--attach", metavar="URL", help="Take live data from an ingest daemon (e.g. http://127.0.0.1:8765) instead of the broker")
+    parser.add_argument("--profile-startup", action="store_true", help="Print import times and time to first frame")
+    args = parser.parse_args()
+
+    log.configure()
+    logging.getLogger("app.app").info("Starting MQTT Application")
+    feed = bootstrap(args.attach)
+    if METRICS_PORT and not args.attach:
+        try:
+            start_metrics_server(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logging.getLogger("app.app").warning("Metrics endpoint not started on port %s: %s", METRICS_PORT, e)
+    app = MQTTApp(feed)
+    app.mainloop()
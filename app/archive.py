@@ -0,0 +1,328 @@
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import numpy as np
+from app.analytics import to_columns
+from app.config import DATABASE_PATH, ARCHIVE_DIR, ARCHIVE_FORMAT, ARCHIVE_CHUNK_ROWS
+from app.migrations import chunked_backfill
+from app.partitions import DAY, list_partition_days, partition_day, partition_path, read_source
+
+logger = logging.getLogger(__name__)
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Analytics columns kept in the archive, in file order; payload text stays in SQLite
+COLUMNS = {
+    "received_time": np.float64,
+    "qos_level": np.int8,
+    "topic_id": np.int32,
+    "latency": np.float64,
+    "jitter": np.float64,
+    "packet_size": np.int32,
+}
+_SELECT_COLUMNS = "received_time, qos_level, COALESCE(topic_id, -1), latency, jitter, packet_size"
+
+
+def backend():
+    """Archive format in use: "parquet", "npy", or None when archiving is off."""
+    if ARCHIVE_FORMAT == "off":
+        return None
+    if ARCHIVE_FORMAT in ("auto", "parquet") and pq is not None:
+        return "parquet"
+    if ARCHIVE_FORMAT == "parquet":
+        logger.warning("ARCHIVE_FORMAT is parquet but pyarrow is not installed; using npy")
+    return "npy"
+
+
+def _sorted(columns):
+    """Reorder by (qos_level, received_time) so each QoS level and time range is one contiguous slice."""
+    order = np.lexsort((columns["received_time"], columns["qos_level"]))
+    return {name: column[order] for name, column in columns.items()}
+
+
+def _write(name, columns, meta):
+    """Write one archive file (or .npy directory) plus its .json sidecar, which is written last and marks it complete."""
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    qos = columns["qos_level"]
+    levels = np.unique(qos)
+    topic_ids, topic_index = np.unique(columns["topic_id"], return_inverse=True)
+    topic_start = np.full(len(topic_ids), np.inf)
+    np.minimum.at(topic_start, topic_index, columns["received_time"])
+    meta.update({
+        "format": backend(),
+        "rows": int(len(qos)),
+        "start": float(columns["received_time"].min()),
+        "end": float(columns["received_time"].max()),
+        # Rows of each QoS level as a [start, stop) slice; they are contiguous by construction
+        "qos": {str(int(level)): [int(np.searchsorted(qos, level, "left")), int(np.searchsorted(qos, level, "right"))]
+                for level in levels},
+        "topic_ids": [int(topic_id) for topic_id in topic_ids],
+        # Oldest row of each topic, so retention knows which files hold expired rows without reading them
+        "topic_start": {str(int(topic_id)): float(start) for topic_id, start in zip(topic_ids, topic_start)},
+    })
+
+    path = os.path.join(ARCHIVE_DIR, name)
+    if meta["format"] == "parquet":
+        table = pa.table(columns)
+        pq.write_table(table, path + ".parquet.tmp", compression="zstd", row_group_size=128 * 1024)
+        os.replace(path + ".parquet.tmp", path + ".parquet")
+    else:
+        # Plain .npy per column (not .npz) so readers can memory-map them
+        tmp = path + ".npy.tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for column, values in columns.items():
+            np.save(os.path.join(tmp, f"{column}.npy"), values)
+        shutil.rmtree(path + ".npy", ignore_errors=True)
+        os.replace(tmp, path + ".npy")
+
+    with open(path + ".json.tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(path + ".json.tmp", path + ".json")
+
+
+def catalog():
+    """Metadata of every complete archive file."""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    entries = []
+    for name in sorted(os.listdir(ARCHIVE_DIR)):
+        if name.endswith(".json"):
+            with open(os.path.join(ARCHIVE_DIR, name), encoding="utf-8") as f:
+                entries.append(json.load(f))
+    return entries
+
+
+def _remove(entry):
+    path = os.path.join(ARCHIVE_DIR, entry["name"])
+    os.remove(path + ".json")  # First, so the file is no longer listed
+    if entry["format"] == "parquet":
+        os.remove(path + ".parquet")
+    else:
+        shutil.rmtree(path + ".npy", ignore_errors=True)
+
+
+def _done_path(day):
+    return os.path.join(ARCHIVE_DIR, f"day_{day}.done")
+
+
+def archived_days(entries):
+    """Days whose partition is archived completely: a .done marker, or one file written before days were chunked."""
+    days = {entry["day"] for entry in entries if "day" in entry and "first_id" not in entry}
+    if os.path.isdir(ARCHIVE_DIR):
+        days.update(int(name[len("day_"):-len(".done")]) for name in os.listdir(ARCHIVE_DIR)
+                    if name.startswith("day_") and name.endswith(".done"))
+    return days
+
+
+def archive_partitions(now):
+    """Archive every closed day partition (older than yesterday) that has no archive yet; returns how many.
+
+    A partition is streamed in rowid ranges of ARCHIVE_CHUNK_ROWS, one file
+    each, so memory stays bounded on busy days. Its files are only read
+    once the day's .done marker is written; an interrupted day resumes
+    after its last file.
+    """
+    if backend() is None:
+        return 0
+    entries = catalog()
+    done = archived_days(entries)
+    resume = {}  # day -> last row id already archived
+    for entry in entries:
+        if "day" in entry and "last_id" in entry:
+            resume[entry["day"]] = max(resume.get(entry["day"], 0), entry["last_id"])
+    dtypes = {"id": np.int64, **COLUMNS}
+    archived = 0
+    for day in list_partition_days():
+        if day >= partition_day(now) - 1:
+            break
+        if day in done:
+            continue
+        base = os.path.basename(partition_path(day))[:-len(".db")]
+        last_id, rows = resume.get(day, 0), 0
+        with read_source(partition_path(day)) as conn:
+            while True:
+                chunk = to_columns(conn.execute(f"""
+                    SELECT id, {_SELECT_COLUMNS} FROM mqtt_data
+                    WHERE id > ? AND received_time IS NOT NULL ORDER BY id LIMIT ?
+                """, (last_id, ARCHIVE_CHUNK_ROWS)), dtypes)
+                ids = chunk.pop("id")
+                if not len(ids):
+                    break
+                first_id, last_id = int(ids[0]), int(ids[-1])
+                name = f"{base}_{first_id:012d}_{last_id:012d}"
+                _write(name, _sorted(chunk), {"name": name, "day": day, "first_id": first_id, "last_id": last_id})
+                rows += len(ids)
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        with open(_done_path(day), "w", encoding="utf-8"):
+            pass
+        archived += 1
+        logger.info("Archived %s rows of %s", rows, base)
+    return archived
+
+
+def compact_archive(policy, now, database_path=DATABASE_PATH):
+    """Apply raw-row retention (a RetentionPolicy) to the archive; returns (files dropped, rows deleted).
+
+    Files holding only expired rows are deleted; files with expired rows of
+    some topics are rewritten without them, so the archive keeps what the
+    partitions keep.
+    """
+    entries = catalog()
+    if not entries:
+        return 0, 0
+    with read_source(database_path) as conn:
+        topics = dict(conn.execute("SELECT id, topic FROM topics"))
+    longest = policy.longest()
+    unknown = now - longest * DAY if longest is not None else None  # Cutoff of rows whose topic id is not in topics
+
+    dropped = deleted = 0
+    for entry in entries:
+        starts = entry.get("topic_start") or {str(topic_id): entry["start"] for topic_id in entry["topic_ids"]}
+        cutoffs = {int(topic_id): policy.cutoff(topics[int(topic_id)], now) if int(topic_id) in topics else unknown
+                   for topic_id in starts}
+        expired = {topic_id: cutoff for topic_id, cutoff in cutoffs.items()
+                   if cutoff is not None and cutoff > starts[str(topic_id)]}
+        if not expired:
+            continue
+        if len(expired) == len(cutoffs) and all(cutoff > entry["end"] for cutoff in expired.values()):
+            _remove(entry)
+            dropped += 1
+            deleted += entry["rows"]
+            continue
+
+        columns = _read_archive(entry, tuple(COLUMNS), None, None, None)
+        keep = np.ones(entry["rows"], dtype=bool)
+        for topic_id, cutoff in expired.items():
+            keep &= (columns["topic_id"] != topic_id) | (columns["received_time"] >= cutoff)
+        removed = entry["rows"] - int(keep.sum())
+        if removed == entry["rows"]:
+            _remove(entry)
+            dropped += 1
+        elif removed:
+            meta = {key: entry[key] for key in ("name", "day", "first_id", "last_id") if key in entry}
+            _write(entry["name"], {name: np.asarray(values[keep]) for name, values in columns.items()}, meta)
+        deleted += removed
+    return dropped, deleted
+
+
+def archive_legacy(database_path=DATABASE_PATH):
+    """Archive the pre-partitioning mqtt_data rows in ARCHIVE_CHUNK_ROWS id ranges (resumable)."""
+    if backend() is None:
+        return False
+    conn = sqlite3.connect(database_path, timeout=30)
+    try:
+        # Rows are archived as the other backfills leave them
+        pending = conn.execute(
+            "SELECT COUNT(*) FROM backfill_progress WHERE done = 0 AND name != 'archive_legacy'"
+        ).fetchone()[0]
+        if pending:
+            return False
+
+        def process_chunk(conn, rows):
+            first_id, last_id = rows[0][0], rows[-1][0]
+            columns = to_columns((row[1:] for row in rows if row[1] is not None), COLUMNS)
+            if len(columns["received_time"]):
+                name = f"legacy_{first_id:012d}_{last_id:012d}"
+                _write(name, _sorted(columns), {"name": name, "first_id": first_id, "last_id": last_id})
+
+        return chunked_backfill(conn, "archive_legacy", f"""
+            SELECT id, {_SELECT_COLUMNS} FROM mqtt_data
+            WHERE id > ? AND id <= ? ORDER BY id LIMIT ?
+        """, process_chunk, ARCHIVE_CHUNK_ROWS)
+    finally:
+        conn.close()
+
+
+def _read_archive(entry, columns, qos, start, end):
+    path = os.path.join(ARCHIVE_DIR, entry["name"])
+    if entry["format"] == "parquet":
+        filters = []
+        if qos is not None:
+            filters.append(("qos_level", "=", qos))
+        if start is not None:
+            filters.append(("received_time", ">=", start))
+        if end is not None:
+            filters.append(("received_time", "<", end))
+        table = pq.read_table(path + ".parquet", columns=list(columns), filters=filters or None, memory_map=True)
+        return {name: table.column(name).to_numpy() for name in columns}
+
+    def load(name):
+        return np.load(os.path.join(path + ".npy", f"{name}.npy"), mmap_mode="r")
+
+    lo, hi = entry["qos"][str(qos)] if qos is not None else (0, entry["rows"])
+    if start is None and end is None:
+        return {name: load(name)[lo:hi] for name in columns}
+    times = load("received_time")[lo:hi]
+    if qos is not None:
+        # Sorted by time within one QoS level, so the range is a slice too
+        first = np.searchsorted(times, start, "left") if start is not None else 0
+        last = np.searchsorted(times, end, "left") if end is not None else len(times)
+        return {name: load(name)[lo + first:lo + last] for name in columns}
+    mask = np.ones(len(times), dtype=bool)
+    if start is not None:
+        mask &= times >= start
+    if end is not None:
+        mask &= times < end
+    return {name: load(name)[lo:hi][mask] for name in columns}
+
+
+def _read_sqlite(conn, columns, conditions, params):
+    """Matching rows of one source as column arrays, read from the cursor without building a list of rows."""
+    selected = ", ".join("COALESCE(topic_id, -1)" if name == "topic_id" else name for name in columns)
+    cursor = conn.execute(f"SELECT {selected} FROM mqtt_data WHERE {' AND '.join(conditions)}", params)
+    return to_columns(cursor, {name: COLUMNS[name] for name in columns})
+
+
+def load_columns(columns, qos=None, start=None, end=None, database_path=DATABASE_PATH):
+    """Numpy arrays of `columns` (names from COLUMNS) for every stored row matching the filters.
+
+    History comes from the archive: memory-mapped .npy slices, or parquet read
+    with the QoS/time predicates pushed down. Only rows not archived yet are
+    read from SQLite. Rows come back in no particular order.
+    """
+    entries = catalog() if backend() is not None else []
+    days = archived_days(entries)
+    parts = [
+        _read_archive(entry, columns, qos, start, end) for entry in entries
+        if ("day" not in entry or entry["day"] in days)  # Files of a day still being archived are not used yet
+        and (start is None or entry["end"] >= start) and (end is None or entry["start"] < end)
+        and (qos is None or str(qos) in entry["qos"])
+    ]
+
+    conditions, params = ["received_time IS NOT NULL"], []
+    if qos is not None:
+        conditions.append("qos_level = ?")
+        params.append(qos)
+    if start is not None:
+        conditions.append("received_time >= ?")
+        params.append(start)
+    if end is not None:
+        conditions.append("received_time < ?")
+        params.append(end)
+
+    with read_source(database_path) as conn:
+        progress = conn.execute("SELECT last_id FROM backfill_progress WHERE name = 'archive_legacy'").fetchone()
+        archived_id = progress[0] if progress is not None and entries else 0
+        parts.append(_read_sqlite(conn, columns, conditions + ["id > ?"], params + [archived_id]))
+
+    first = partition_day(start) if start is not None else None
+    last = partition_day(end) if end is not None else None
+    for day in list_partition_days():
+        if day in days or (first is not None and day < first) or (last is not None and day > last):
+            continue
+        try:
+            with read_source(partition_path(day)) as conn:
+                parts.append(_read_sqlite(conn, columns, conditions, params))
+        except sqlite3.OperationalError:
+            if os.path.exists(partition_path(day)):
+                raise
+            # Dropped by compaction since it was listed
+
+    return {name: np.concatenate([part[name] for part in parts]) for name in columns}
@@ -0,0 +1,132 @@
+import logging
+import sys
+import threading
+import time
+from importlib.abc import MetaPathFinder
+
+logger = logging.getLogger(__name__)
+
+
+class _TimedLoader:
+    """Wraps a module loader to time exec_module; everything else is delegated."""
+
+    def __init__(self, loader, timer, name):
+        self._loader = loader
+        self._timer = timer
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(self._loader, attr)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        stack = self._timer.stack
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self._timer.times[self._name] = (elapsed, elapsed - nested)
+
+
+class _ImportTimer(MetaPathFinder):
+    """Meta path hook recording (cumulative, self) seconds per module imported on the main thread."""
+
+    def __init__(self):
+        self.times = {}
+        self.stack = []
+
+    def find_spec(self, name, path, target=None):
+        if threading.current_thread() is not threading.main_thread():
+            return None
+        for finder in sys.meta_path:
+            find_spec = getattr(finder, "find_spec", None)
+            if finder is self or find_spec is None:
+                continue
+            spec = find_spec(name, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+            spec.loader = _TimedLoader(spec.loader, self, name)
+        return spec
+
+
+class StartupProfiler:
+    """Import times and named milestones (e.g. first frame) of one application start."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.marks = []
+        self.timer = None
+
+    @property
+    def enabled(self):
+        return self.timer is not None
+
+    def enable(self):
+        """Start timing imports; only modules imported after this call are covered."""
+        if self.timer is None:
+            self.timer = _ImportTimer()
+            sys.meta_path.insert(0, self.timer)
+
+    def mark(self, label):
+        if self.enabled:
+            self.marks.append((label, time.perf_counter() - self.start))
+
+    def report(self, top=15):
+        """Print milestones and the slowest imports, then stop timing imports."""
+        if not self.enabled:
+            return
+        sys.meta_path.remove(self.timer)
+        logger.info("Startup profile (ms since launch):")
+        for label, elapsed in self.marks:
+            logger.info("  %9.1f  %s", elapsed * 1000, label)
+        slowest = sorted(self.timer.times.items(), key=lambda item: item[1][0], reverse=True)[:top]
+        logger.info("Slowest imports (cumulative / self ms) of %s modules:", len(self.timer.times))
+        for name, (cumulative, own) in slowest:
+            logger.info("  %9.1f %9.1f  %s", cumulative * 1000, own * 1000, name)
+        self.timer = None
+
+
+startup_profiler = StartupProfiler()
+
+
+def bootstrap(attach=None, processes=1):
+    """Prepare storage and start the live message feed; nothing here blocks on the network.
+
+    The feed is the broker connection, or with `processes` > 1 an
+    IngestCluster of that many subscriber processes. With `attach` (an
+    ingest daemon's read API URL) it is the daemon's live stream, which
+    leaves storage to the daemon.
+    """
+    if attach:
+        from app.remote import RemoteFeed
+
+        feed = RemoteFeed(attach)
+        feed.start()
+        startup_profiler.mark("attached to ingest daemon")
+        return feed
+
+    from app.database import init_db
+    from app.retention import start_compaction
+
+    init_db()
+    start_compaction()
+    startup_profiler.mark("database ready")
+    if processes > 1:
+        from app.cluster import IngestCluster
+
+        feed = IngestCluster(processes)
+    else:
+        from app.mqtt_client import mqtt_client as feed
+    feed.start()
+    startup_profiler.mark("broker connection started")
+    return feed
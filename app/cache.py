@@ -0,0 +1,215 @@
+import functools
+import inspect
+import sys
+import threading
+import time
+from collections import OrderedDict
+from app.config import QUERY_CACHE_MAX_ENTRIES, QUERY_CACHE_MAX_BYTES, QUERY_CACHE_TTL, QUERY_CACHE_SETTLE
+from app.metrics import registry
+from app.writer import WriterHook
+
+# Watermarks: topic_mark(topic) and qos_mark(qos) move when rows of that
+# topic or QoS level are committed, ALL on any commit, TOPICS when a topic is
+# seen for the first time, LATE when rows received more than
+# QUERY_CACHE_SETTLE seconds ago are committed (spill replay, a backed-up
+# writer) and REWRITE when stored data changes in place (backfills,
+# retention); every entry depends on REWRITE
+ALL = "*"
+TOPICS = "topics"
+LATE = "late"
+REWRITE = "rewrite"
+
+
+def topic_mark(topic):
+    return ("topic", topic)  # Kept apart from the names above, which are also valid topics
+
+
+def qos_mark(qos):
+    return ("qos", qos)
+
+
+def commit_marks(rows, now=None):
+    """Watermarks moved by committing `rows` (TOPICS aside, which depends on what was committed before)."""
+    now = time.time() if now is None else now
+    names = {ALL}
+    for row in rows:
+        names.add(topic_mark(row["topic"]))
+        names.add(qos_mark(row["qos_level"]))
+        if row["received_time"] < now - QUERY_CACHE_SETTLE:
+            names.add(LATE)
+    return names
+
+
+def range_marks(start=None, end=None, topic=None, qos=None):
+    """Watermarks of a read of mqtt_data filtered by received_time range, topic and QoS."""
+    if end is not None and end < time.time() - QUERY_CACHE_SETTLE:
+        return (LATE,)  # Settled range: only late commits can still add rows to it
+    if topic is not None:
+        return (topic_mark(topic),)
+    if qos is not None:
+        return (qos_mark(qos),)
+    return (ALL,)
+
+
+def estimate_size(value, sample=100):
+    """Approximate bytes held by a query result; long sequences are sized from their first `sample` items."""
+    if hasattr(value, "nbytes"):  # numpy arrays
+        return int(value.nbytes)
+    if hasattr(value, "memory_usage"):  # pandas DataFrames
+        return int(value.memory_usage(index=True).sum())
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        return size + sum(estimate_size(key) + estimate_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)) and value:
+        head = value[:sample]
+        return size + sum(estimate_size(item) for item in head) * len(value) // len(head)
+    return size
+
+
+class QueryCache:
+    """LRU cache of reader results, invalidated by ingest watermarks.
+
+    Each entry remembers the watermarks it depends on as they were when its
+    query started. An entry is served only while none of them has moved and
+    it is younger than `ttl`; the oldest entries are evicted past
+    `max_entries` or `max_bytes`.
+    """
+
+    def __init__(self, max_entries=QUERY_CACHE_MAX_ENTRIES, max_bytes=QUERY_CACHE_MAX_BYTES, ttl=QUERY_CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (value, size, stored_at, {watermark: value})
+        self.watermarks = {}
+        self.version = 0  # Counts bumps, so other processes can ask which watermarks moved since they last looked
+        self.moved = {}  # watermark -> version of its last bump
+        self.bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "invalidated": 0, "expired": 0, "evicted": 0, "uncacheable": 0}
+        self._lock = threading.Lock()
+
+    def bump(self, names):
+        """Move the named watermarks (e.g. those of the topics a commit wrote to)."""
+        with self._lock:
+            self.version += 1
+            for name in names:
+                self.watermarks[name] = self.watermarks.get(name, 0) + 1
+                self.moved[name] = self.version
+
+    def moved_since(self, version):
+        """(current version, watermarks bumped after `version`)."""
+        with self._lock:
+            return self.version, [name for name, moved in self.moved.items() if moved > version]
+
+    def snapshot(self, names):
+        with self._lock:
+            return {name: self.watermarks.get(name, 0) for name in names}
+
+    def get(self, key):
+        """(True, value) for a valid entry, else (False, None)."""
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return False, None
+            value, size, stored_at, marks = entry
+            if time.monotonic() - stored_at > self.ttl:
+                reason = "expired"
+            elif any(self.watermarks.get(name, 0) != mark for name, mark in marks.items()):
+                reason = "invalidated"
+            else:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return True, value
+            self._remove(key)
+            self.stats[reason] += 1
+            self.stats["misses"] += 1
+            return False, None
+
+    def put(self, key, value, marks):
+        """Store `value`, computed from data as of watermarks `marks` (taken before the query ran)."""
+        size = estimate_size(value)
+        with self._lock:
+            if size > self.max_bytes:
+                self.stats["uncacheable"] += 1
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, size, time.monotonic(), marks)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.stats["evicted"] += 1
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def metrics(self):
+        with self._lock:
+            snapshot = dict(self.stats)
+            snapshot["entries"] = len(self.entries)
+            snapshot["bytes"] = self.bytes
+        lookups = snapshot["hits"] + snapshot["misses"]
+        snapshot["hit_rate"] = snapshot["hits"] / lookups if lookups else None
+        return snapshot
+
+    def _remove(self, key):
+        self.bytes -= self.entries.pop(key)[1]
+
+
+query_cache = QueryCache()
+registry.counter("iot_query_cache_events_total", "Query cache lookups and removals by event", ("event",),
+                 function=lambda: {(event,): count for event, count in query_cache.stats.items()})
+registry.gauge("iot_query_cache_bytes", "Estimated size of the cached results", function=lambda: query_cache.bytes)
+
+
+def cached(depends=(ALL,), cache=query_cache):
+    """Cache a reader's results per argument values until a watermark it depends on moves.
+
+    `depends` is a tuple of watermark names, or a function taking the call's
+    arguments by name and returning one. Results are shared between callers
+    and must not be modified. `func.uncached` bypasses the cache.
+    """
+    def decorate(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = (func.__qualname__, tuple(bound.arguments.items()))
+            try:
+                found, value = cache.get(key)
+            except TypeError:  # Unhashable arguments
+                return func(*args, **kwargs)
+            if found:
+                return value
+            names = depends(**bound.arguments) if callable(depends) else depends
+            marks = cache.snapshot((*names, REWRITE))
+            value = func(*args, **kwargs)
+            cache.put(key, value, marks)
+            return value
+
+        wrapper.uncached = func
+        return wrapper
+    return decorate
+
+
+class CacheInvalidator(WriterHook):
+    """Moves the watermarks of each committed batch (writer hook)."""
+
+    def __init__(self, cache=query_cache):
+        self.cache = cache
+        self.seen = set()
+
+    def after_commit(self, rows):
+        self.committed(commit_marks(rows))
+
+    def committed(self, names):
+        """Move the commit_marks() of a commit (also called for commits made by other processes)."""
+        topics = {name[1] for name in names if isinstance(name, tuple) and name[0] == "topic"}
+        if not topics <= self.seen:
+            self.seen |= topics
+            names = {*names, TOPICS}
+        self.cache.bump(names)
@@ -0,0 +1,289 @@
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+from app import log
+from app.cache import CacheInvalidator, commit_marks
+from app.config import BROKER_IP, PORT, SPILL_PATH, MQTT_RECONNECT_MIN_DELAY
+from app.config import INGEST_PROCESSES, INGEST_SHARDING, INGEST_SHARE_GROUP, INGEST_CLIENT_ID
+from app.config import INGEST_FORWARD_INTERVAL, INGEST_REPORT_INTERVAL, INGEST_RESTART_MAX_DELAY
+from app.database import close_db, get_writer
+from app.metrics import registry
+from app.mqtt_client import CallbackDispatcher, MQTTClient
+from app.topic_tree import TopicMatcher
+from app.writer import WriterHook
+
+logger = logging.getLogger(__name__)
+
+SHARDING_MODES = ("hash", "shared")
+
+
+class _Forwarder(WriterHook):
+    """Writer hook of an ingest process that collects committed messages for the coordinator."""
+
+    def __init__(self, index, events):
+        self.index = index
+        self.events = events
+        self.messages = []  # (topic, value or data) committed since the last send
+        self.marks = set()  # Cache watermarks those commits moved
+        self._lock = threading.Lock()
+
+    def after_commit(self, rows):
+        messages = [(row["topic"], row["value"] if row["value"] is not None else row["data"]) for row in rows]
+        marks = commit_marks(rows)
+        with self._lock:
+            self.messages.extend(messages)
+            self.marks |= marks
+
+    def send(self):
+        with self._lock:
+            messages, self.messages = self.messages, []
+            marks, self.marks = self.marks, set()
+        if messages:
+            self.events.put(("committed", self.index, (messages, marks)))
+
+
+def _report(client):
+    return {
+        "connected": client.is_connected(),
+        "ingest": client.ingest_metrics(),
+        "writer": client.writer_metrics(),
+        "clocks": client.clock_metrics() if client.time_sync else None,
+        "metrics": registry.collect(),
+    }
+
+
+def _run_process(index, processes, sharding, group, host, port, control, events):
+    """Body of ingest process `index`: follow the subscriptions sent on `control`, report on `events`."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C reaches the whole process group; the coordinator stops us
+    log.configure()
+
+    forwarder = _Forwarder(index, events)
+    get_writer(spill_path=f"{SPILL_PATH}.{index}").hooks.append(forwarder)
+    # Clock probes are answered by the first process only; the others read its estimates from clock_offsets
+    client = MQTTClient(client_id=f"{INGEST_CLIENT_ID}-{index}", clean_session=False, time_sync=index == 0)
+    if sharding == "shared":
+        client.share_group = group
+    else:
+        client.shard = (index, processes)
+    client.start(host, port)
+    logger.info("Ingest process %s of %s started (%s sharding)", index, processes, sharding)
+
+    parent = multiprocessing.parent_process()
+    next_report = 0.0
+    timeout = None
+    while parent.is_alive():
+        try:
+            command = control.get(timeout=INGEST_FORWARD_INTERVAL)
+        except queue.Empty:
+            command = None
+        if command is not None and command[0] == "stop":
+            timeout = command[1]
+            break
+        if command is not None and command[0] == "subscribe":
+            client.subscribe(command[1], None, command[2])
+        elif command is not None and command[0] == "unsubscribe":
+            client.unsubscribe(command[1])
+
+        forwarder.send()
+        if time.monotonic() >= next_report:
+            events.put(("report", index, _report(client)))
+            next_report = time.monotonic() + INGEST_REPORT_INTERVAL
+
+    client.stop(timeout)
+    close_db(timeout)
+    forwarder.send()
+    logger.info("Ingest process %s stopped", index)
+
+
+class IngestCluster:
+    """Ingest spread over subscriber processes, each with its own broker connection, ingest workers and writer.
+
+    With "hash" sharding every process subscribes to the full filters and
+    keeps the topics process_shard() assigns to it, so each topic is stored
+    in order by one writer. With "shared" the processes join a $share group
+    and the broker balances messages over them, which spares each process
+    from receiving every message but spreads a topic over several writers.
+    The writers share the database and take turns at its write lock.
+
+    Offers the subscribe/dispatcher surface of MQTTClient; callbacks get a
+    message once a process has committed it, and the query-cache watermarks of
+    this process move with it. Processes that exit are restarted after a
+    doubling delay; their persistent sessions keep what the broker queued for
+    them (QoS 1 and 2) in the meantime.
+    """
+
+    def __init__(self, processes=INGEST_PROCESSES, sharding=INGEST_SHARDING, group=INGEST_SHARE_GROUP):
+        if sharding not in SHARDING_MODES:
+            raise ValueError(f"Unknown ingest sharding: {sharding!r}")
+        self.sharding = sharding
+        self.group = group
+        self.host = self.port = None
+        self.callbacks = TopicMatcher()
+        self.dispatcher = CallbackDispatcher()
+        self.subscriptions = {}  # topic filter -> qos
+        self.processes = [None] * processes
+        self.controls = [None] * processes
+        self.reports = [None] * processes  # Latest report per process, None until its first one
+        self.restarts = [0] * processes
+        self._started = [0.0] * processes
+        self._context = multiprocessing.get_context("spawn")  # No fork of a process that runs threads
+        self.events = self._context.Queue()
+        self._invalidator = CacheInvalidator()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+
+        registry.gauge("iot_ingest_processes_up", "Ingest processes running",
+                       function=lambda: sum(1 for process in self.processes if process is not None and process.is_alive()))
+        registry.counter("iot_ingest_process_restarts_total", "Restarts of each ingest process", ("worker",),
+                         function=lambda: {(str(index),): count for index, count in enumerate(self.restarts)})
+        registry.add_collector(self._collect)
+
+    def start(self, host=BROKER_IP, port=PORT):
+        if self._threads:
+            return
+        self.host, self.port = host, port
+        for index in range(len(self.processes)):
+            self._spawn(index)
+        for target, name in ((self._receive, "cluster-events"), (self._supervise, "cluster-supervisor")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Let every process drain and commit what it received, then stop them."""
+        self._stopping.set()
+        with self._lock:
+            processes = list(self.processes)
+            for control in self.controls:
+                control.put(("stop", timeout))
+        for index, process in enumerate(processes):
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning("Ingest process %s did not stop in time; terminating it", index)
+                process.terminate()
+                process.join()
+        self.events.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def subscribe(self, topic, callback, qos=0):
+        if callback not in self.callbacks.filters(topic):
+            self.callbacks.add(topic, callback)
+        with self._lock:
+            if self.subscriptions.get(topic) == qos:
+                return
+            self.subscriptions[topic] = qos
+            for control in self.controls:
+                control.put(("subscribe", topic, qos))
+
+    def unsubscribe(self, topic, callback=None):
+        callbacks = [callback] if callback is not None else self.callbacks.filters(topic)
+        for registered in callbacks:
+            self.callbacks.remove(topic, registered)
+        if self.callbacks.filters(topic):
+            return
+        with self._lock:
+            if self.subscriptions.pop(topic, None) is None:
+                return
+            for control in self.controls:
+                control.put(("unsubscribe", topic))
+
+    def _spawn(self, index):
+        with self._lock:
+            control = self._context.Queue()
+            for topic, qos in self.subscriptions.items():
+                control.put(("subscribe", topic, qos))
+            process = self._context.Process(
+                target=_run_process, name=f"ingest-process-{index}",
+                args=(index, len(self.processes), self.sharding, self.group, self.host, self.port, control, self.events),
+            )
+            process.start()
+            self.processes[index], self.controls[index] = process, control
+            self._started[index] = time.monotonic()
+
+    def _receive(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            kind, index, body = event
+            if kind == "report":
+                self.reports[index] = body
+                continue
+            messages, marks = body
+            for topic, payload in messages:
+                for callback in self.callbacks.match(topic):
+                    self.dispatcher.put(callback, payload, topic)
+            self._invalidator.committed(marks)
+
+    def _supervise(self):
+        delays = [MQTT_RECONNECT_MIN_DELAY] * len(self.processes)
+        due = [None] * len(self.processes)  # time.monotonic() a dead process is restarted at
+        while not self._stopping.wait(1):
+            for index, process in enumerate(self.processes):
+                if process.is_alive():
+                    continue
+                now = time.monotonic()
+                if due[index] is None:
+                    # A process that ran for a while gets restarted quickly again
+                    if now - self._started[index] >= INGEST_RESTART_MAX_DELAY:
+                        delays[index] = MQTT_RECONNECT_MIN_DELAY
+                    logger.warning("Ingest process %s exited with code %s; restarting in %ss",
+                                   index, process.exitcode, delays[index])
+                    self.reports[index] = None
+                    due[index] = now + delays[index]
+                    delays[index] = min(delays[index] * 2, INGEST_RESTART_MAX_DELAY)
+                elif now >= due[index] and not self._stopping.is_set():
+                    due[index] = None
+                    self.restarts[index] += 1
+                    self._spawn(index)
+
+    def _collect(self):
+        """The processes' latest metrics, each series labelled with its process index."""
+        families = []
+        for index, report in enumerate(self.reports):
+            if report is None:
+                continue
+            worker = ("worker", str(index))
+            for name, kind, help, samples in report["metrics"]:
+                families.append((name, kind, help, [(suffix, (worker,) + labels, value) for suffix, labels, value in samples]))
+        return families
+
+    def is_connected(self):
+        """True once every process reports a broker connection."""
+        return all(report is not None and report["connected"] for report in self.reports)
+
+    def ingest_metrics(self):
+        """Totals over the processes' ingest pipelines, followed by each process's own metrics."""
+        reports = list(self.reports)
+        pipelines = [report["ingest"] for report in reports if report is not None and report["ingest"] is not None]
+        return {
+            "processes": len(reports),
+            "sharding": self.sharding,
+            "alive": sum(1 for process in self.processes if process is not None and process.is_alive()),
+            "restarts": list(self.restarts),
+            "queue_depth": sum(pipeline["queue_depth"] for pipeline in pipelines),
+            "processed": sum(pipeline["processed"] for pipeline in pipelines),
+            "errors": sum(pipeline["errors"] for pipeline in pipelines),
+            "lag": max((pipeline["lag"] for pipeline in pipelines), default=0.0),
+            "per_process": [report["ingest"] if report is not None else None for report in reports],
+        }
+
+    def writer_metrics(self):
+        """Writer counters summed over the processes, or None before any has written."""
+        writers = [report["writer"] for report in self.reports if report is not None and report["writer"] is not None]
+        if not writers:
+            return None
+        totals = {}
+        for writer in writers:
+            for name, value in writer.items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def clock_metrics(self):
+        report = self.reports[0]
+        return report["clocks"] if report is not None else None
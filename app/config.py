@@ -1,17 +1,179 @@
 import os
+import json
 
 # MQTT Configuration
 BROKER_IP = "10.245.30.78"  # Change this to your actual broker IP
 PORT = 1883
 MQTT_USERNAME = "admin"
 MQTT_PASSWORD = "admin"
+MQTT_RECONNECT_MIN_DELAY = 1  # Seconds before the first reconnect attempt
+MQTT_RECONNECT_MAX_DELAY = 60  # Cap on the doubling delay between reconnect attempts
 
 
+# Logging Configuration
+LOG_LEVEL = "INFO"  # DEBUG also logs every stored message (rate limited)
+LOG_FORMAT = "text"  # "text" ([LEVEL] message) or "json" (one object per line)
+LOG_FILE = ""  # Append log lines to this file instead of standard output
+LOG_QUEUE_SIZE = 10000  # Records waiting for the log writer thread; more are dropped
+LOG_RATE_LIMIT = 20  # Most records per second from one logging call; 0 for no limit
+
 # Database Configuration
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DATABASE_DIR = os.path.join(BASE_DIR, "database")
+DATABASE_DIR = os.path.join(BASE_DIR, "database")  # Created by init_db()
+DATABASE_PATH = os.path.join(DATABASE_DIR, "data.db")
+PARTITION_DIR = os.path.join(DATABASE_DIR, "partitions")  # One mqtt_data file per UTC day
+
+# Ingest Configuration
+INGEST_WORKERS = 4  # Worker threads (or processes) handling parse/latency/persistence
+INGEST_MODE = "thread"  # "thread" or "process" (parse in a process pool)
+INGEST_QUEUE_SIZE = 10000  # Per-worker bound on raw messages waiting to be processed
+INGEST_PROCESS_BATCH = 200  # Messages sent to a worker process per round trip
+INGEST_MAX_CLOCK_SKEW = 366 * 86400  # Seconds a send time may lie from its receive time; further off it counts as missing
+# (topic filter, codec name) for topics whose payloads carry no marker byte; the first match applies.
+# Other payloads are decoded by their leading marker byte, or as JSON if they have none.
+# Codecs (app/payload.py): "json", "struct" (sent_ns, data), "struct-seq" (+ device, seq), "msgpack", "cbor"
+PAYLOAD_CODECS = ()
+
+# Metrics and Profiling Configuration
+METRICS_HOST = "127.0.0.1"  # Interface of the GUI's /metrics endpoint (the ingest daemon serves it on its read API)
+METRICS_PORT = 9101  # Port of the GUI's /metrics endpoint; 0 turns it off
+METRICS_HISTOGRAM_BUCKETS = (1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.5, 1, 5)  # Seconds
+METRICS_MAX_SERIES = 1000  # Label combinations per metric (e.g. topics); further ones are counted as "_other"
+PROFILE_DEFAULT_SECONDS = 10  # Length of a profile window when none is given
+PROFILE_MAX_SECONDS = 300  # Longest profile window that can be requested
+PROFILE_TOP = 40  # Functions (CPU) or source lines (memory) listed in a profile report
+DIAGNOSTICS_REFRESH_MS = 1000  # How often the Diagnostics page re-reads the metrics
+
+# Clock Sync Configuration
+TIME_SYNC_TOPIC = "timesync"  # Publishers probe our clock on <topic>/<client id>/ping; reserved, never stored
+TIME_SYNC_WINDOW = 32  # Recent probes per publisher the offset/drift fit uses
+TIME_SYNC_MIN_SPAN = 60  # Seconds the probes must span before drift is fitted (constant offset until then)
+TIME_SYNC_MAX_AGE = 6 * 3600  # Seconds after a publisher's last probe that its estimate stops being applied
+TIME_SYNC_RELOAD = 30  # Seconds before a stored estimate (kept current by another ingest process) is read again
+TIME_SYNC_MAX_LOADED = 10000  # Publishers whose stored estimate (or its absence) is kept in memory between reloads
+
+# Delivery Accounting Configuration
+DELIVERY_WINDOW = 1024  # Sequence numbers per publisher the duplicate window spans; older ones can't be told apart
+DELIVERY_MAX_PUBLISHERS = 10000  # Publisher windows kept in memory (the rest are read back from delivery_windows)
+
+# Write Pipeline Configuration
+WRITE_BATCH_SIZE = 500  # Max rows per group commit
+WRITE_FLUSH_INTERVAL = 0.05  # Max seconds a queued row waits before commit
+WRITE_QUEUE_SIZE = 10000  # Bound on rows waiting for the writer
+WRITE_BACKPRESSURE = "block"  # "block", "drop_oldest" or "spill" when the queue is full
+WRITE_SYNCHRONOUS = "NORMAL"  # SQLite synchronous level for the writer connection
+WRITE_LOCK_TIMEOUT = 30  # Seconds a batch waits for another process's write transaction to finish
+DB_CACHE_SIZE = -16384  # PRAGMA cache_size of every connection (negative: KiB, so 16 MiB)
+DB_MMAP_SIZE = 256 * 1024 * 1024  # PRAGMA mmap_size of every connection; 0 turns memory-mapped reads off
+READ_POOL_SIZE = 4  # Pooled read-only connections per database file
+READ_POOL_TIMEOUT = 1.0  # Seconds a read waits for a pooled connection before opening an extra one
+READ_POOL_MAX_FILES = 8  # Database files (main + partitions) whose idle reader connections are kept
+SPILL_PATH = os.path.join(DATABASE_DIR, "spill.jsonl")
+BACKFILL_CHUNK_SIZE = 5000  # Rows converted per transaction when upgrading an existing database
+
+# Retention Configuration
+# (topic filter, days of raw rows to keep or None for forever); the first matching filter applies
+RETENTION_POLICIES = (("#", None),)
+# (rollup resolution in seconds, days to keep or None); coarser rollups outlive finer ones
+ROLLUP_RETENTION = ((1, None), (60, None), (3600, None))
+COMPACTION_INTERVAL = 3600  # Seconds between background retention/compaction passes
+
+# Archive Configuration
+ARCHIVE_DIR = os.path.join(DATABASE_DIR, "archive")  # Columnar copies of closed partitions for analytics
+ARCHIVE_FORMAT = "auto"  # "parquet" (needs pyarrow), "npy" (memory-mapped numpy), "auto" or "off"
+ARCHIVE_CHUNK_ROWS = 250000  # Rows per archive file when archiving the pre-partitioning table
+
+# Query Cache Configuration
+QUERY_CACHE_MAX_ENTRIES = 256  # Reader results kept
+QUERY_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Approximate memory cap for cached results
+QUERY_CACHE_TTL = 300  # Seconds a result may be served without a watermark moving (bounds staleness from other processes)
+QUERY_CACHE_SETTLE = 60  # Seconds after which a received_time range only changes through late commits (spill replay)
+
+# Statistics Configuration
+SKETCH_RELATIVE_ACCURACY = 0.01  # Relative error of latency quantiles (p50/p95/p99)
+SKETCH_MAX_BINS = 2048  # Upper bound on bins per quantile sketch
+ROLLUP_RESOLUTIONS = (1, 60, 3600)  # Rollup bucket widths in seconds
+GRAPH_TARGET_POINTS = 2000  # Points per series the graph queries aim for
+LTTB_MAX_ROWS = 200000  # Largest raw range downsampled with LTTB instead of read from rollups
+JITTER_SMOOTHING_WINDOW = 25  # Messages in the rolling mean drawn over raw jitter
+LIVE_GRAPH_WINDOW = 60  # Seconds of history shown by the live graph
+LIVE_GRAPH_POINTS = 5000  # Newest messages per QoS level the live graph keeps
+LIVE_GRAPH_FPS = 10  # Most live graph redraws (and database polls) per second
+LIVE_GRAPH_FETCH_LIMIT = 20000  # Most new rows the live graph reads per poll
+
+# GUI Configuration
+TOPIC_PAGE_SIZE = 200  # Rows fetched per page in the topic data viewer
+TOPIC_VIEW_WINDOW = 1000  # Most rows the topic data viewer keeps loaded at once
+TOPIC_TAIL_INTERVAL_MS = 1000  # How often the topic data viewer polls for new rows
+DISPATCH_INTERVAL_MS = 50  # How often queued MQTT callbacks are delivered on the Tk thread
+DISPATCH_BATCH_SIZE = 1000  # Most callbacks delivered per Tk tick
+TOPIC_TREE_REFRESH_MS = 500  # How often new-message counts are applied to the topic tree
+
+# Ingest Daemon Configuration
+DAEMON_SUBSCRIBE_TOPIC = "#"  # Topic filter the headless collector captures
+DAEMON_SUBSCRIBE_QOS = 0
+DAEMON_HTTP_HOST = "127.0.0.1"  # Read API address; use 0.0.0.0 to serve other machines
+DAEMON_HTTP_PORT = 8765
+DAEMON_SHUTDOWN_TIMEOUT = 30  # Seconds allowed for draining queued messages on shutdown
+LIVE_FEED_SIZE = 10000  # Recent messages kept for attached GUIs
+LIVE_POLL_TIMEOUT = 20  # Seconds a /live request waits for new messages
+
+# Multi-process Ingest Configuration (daemon only)
+INGEST_PROCESSES = 1  # Subscriber processes, each with its own broker connection and batched writer; 1 ingests in-process
+INGEST_SHARDING = "hash"  # "hash": each process keeps the topics hashing to it; "shared": $share subscription, broker balances
+INGEST_SHARE_GROUP = "iot-ingest"  # Shared subscription group of the "shared" processes
+INGEST_CLIENT_ID = "iot-ingest"  # Processes connect as <id>-<index> with persistent sessions, so a restart gets what was queued
+INGEST_FORWARD_INTERVAL = 0.05  # Seconds between a process's batches of committed messages to the coordinator
+INGEST_REPORT_INTERVAL = 1.0  # Seconds between a process's metrics reports
+INGEST_RESTART_MAX_DELAY = 60  # Cap on the doubling delay before a crashed process is restarted
+
+
+def _apply_overrides():
+    """Override the values above from a JSON file named by IOT_CONFIG, then from IOT_<NAME> variables.
+
+    Environment values for non-string settings are parsed as JSON (numbers,
+    lists). Paths derived from DATABASE_DIR follow
+    it unless they are overridden themselves.
+    """
+    overrides = {}
+    config_file = os.environ.get("IOT_CONFIG")
+    if config_file:
+        with open(config_file, encoding="utf-8") as f:
+            overrides.update(json.load(f))
+    for name in list(globals()):
+        value = os.environ.get(f"IOT_{name}")
+        if not name.isupper() or value is None:
+            continue
+        if isinstance(globals()[name], str):
+            overrides[name] = value
+        else:
+            try:
+                overrides[name] = json.loads(value)
+            except ValueError:
+                overrides[name] = value
+
+    unknown = [name for name in overrides if not (name.isupper() and name in globals())]
+    if unknown:
+        raise ValueError(f"Unknown configuration settings: {', '.join(unknown)}")
+    for name, value in overrides.items():
+        default = globals()[name]
+        if isinstance(default, tuple):
+            value = tuple(value)
+        elif isinstance(default, float) and isinstance(value, int):
+            value = float(value)
+        elif not isinstance(value, type(default)):
+            raise ValueError(f"Configuration setting {name} must be {type(default).__name__}, got {value!r}")
+        globals()[name] = value
+
+    if "DATABASE_DIR" in overrides:
+        if "DATABASE_PATH" not in overrides:
+            globals()["DATABASE_PATH"] = os.path.join(DATABASE_DIR, "data.db")
+        if "SPILL_PATH" not in overrides:
+            globals()["SPILL_PATH"] = os.path.join(DATABASE_DIR, "spill.jsonl")
+        if "PARTITION_DIR" not in overrides:
+            globals()["PARTITION_DIR"] = os.path.join(DATABASE_DIR, "partitions")
+        if "ARCHIVE_DIR" not in overrides:
+            globals()["ARCHIVE_DIR"] = os.path.join(DATABASE_DIR, "archive")
 
-# Ensure the database directory exists
-os.makedirs(DATABASE_DIR, exist_ok=True)
 
-DATABASE_PATH = os.path.join(DATABASE_DIR, "data.db")
\ No newline at end of file
+_apply_overrides()
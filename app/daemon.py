@@ -0,0 +1,199 @@
+import argparse
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+logger = logging.getLogger(__name__)
+
+
+class LiveFeed:
+    """Ring buffer of recent messages, numbered so that readers can resume after the last one they saw."""
+
+    def __init__(self, size):
+        self.messages = deque(maxlen=size)  # (seq, topic, payload)
+        self.seq = 0
+        self._cond = threading.Condition()
+
+    def publish(self, payload, topic):
+        """Subscription callback; runs once the message is committed, on the writer thread (or the cluster event thread)."""
+        with self._cond:
+            self.seq += 1
+            self.messages.append((self.seq, topic, payload))
+            self._cond.notify_all()
+
+    def since(self, after, timeout):
+        """Messages with seq > `after`, waiting up to `timeout` seconds for the first one.
+
+        Returns (latest seq, messages, number of messages already evicted from the buffer).
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self.seq > after, timeout)
+            if not self.messages or self.seq <= after:
+                return self.seq, [], 0
+            first = self.messages[0][0]
+            start = max(after + 1 - first, 0)
+            return self.seq, [self.messages[i] for i in range(start, len(self.messages))], max(first - after - 1, 0)
+
+
+def _int(params, name, default=None):
+    return int(params[name][0]) if name in params else default
+
+
+def _float(params, name, default=None):
+    return float(params[name][0]) if name in params else default
+
+
+class ReadAPIHandler(BaseHTTPRequestHandler):
+    """JSON read API over the database and the live feed, plus Prometheus /metrics and POST /profile."""
+
+    feed = None
+    mqtt_client = None
+
+    def do_GET(self):
+        from app import database, log
+        from app.cache import query_cache
+        from app.config import LIVE_POLL_TIMEOUT
+        from app.metrics import PROMETHEUS_CONTENT_TYPE, registry
+        from app.profiling import profiler
+
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        try:
+            content_type = "application/json"
+            if url.path == "/metrics":
+                content_type, data = PROMETHEUS_CONTENT_TYPE, registry.render().encode()
+            elif url.path == "/live" and "after" not in params:
+                body = {"seq": self.feed.seq, "missed": 0, "messages": [], "version": query_cache.version, "moved": []}
+            elif url.path == "/live":
+                seq, messages, missed = self.feed.since(
+                    _int(params, "after", 0), min(_float(params, "timeout", LIVE_POLL_TIMEOUT), LIVE_POLL_TIMEOUT)
+                )
+                # Cache watermarks this process's commits moved since the reader's `version`
+                version, moved = query_cache.moved_since(_int(params, "version", 0))
+                body = {"seq": seq, "missed": missed, "messages": messages, "version": version, "moved": moved}
+            elif url.path == "/health":
+                body = {
+                    "connected": self.mqtt_client.is_connected(),
+                    "ingest": self.mqtt_client.ingest_metrics(),
+                    "writer": self.mqtt_client.writer_metrics(),
+                    "readers": database.pool_metrics(),
+                    "cache": database.cache_metrics(),
+                    "log_dropped": log.dropped(),
+                    "clocks": self.mqtt_client.clock_metrics(),
+                }
+            elif url.path == "/topics":
+                body = database.get_topic_summaries()
+            elif url.path == "/topic":
+                after = (_float(params, "after_time"), _int(params, "after_id")) if "after_id" in params else None
+                before = (_float(params, "before_time"), _int(params, "before_id")) if "before_id" in params else None
+                body = database.get_topic_page(
+                    params["topic"][0], after=after, before=before,
+                    start=_float(params, "start"), end=_float(params, "end"),
+                    limit=_int(params, "limit", database.TOPIC_PAGE_SIZE),
+                )
+            elif url.path == "/stats":
+                body = database.get_latency_stats(params["topic"][0] if "topic" in params else None)
+            elif url.path == "/delivery":
+                body = database.get_delivery_stats(params["topic"][0] if "topic" in params else None)
+            elif url.path == "/profile":
+                body = profiler.status()
+            else:
+                self.send_error(404)
+                return
+            if content_type == "application/json":
+                data = json.dumps(body).encode()
+        except (KeyError, ValueError) as e:
+            self.send_error(400, f"Bad request: {e}")
+            return
+        except Exception as e:
+            # e.g. sqlite3.OperationalError while the database is locked; the client gets a status either way
+            logger.exception("Failed to serve %s", self.path)
+            self._send(500, "application/json", json.dumps({"error": f"{type(e).__name__}: {e}"}).encode())
+            return
+
+        self._send(200, content_type, data)
+
+    def do_POST(self):
+        """POST /profile?kind=cpu|memory&seconds=N opens a profiling window; poll GET /profile for the report."""
+        from app.config import PROFILE_DEFAULT_SECONDS
+        from app.profiling import profiler
+
+        url = urlparse(self.path)
+        if url.path != "/profile":
+            self.send_error(404)
+            return
+        params = parse_qs(url.query)
+        try:
+            profiler.start(params.get("kind", ["cpu"])[0], _float(params, "seconds", PROFILE_DEFAULT_SECONDS))
+        except ValueError as e:
+            self.send_error(409, str(e))
+            return
+        self._send(202, "application/json", json.dumps(profiler.status()).encode())
+
+    def _send(self, status, content_type, data):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass  # One line per live poll would drown the service log
+
+
+def run(topic, qos, host, port):
+    """Capture `topic` until SIGINT/SIGTERM, then drain and exit."""
+    from app.bootstrap import bootstrap
+    from app.config import LIVE_FEED_SIZE, DAEMON_SHUTDOWN_TIMEOUT, INGEST_PROCESSES
+    from app.database import close_db
+    from app.log import configure
+
+    configure()
+    mqtt_client = bootstrap(processes=INGEST_PROCESSES)
+    feed = LiveFeed(LIVE_FEED_SIZE)
+    mqtt_client.subscribe(topic, feed.publish, qos)
+
+    ReadAPIHandler.feed = feed
+    ReadAPIHandler.mqtt_client = mqtt_client
+    server = ThreadingHTTPServer((host, port), ReadAPIHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="read-api", daemon=True).start()
+    logger.info("Ingest daemon capturing `%s` at QoS %s; read API on http://%s:%s", topic, qos, host, port)
+
+    stopping = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda signum, frame: stopping.set())
+    while not stopping.wait(1):
+        pass
+
+    logger.info("Shutting down: draining queued messages")
+    server.shutdown()
+    mqtt_client.stop(DAEMON_SHUTDOWN_TIMEOUT)
+    close_db(DAEMON_SHUTDOWN_TIMEOUT)
+    logger.info("Ingest daemon stopped")
+
+
+def main(argv=None):
+    """python -m app.daemon [--config settings.json]
+
+    Settings come from app/config.py, overridden by the JSON file and
+    IOT_<NAME> environment variables.
+    """
+    parser = argparse.ArgumentParser(description="Headless MQTT ingest service")
+    parser.add_argument("--config", help="JSON file of app/config.py overrides (same as IOT_CONFIG)")
+    args = parser.parse_args(argv)
+    if args.config:
+        os.environ["IOT_CONFIG"] = args.config  # Read when app.config is first imported
+
+    from app.config import DAEMON_SUBSCRIBE_TOPIC, DAEMON_SUBSCRIBE_QOS, DAEMON_HTTP_HOST, DAEMON_HTTP_PORT
+    run(DAEMON_SUBSCRIBE_TOPIC, DAEMON_SUBSCRIBE_QOS, DAEMON_HTTP_HOST, DAEMON_HTTP_PORT)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
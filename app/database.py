@@ -1,11 +1,153 @@
+import logging
+import os
 import sqlite3
 import json
-from datetime import datetime
-from app.config import DATABASE_PATH
+import atexit
+import base64
+import functools
+import threading
+import time
+from contextlib import ExitStack
+from app.config import DATABASE_PATH, ROLLUP_RESOLUTIONS, GRAPH_TARGET_POINTS, LTTB_MAX_ROWS, TOPIC_PAGE_SIZE, LIVE_GRAPH_FETCH_LIMIT
+from app.config import PAYLOAD_CODECS, INGEST_PROCESSES, INGEST_SHARDING, INGEST_MAX_CLOCK_SKEW
+from app.writer import BatchWriter, WriterHook
+from app.migrations import migrate, backfill_time_columns
+from app.timeutil import NS_PER_SECOND, parse_timestamp_ns, format_timestamp_ns
+from app.stats import StatsEngine, LatencySummary, DDSketch, summary_to_dict, backfill_latency_stats
+from app.rollups import RollupHook, backfill_rollups, choose_resolution
+from app.partitions import DAY, ID_STRIDE, PartitionRouter, query_partitions, sources, read_source, readers, upgrade_partitions
+from app.retention import rollup_cutoff
+from app.cache import ALL, TOPICS, REWRITE, CacheInvalidator, cached, query_cache, range_marks, topic_mark
+from app.payload import PayloadError, decode as decode_payload, get_codec
+from app.topic_tree import TopicMatcher
+from app.timesync import ClockCorrector
+from app.delivery import DeliveryTracker, backfill_delivery_stats
+from app.metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# {schema} is the day partition the row goes to (see PartitionRouter)
+INSERT_MQTT_DATA = """
+    INSERT INTO {schema}.mqtt_data (topic, topic_id, data, value, qos_level, packet_size, sent_timestamp, received_timestamp,
+                           sent_time, received_time, sent_ns, received_ns, latency, jitter, previous_latency,
+                           precise_received_time, client_id, clock_offset, latency_error)
+    VALUES (:topic, :topic_id, :data, :value, :qos_level, :packet_size, :sent_timestamp, :received_timestamp,
+            :sent_time, :received_time, :sent_ns, :received_ns, :latency, :jitter, :previous_latency,
+            :precise_received_time, :client_id, :clock_offset, :latency_error)
+"""
+
+
+class TopicRegistry(WriterHook):
+    """Keeps the topics dimension table current and stamps each row with its topic_id."""
+
+    def __init__(self):
+        self.ids = {}
+
+    def before_insert(self, conn, rows):
+        batch_topics = {}
+        for row in rows:
+            topic, received_time = row["topic"], row["received_time"]
+            entry = batch_topics.get(topic)
+            if entry is None:
+                batch_topics[topic] = [received_time, received_time, 1]
+            else:
+                entry[1] = received_time
+                entry[2] += 1
+
+        conn.executemany("""
+            INSERT INTO topics (topic, first_seen, last_seen, message_count) VALUES (?, ?, ?, ?)
+            ON CONFLICT(topic) DO UPDATE SET
+                first_seen = COALESCE(first_seen, excluded.first_seen),
+                last_seen = excluded.last_seen,
+                message_count = message_count + excluded.message_count
+        """, [(topic, *entry) for topic, entry in batch_topics.items()])
+
+        for topic in batch_topics:
+            if topic not in self.ids:
+                self.ids[topic] = conn.execute("SELECT id FROM topics WHERE topic = ?", (topic,)).fetchone()[0]
+        for row in rows:
+            row["topic_id"] = self.ids[row["topic"]]
+        return rows
+
+    def rollback(self):
+        self.ids.clear()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+_backfill_lock = threading.Lock()
+
+def get_writer(**options):
+    """Return the shared batched writer, starting it on first use with BatchWriter `options`."""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            router = PartitionRouter(INSERT_MQTT_DATA)
+            # Shared subscriptions spread a topic's messages over several writer processes
+            stats = StatsEngine(shared=INGEST_PROCESSES > 1 and INGEST_SHARDING == "shared")
+            # A publisher's topics can land in different processes under either sharding
+            delivery = DeliveryTracker(shared=INGEST_PROCESSES > 1)
+            hooks = [delivery, ClockCorrector(), TopicRegistry(), stats, RollupHook(), router, CacheInvalidator()]
+            _writer = BatchWriter(router.insert, hooks=hooks, **options)
+            atexit.register(close_db)
+    return _writer
+
+def flush_data(timeout=None):
+    """Block until all queued MQTT messages have been committed."""
+    if _writer is not None:
+        return _writer.flush(timeout)
+    return True
+
+def writer_metrics():
+    """Counters of the batched writer, or None before the first message was queued."""
+    writer = _writer
+    return writer.metrics() if writer is not None else None
+
+def pool_metrics():
+    """Checkout counts and wait times of the pooled reader connections."""
+    return readers.metrics()
+
+def cache_metrics():
+    """Hit/miss counters and size of the reader cache."""
+    return query_cache.metrics()
+
+def close_db(timeout=None):
+    """Flush queued messages and close the writer connection."""
+    global _writer
+    with _writer_lock:
+        writer, _writer = _writer, None
+    if writer is not None:
+        writer.close(timeout)
+
+def run_backfills():
+    """Convert rows stored before the latest migrations, in dependency order."""
+    if not _backfill_lock.acquire(blocking=False):
+        return  # Already running in this process
+    try:
+        backfill_time_columns(DATABASE_PATH)
+        backfill_latency_stats(DATABASE_PATH)
+        backfill_rollups(DATABASE_PATH)
+        backfill_delivery_stats(DATABASE_PATH)
+        query_cache.bump([REWRITE])
+        try:
+            from app.archive import archive_legacy
+        except ImportError:
+            return  # numpy is not installed; history stays in SQLite only
+        archive_legacy(DATABASE_PATH)
+    finally:
+        _backfill_lock.release()
+
+def start_backfill():
+    """Run the pending backfills on a background thread."""
+    thread = threading.Thread(target=run_backfills, name="db-backfill", daemon=True)
+    thread.start()
+    return thread
 
 def init_db():
     """Initialize the database and create the table if it doesn't exist."""
-    conn = sqlite3.connect(DATABASE_PATH)
+    os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
+    conn = sqlite3.connect(DATABASE_PATH, timeout=30)  # Waits out another process's migration step
+    conn.execute("PRAGMA journal_mode=WAL")  # Readers and the writer no longer block each other
     cursor = conn.cursor()
     
     # Update table schema to include precise_received_time
@@ -33,126 +175,482 @@ def init_db():
     """)
 
     conn.commit()
+
+    # Bring older databases up to the current schema; row conversion continues in the background
+    migrate(conn)
     conn.close()
+    upgrade_partitions()
+    start_backfill()
 
 
-    
-def save_data(topic, payload, qos, received_timestamp, packet_size, precise_received_time):
-    """Save MQTT messages using system-monotonic timing to ensure accuracy."""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+# Codec of the topics whose payloads carry no marker byte, per PAYLOAD_CODECS topic filter
+_topic_codecs = TopicMatcher()
+for _index, (_topic_filter, _codec) in enumerate(PAYLOAD_CODECS):
+    _topic_codecs.add(_topic_filter, (_index, get_codec(_codec).name))
+
+@functools.lru_cache(maxsize=4096)
+def topic_codec(topic):
+    """Name of the codec of every payload on `topic` (the first matching filter wins), or None to go by marker byte."""
+    matches = _topic_codecs.match(topic)
+    return min(matches)[1] if matches else None
 
+def bytes_text(raw):
+    """Bytes decoded by a binary codec as text for the `data` column: UTF-8 if valid, else base64."""
     try:
-        payload_data = json.loads(payload)  # Try parsing JSON
-        if "sent_timestamp" in payload_data:
+        return raw.decode()
+    except UnicodeDecodeError:
+        return base64.b64encode(raw).decode()
+
+def payload_text(payload):
+    """The whole payload as text, for the `data` column of payloads without a usable `data` field."""
+    return payload.decode(errors="replace") if isinstance(payload, bytes) else str(payload)
+
+def valid_sent_ns(sent_ns, received_ns):
+    """True if `sent_ns` is an epoch-ns integer within INGEST_MAX_CLOCK_SKEW of `received_ns`."""
+    return (isinstance(sent_ns, int) and not isinstance(sent_ns, bool) and 0 < sent_ns < 2 ** 63
+            and abs(received_ns - sent_ns) <= INGEST_MAX_CLOCK_SKEW * NS_PER_SECOND)
+
+def build_row(topic, payload, qos, received_ns, packet_size, precise_received_time):
+    """Parse an MQTT payload into a mqtt_data row without touching the database.
+
+    Clients opt in to the compact time format by sending `sent_ns` (integer
+    epoch nanoseconds); otherwise the legacy `sent_timestamp` string is parsed.
+    `payload` is raw bytes in any codec of app.payload, or JSON text. Numeric
+    readings are stored in the REAL `value` column and leave `data` empty.
+    Latency is raw receive minus send time here, and NULL for payloads
+    without a usable send time; payloads that name their
+    `client_id` are corrected for that publisher's clock offset by the
+    ClockCorrector writer hook. A publisher's `seq` numbers (per `client_id`,
+    else per `device`) are checked for duplicates and gaps by the
+    DeliveryTracker writer hook.
+    """
+    received_timestamp = format_timestamp_ns(received_ns)
+    sent_ns = sent_timestamp = value = client_id = device = seq = None
+    try:
+        started = time.perf_counter()
+        payload_data = decode_payload(payload, topic_codec(topic))
+        STAGE_SECONDS.observe(time.perf_counter() - started, ("decode",))
+        if "sent_ns" in payload_data:
+            sent_ns = payload_data["sent_ns"]
+            if not valid_sent_ns(sent_ns, received_ns):
+                logger.warning("Unusable 'sent_ns' in payload: %r", sent_ns)
+                sent_ns = None
+        elif "sent_timestamp" in payload_data:
             sent_timestamp = payload_data["sent_timestamp"]
+            sent_ns = parse_timestamp_ns(sent_timestamp)
+            if sent_ns is not None and not valid_sent_ns(sent_ns, received_ns):
+                sent_ns = None  # Logged as an incorrect timestamp below
         else:
-            sent_timestamp = received_timestamp
-            print(f"[WARNING] 'sent_timestamp' missing from payload: {payload_data}")
-        data = payload_data.get("data", str(payload))  # Extract actual message content
-    except json.JSONDecodeError:
-        sent_timestamp = received_timestamp  # Fallback in case of malformed JSON
-        data = str(payload)
-
-    # Convert timestamps for latency calculation
-    try:
-        sent_dt = datetime.strptime(sent_timestamp, "%Y-%m-%d %H:%M:%S.%f")
-        received_dt = datetime.strptime(received_timestamp, "%Y-%m-%d %H:%M:%S.%f")
-        latency = (received_dt - sent_dt).total_seconds() + 0.01
-    except ValueError:
-        print(f"[ERROR] Timestamp format incorrect: Sent='{sent_timestamp}', Received='{received_timestamp}'")
-        latency = None
+            logger.warning("'sent_timestamp' missing from payload: %s", payload_data)
+        if isinstance(payload_data.get("client_id"), str):
+            client_id = payload_data["client_id"]
+        if isinstance(payload_data.get("device"), int) and not isinstance(payload_data["device"], bool):
+            device = payload_data["device"]
+        if isinstance(payload_data.get("seq"), int) and not isinstance(payload_data["seq"], bool):
+            seq = payload_data["seq"]
+        data = payload_data["data"] if "data" in payload_data else payload_text(payload)  # Extract actual message content
+        if isinstance(data, (int, float)) and not isinstance(data, bool):
+            value, data = float(data), ""
+        elif isinstance(data, bytes):
+            data = bytes_text(data)
+        elif not isinstance(data, str):
+            # SQLite can't bind nested structures; None is stored as "null"
+            data = json.dumps(data, default=lambda item: bytes_text(item) if isinstance(item, bytes) else str(item))
+    except PayloadError:
+        data = payload_text(payload)  # Malformed or non-object payload: stored as text with no send time
+
+    if sent_ns is not None:
+        # Latency straight from the integer clocks; epoch seconds are kept for queries
+        latency = (received_ns - sent_ns) / NS_PER_SECOND
+        sent_time = sent_ns / NS_PER_SECOND
+        if sent_timestamp is None:
+            sent_timestamp = format_timestamp_ns(sent_ns)
+    else:
+        # NULL latency keeps the row out of latency_stats, the rollups and jitter
+        if sent_timestamp is not None:
+            logger.error("Timestamp format incorrect: Sent='%s', Received='%s'", sent_timestamp, received_timestamp)
+        latency = sent_time = None
+        sent_timestamp = sent_timestamp or ""  # Column is NOT NULL
 
     # Store precise received time in seconds (monotonic)
-    cursor.execute("""
-        INSERT INTO mqtt_data (topic, data, qos_level, packet_size, sent_timestamp, received_timestamp, latency, precise_received_time)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """, (topic, data, qos, packet_size, sent_timestamp, received_timestamp, latency, precise_received_time))
+    return {
+        "topic": topic,
+        "data": data,
+        "value": value,
+        "qos_level": qos,
+        "packet_size": packet_size,
+        "sent_timestamp": sent_timestamp,
+        "received_timestamp": received_timestamp,
+        "sent_time": sent_time,
+        "received_time": received_ns / NS_PER_SECOND,
+        "sent_ns": sent_ns,
+        "received_ns": received_ns,
+        "latency": latency,
+        "jitter": None,  # Filled in by the StatsEngine writer hook
+        "previous_latency": None,
+        "precise_received_time": precise_received_time,
+        "client_id": client_id,
+        "clock_offset": None,  # Set with latency_error by the ClockCorrector writer hook
+        "latency_error": None,
+        "device": device,  # Not stored; tells publishers without a client_id apart for DeliveryTracker
+        "seq": seq,  # Not stored; DeliveryTracker drops the row if it is a redelivery
+    }
 
-    conn.commit()
-    conn.close()
+def parse_message(topic, payload, qos, received_ns, precise_received_time):
+    """Build a row from a raw message captured by MQTTClient.on_message."""
+    return build_row(topic, payload, qos, received_ns, len(payload), precise_received_time)
+
+def store_row(row):
+    """Queue a parsed row for the batched writer."""
+    get_writer().submit(row)
+    if logger.isEnabledFor(logging.DEBUG):  # Per message: skip building the record unless it is wanted
+        logger.debug("Queued MQTT message", extra={"topic": row["topic"], "qos": row["qos_level"], "latency": row["latency"]})
 
-    print(f"[INFO] Stored MQTT message: Topic={topic}, QoS={qos}, Latency={latency}")
+def save_data(topic, payload, qos, received_timestamp, packet_size, precise_received_time):
+    """Parse an MQTT message and queue it for the batched writer."""
+    received_ns = parse_timestamp_ns(received_timestamp)
+    if received_ns is None:
+        logger.error("Timestamp format incorrect: Received='%s'", received_timestamp)
+        return
+    store_row(build_row(topic, payload, qos, received_ns, packet_size, precise_received_time))
 
     
 
+@cached((TOPICS,))
 def get_topics():
     """Fetch all unique topics from the database."""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    
-    # Debugging: Print all unique topics
-    cursor.execute("SELECT DISTINCT topic FROM mqtt_data")
-    topics = [row[0] for row in cursor.fetchall()]
-    
-    print(f"[DEBUG] Retrieved Topics: {topics}")  # Debugging output
-    
-    conn.close()
+    with read_source() as conn:
+        topics = [row[0] for row in conn.execute("SELECT topic FROM topics ORDER BY topic")]
+
+    logger.debug("Retrieved Topics: %s", topics)
     return topics
 
+@cached((ALL,))
+def get_topic_summaries():
+    """(topic, message_count, last_seen) for every topic, read from the topics table."""
+    with read_source() as conn:
+        return conn.execute("SELECT topic, message_count, last_seen FROM topics ORDER BY topic").fetchall()
+
+@cached(lambda topic: (topic_mark(topic),))
 def get_data_for_topic(topic):
     """Fetch all data for a specific topic."""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT data, received_timestamp FROM mqtt_data WHERE topic = ? ORDER BY received_timestamp ASC", (topic,))
-    data = cursor.fetchall()
-    conn.close()
-    return data
+    return query_partitions(
+        "SELECT COALESCE(value, data), received_timestamp FROM mqtt_data WHERE topic = ? ORDER BY received_time ASC", (topic,)
+    )
+
+def get_topic_page(topic, after=None, before=None, start=None, end=None, limit=TOPIC_PAGE_SIZE):
+    """Keyset-paginated rows of one topic, ordered by (received_time, id).
+
+    `after` and `before` are (received_time, id) cursors taken from rows of a
+    previous page. With `after` the next `limit` rows are returned; otherwise
+    the `limit` rows just before `before` (the newest rows if it is None).
+    `start`/`end` bound received_time in epoch seconds. Rows always come back
+    oldest first as (id, received_time, received_timestamp, data).
+    """
+    conditions, params = ["topic = ?"], [topic]
+    first, last = start, end  # Range of partitions the query can still reach
+    if start is not None:
+        conditions.append("received_time >= ?")
+        params.append(start)
+    if end is not None:
+        conditions.append("received_time < ?")
+        params.append(end)
+
+    if after is not None:
+        conditions.append("(received_time, id) > (?, ?)")
+        params.extend(after)
+        first = after[0] if first is None else max(first, after[0])
+        order = "ASC"
+    else:
+        if before is not None:
+            conditions.append("(received_time, id) < (?, ?)")
+            params.extend(before)
+            last = before[0] if last is None else min(last, before[0])
+        order = "DESC"
+
+    # Served straight from the (topic, received_time) index, which carries the rowid
+    rows = query_partitions(f"""
+        SELECT id, received_time, received_timestamp, COALESCE(value, data) FROM mqtt_data
+        WHERE {' AND '.join(conditions)}
+        ORDER BY received_time {order}, id {order}
+        LIMIT ?
+    """, params, start=first, end=last, newest_first=order == "DESC", limit=limit)
+
+    if order == "DESC":
+        rows.reverse()
+    return rows
 
+@cached((ALL,))
 def get_latency_dataframe():
-    """Returns a DataFrame with qos_level and latency for advanced visualizations."""
-    import pandas as pd
-    conn = sqlite3.connect(DATABASE_PATH)
-    query = """
-        SELECT qos_level, latency
-        FROM mqtt_data
-        WHERE latency IS NOT NULL AND latency > 0
+    """Returns a DataFrame with qos_level and latency for advanced visualizations.
+
+    Archived history is loaded column-wise from the archive; only recent rows come from SQLite.
     """
-    df = pd.read_sql_query(query, conn)
-    conn.close()
-    return df
+    import pandas as pd
+    from app.archive import load_columns
+    columns = load_columns(("qos_level", "latency"))
+    keep = columns["latency"] > 0  # Also drops NaN (NULL) latencies
+    return pd.DataFrame({"qos_level": columns["qos_level"][keep], "latency": columns["latency"][keep]})
 
 
-def get_qos_latency_data():
-    """Fetch QoS levels, latencies, packet sizes, and jitter values from the database."""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+@cached(lambda qos, start, end: range_marks(start, end, qos=qos))
+def get_qos_latency_data(qos=None, start=None, end=None):
+    """Fetch QoS levels, latencies, packet sizes, and jitter values from the database.
 
-    cursor.execute("""
-        SELECT qos_level, latency, packet_size, jitter FROM mqtt_data ORDER BY received_timestamp ASC
-    """)
-    
-    data = cursor.fetchall()
-    conn.close()
+    Optionally restricted to one QoS level and/or a received-time range (epoch seconds),
+    which lets SQLite use the (qos_level, received_time) index.
+    """
+    conditions, params = [], []
+    if qos is not None:
+        conditions.append("qos_level = ?")
+        params.append(qos)
+    if start is not None:
+        conditions.append("received_time >= ?")
+        params.append(start)
+    if end is not None:
+        conditions.append("received_time < ?")
+        params.append(end)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    # Row ids follow arrival order, so without a QoS filter ordering by id avoids a full sort
+    order = "received_time ASC, id ASC" if qos is not None else "id ASC"
+    data = query_partitions(f"""
+        SELECT qos_level, latency, packet_size, jitter FROM mqtt_data {where} ORDER BY {order}
+    """, params, start=start, end=end)
 
     if not data:
-        print("[DEBUG] No QoS-related data found in database!")
+        logger.debug("No QoS-related data found in database!")
         return []
 
     return data
 
-def get_qos_comparison():
-    """Retrieve the count of received packets per QoS level."""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+@cached(lambda topic: (topic_mark(topic),) if topic is not None else (ALL,))
+def get_delivery_stats(topic=None):
+    """Delivery counters per topic and QoS level from delivery_stats (no mqtt_data scan).
 
-    cursor.execute("""
-        SELECT qos_level, COUNT(*) FROM mqtt_data
-        GROUP BY qos_level
-        ORDER BY qos_level ASC
-    """)
+    Rates are over messages with sequence numbers: loss is the share of
+    expected numbers missing, duplicates the share of deliveries that were
+    redeliveries and reordering the share of stored messages that came late.
+    """
+    query = "SELECT topic, qos_level, received, sequenced, duplicates, reordered, lost FROM delivery_stats"
+    with read_source() as conn:
+        if topic is not None:
+            rows = conn.execute(query + " WHERE topic = ? ORDER BY qos_level", (topic,)).fetchall()
+        else:
+            rows = conn.execute(query + " ORDER BY topic, qos_level").fetchall()
+    return [delivery_to_dict(*row) for row in rows]
 
-    qos_comparison = cursor.fetchall()
-    conn.close()
+def delivery_to_dict(topic, qos, received, sequenced, duplicates, reordered, lost):
+    expected = sequenced + lost
+    return {
+        "topic": topic,
+        "qos_level": qos,
+        "received": received,
+        "sequenced": sequenced,
+        "duplicates": duplicates,
+        "reordered": reordered,
+        "lost": lost,
+        "loss_rate": lost / expected if expected else None,
+        "duplicate_rate": duplicates / (sequenced + duplicates) if sequenced + duplicates else None,
+        "reorder_rate": reordered / sequenced if sequenced else None,
+    }
+
+@cached((ALL,))
+def get_qos_comparison():
+    """Delivery counters and loss, duplicate and reorder rates per QoS level, summed over topics."""
+    totals = {}
+    for stats in get_delivery_stats():
+        counts = totals.setdefault(stats["qos_level"], [0] * 5)
+        for index, name in enumerate(("received", "sequenced", "duplicates", "reordered", "lost")):
+            counts[index] += stats[name]
+    qos_comparison = [delivery_to_dict(None, qos, *counts) for qos, counts in sorted(totals.items())]
 
     if not qos_comparison:
-        print("[DEBUG] No QoS comparison data found!")
+        logger.debug("No QoS comparison data found!")
         return []
 
-    print(f"[DEBUG] QoS Comparison Data: {qos_comparison}")  # Debugging output
+    logger.debug("QoS Comparison Data: %s", qos_comparison)
     return qos_comparison
 
 
 
-# Ensure the database is initialized on startup
-init_db()
+# The last rollup bucket read may reach past `end` by up to the coarsest resolution
+@cached(lambda qos, topic, start, end, target_points: range_marks(
+    start, end + max(ROLLUP_RESOLUTIONS) if end is not None else None, topic, qos))
+def get_latency_series(qos=None, topic=None, start=None, end=None, target_points=GRAPH_TARGET_POINTS):
+    """Latency and jitter over time per QoS level, downsampled to about target_points per series.
+
+    Reads the finest rollup resolution that fits the range in target_points
+    buckets. When the range holds few enough raw rows it reads them instead
+    (LTTB-downsampled if needed), so short ranges keep full detail. Returns
+    {qos: {"resolution", "time", "latency", "min", "max", "jitter"}} with
+    resolution 0 for raw rows (as numpy arrays, NULL jitter as NaN) and times
+    in epoch seconds.
+    """
+    finest, coarsest = min(ROLLUP_RESOLUTIONS), max(ROLLUP_RESOLUTIONS)
+
+    filters, filter_params = "", []
+    if qos is not None:
+        filters += " AND qos_level = ?"
+        filter_params.append(qos)
+    if topic is not None:
+        filters += " AND topic = ?"
+        filter_params.append(topic)
+
+    with read_source() as conn:
+        if start is None or end is None:
+            first, last = conn.execute(
+                "SELECT MIN(bucket_start), MAX(bucket_start) FROM latency_rollup WHERE resolution = ?", (finest,)
+            ).fetchone()
+            if first is None:
+                return {}
+            start = first if start is None else start
+            end = last + finest if end is None else end
+
+        # The coarsest rollup is small and tells us how many raw rows the range holds
+        raw_count = conn.execute(f"""
+            SELECT COALESCE(SUM(count), 0) FROM latency_rollup
+            WHERE resolution = ? AND bucket_start >= ? AND bucket_start < ?{filters}
+        """, [coarsest, start // coarsest * coarsest, end] + filter_params).fetchone()[0]
+
+    resolution = choose_resolution(max(end - start, 1), target_points)
+    # Finer rollups may already be expired for the start of the range
+    while resolution < coarsest and (rollup_cutoff(resolution) or 0) > start:
+        resolution = min(r for r in ROLLUP_RESOLUTIONS if r > resolution)
+    few_buckets = (end - start) / resolution < target_points / 4
+    series = {}
+
+    if raw_count <= target_points or (few_buckets and raw_count <= LTTB_MAX_ROWS):
+        import numpy as np
+        from app.analytics import query_columns, lttb
+        # One query per QoS level so each uses the (qos_level, received_time) index
+        levels = [qos] if qos is not None else [0, 1, 2]
+        topic_filter = " AND topic = ?" if topic is not None else ""
+        for level in levels:
+            columns = query_columns(f"""
+                SELECT received_time, latency, jitter FROM mqtt_data
+                WHERE qos_level = ? AND received_time >= ? AND received_time < ? AND latency IS NOT NULL{topic_filter}
+                ORDER BY received_time ASC
+            """, [level, start, end] + ([topic] if topic is not None else []),
+                {"time": np.float64, "latency": np.float64, "jitter": np.float64}, start=start, end=end)
+            if not len(columns["time"]):
+                continue
+            keep = lttb(columns["time"], columns["latency"], target_points)
+            picked = columns["latency"][keep]
+            series[level] = {
+                "resolution": 0,
+                "time": columns["time"][keep],
+                "latency": picked,
+                "min": picked,
+                "max": picked,
+                "jitter": columns["jitter"][keep],
+            }
+    else:
+        with read_source() as conn:
+            buckets = conn.execute(f"""
+                SELECT qos_level, bucket_start, SUM(count), MIN(min_latency), MAX(max_latency),
+                       SUM(sum_latency), SUM(jitter_sum), SUM(jitter_count)
+                FROM latency_rollup
+                WHERE resolution = ? AND bucket_start >= ? AND bucket_start < ?{filters}
+                GROUP BY qos_level, bucket_start
+                ORDER BY bucket_start ASC
+            """, [resolution, start // resolution * resolution, end] + filter_params).fetchall()
+        for level, bucket_start, count, min_latency, max_latency, sum_latency, jitter_sum, jitter_count in buckets:
+            entry = series.setdefault(level, {"resolution": resolution, "time": [], "latency": [], "min": [], "max": [], "jitter": []})
+            entry["time"].append(bucket_start + resolution / 2)
+            entry["latency"].append(sum_latency / count)
+            entry["min"].append(min_latency)
+            entry["max"].append(max_latency)
+            entry["jitter"].append(jitter_sum / jitter_count if jitter_count else None)
+
+    return series
+
+@cached((ALL,))
+def get_packet_latency_sample(limit=GRAPH_TARGET_POINTS):
+    """Evenly spaced sample of rows as {"qos_level", "latency", "packet_size"} numpy arrays, read by rowid lookups.
+
+    Each partition gets a share of `limit` proportional to its id range.
+    """
+    import numpy as np
+    from app.analytics import to_columns
+    dtypes = {"qos_level": np.int8, "latency": np.float64, "packet_size": np.int32}
+    with ExitStack() as stack:
+        connections = []
+        for path in sources():
+            try:
+                connections.append(stack.enter_context(read_source(path)))
+            except sqlite3.OperationalError:
+                continue  # Dropped by compaction since it was listed
+
+        ranges = []
+        for conn in connections:
+            first, last = conn.execute("SELECT MIN(id), MAX(id) FROM mqtt_data").fetchone()
+            if first is not None:
+                ranges.append((conn, first, last))
+        span = sum(last - first + 1 for _, first, last in ranges)
+        step = max(1, span // limit) if span else 1
+
+        parts = [to_columns((), dtypes)]
+        for conn, first, last in ranges:
+            parts.append(to_columns(conn.execute("""
+                WITH RECURSIVE ids(i) AS (
+                    SELECT ? UNION ALL SELECT i + ? FROM ids WHERE i + ? <= ?
+                )
+                SELECT qos_level, latency, packet_size FROM ids JOIN mqtt_data ON mqtt_data.id = ids.i
+                WHERE latency IS NOT NULL
+            """, (first, step, step, last)), dtypes))
+    return {name: np.concatenate([part[name] for part in parts]) for name in dtypes}
+
+def get_max_row_id():
+    """Id of the newest stored row, or 0 if there is none."""
+    for (max_id,) in query_partitions("SELECT MAX(id) FROM mqtt_data", newest_first=True):
+        if max_id is not None:
+            return max_id
+    return 0
+
+def get_live_rows(after_id, limit=LIVE_GRAPH_FETCH_LIMIT):
+    """Rows with an id above `after_id`, oldest first, as {"id", "qos_level", "received_time", "latency", "jitter"} arrays.
+
+    Ids grow with arrival across partitions, so the query starts at the
+    partition `after_id` is in and walks the primary key from there.
+    """
+    import numpy as np
+    from app.analytics import query_columns
+    dtypes = {"id": np.int64, "qos_level": np.int8, "received_time": np.float64, "latency": np.float64, "jitter": np.float64}
+    return query_columns("""
+        SELECT id, qos_level, received_time, latency, jitter FROM mqtt_data
+        WHERE id > ? AND latency IS NOT NULL ORDER BY id LIMIT ?
+    """, [after_id], dtypes, start=after_id // ID_STRIDE * DAY, limit=limit)
+
+@cached(lambda topic: (topic_mark(topic),) if topic is not None else (ALL,))
+def get_latency_stats(topic=None):
+    """Latency statistics per QoS level from the latency_stats summary table (no mqtt_data scan).
+
+    With a topic, returns that topic's rows; otherwise the per-topic summaries are
+    merged for each QoS level and jitter is averaged weighted by message count.
+    """
+    query = """
+        SELECT topic, qos_level, count, mean, m2, min_latency, max_latency, sketch, jitter
+        FROM latency_stats
+    """
+    with read_source() as conn:
+        if topic is not None:
+            rows = conn.execute(query + " WHERE topic = ? ORDER BY qos_level", (topic,)).fetchall()
+        else:
+            rows = conn.execute(query + " ORDER BY qos_level").fetchall()
+
+    merged = {}
+    for row_topic, qos, count, mean, m2, min_latency, max_latency, sketch, jitter in rows:
+        summary = LatencySummary()
+        summary.count, summary.mean, summary.m2, summary.min, summary.max = count, mean, m2, min_latency, max_latency
+        summary.sketch = DDSketch.from_json(sketch)
+        key = (row_topic if topic is not None else None, qos)
+        if key not in merged:
+            merged[key] = [LatencySummary(), 0.0]
+        merged[key][0].merge(summary)
+        merged[key][1] += (jitter or 0.0) * count
+
+    return [
+        summary_to_dict(key[0], key[1], summary, weighted_jitter / summary.count if summary.count else None)
+        for key, (summary, weighted_jitter) in sorted(merged.items(), key=lambda item: item[0][1])
+    ]
@@ -0,0 +1,218 @@
+import sqlite3
+import time
+from collections import OrderedDict
+from app.config import DATABASE_PATH, DELIVERY_WINDOW, DELIVERY_MAX_PUBLISHERS
+from app.metrics import registry
+from app.migrations import chunked_backfill
+from app.writer import WriterHook
+
+DELIVERY_EVENTS = registry.counter(
+    "iot_delivery_events_total",
+    "Sequence events at ingest per QoS: duplicate (dropped, including numbers too far behind the window to tell), "
+    "skipped (numbers missing when a higher one arrived), reordered (arrived after a higher one) and restart (publisher began a new sequence)",
+    ("kind", "qos"),
+)
+
+# Columns of delivery_stats a batch adds to, in the order of the per-key delta lists
+COUNTERS = ("received", "sequenced", "duplicates", "reordered", "lost")
+
+
+def publisher_key(row):
+    """Whose sequence a row belongs to: its client_id, else its device number (struct layouts), else its topic."""
+    if row.get("client_id") is not None:
+        return row["client_id"]
+    if row.get("device") is not None:
+        return f"device:{row['device']}"
+    return row["topic"]
+
+
+class SequenceWindow:
+    """The highest sequence number seen from a publisher and which of the `size` numbers up to it arrived.
+
+    Bit i of `bits` is set once `highest - i` arrived. Numbers skipped when a
+    higher one arrives are counted lost until they turn up late; those below
+    `first`, the number the window started at, were never counted.
+    """
+
+    __slots__ = ("first", "highest", "highest_sent_ns", "bits")
+
+    def __init__(self, first, highest, highest_sent_ns, bits=1):
+        self.first = first
+        self.highest = highest
+        self.highest_sent_ns = highest_sent_ns
+        self.bits = bits
+
+    @classmethod
+    def start(cls, seq, sent_ns):
+        return cls(seq, seq, sent_ns)
+
+    def copy(self):
+        return SequenceWindow(self.first, self.highest, self.highest_sent_ns, self.bits)
+
+    def accept(self, seq, sent_ns, size):
+        """Record `seq`; returns (kind, change in lost) with kind "next", "late", "duplicate" or "restart".
+
+        A number behind `highest` that was sent after it means the publisher
+        started counting again; the window restarts from it. Without that
+        evidence a number behind the window is taken for a late redelivery
+        and reported as a duplicate, since whether it arrived is no longer known.
+        """
+        if seq > self.highest:
+            shift = seq - self.highest
+            self.bits = ((self.bits << shift) | 1) & ((1 << size) - 1) if shift < size else 1
+            self.highest, self.highest_sent_ns = seq, sent_ns
+            return "next", shift - 1
+        behind = self.highest - seq
+        if sent_ns is not None and self.highest_sent_ns is not None and sent_ns > self.highest_sent_ns:
+            self.first, self.highest, self.highest_sent_ns, self.bits = seq, seq, sent_ns, 1
+            return "restart", 0
+        if behind >= size or self.bits >> behind & 1:
+            return "duplicate", 0
+        self.bits |= 1 << behind
+        return "late", -1 if seq >= self.first else 0
+
+    def to_row(self, size):
+        return self.first, self.highest, self.highest_sent_ns, self.bits.to_bytes((size + 7) // 8, "little")
+
+    @classmethod
+    def from_row(cls, row, size):
+        first, highest, highest_sent_ns, window = row
+        return cls(first, highest, highest_sent_ns, int.from_bytes(window, "little") & ((1 << size) - 1))
+
+
+class DeliveryTracker(WriterHook):
+    """Writer hook that drops redelivered messages and keeps delivery_stats current from sequence numbers.
+
+    Publishers stamp a per-client monotonic `seq`; each publisher's recent
+    numbers are kept in a SequenceWindow, so duplicates within the window
+    are not inserted and gaps, late arrivals and duplicates are counted per
+    (topic, QoS) as the rows arrive, without reading mqtt_data. Rows without
+    a `seq` are only counted as received. Windows are stored in
+    delivery_windows and read back for publishers not in memory; with
+    `shared` (other processes may see the same publishers) they are read
+    back in every batch.
+
+    Runs first, so redeliveries never reach the latency statistics.
+    """
+
+    def __init__(self, size=DELIVERY_WINDOW, max_publishers=DELIVERY_MAX_PUBLISHERS, shared=False):
+        self.size = size
+        self.max_publishers = max_publishers
+        self.shared = shared
+        self.windows = OrderedDict()  # publisher -> SequenceWindow, least recently used first
+        self._undo = {}
+        self._events = {}
+
+    def _window(self, conn, publisher):
+        window = self.windows.get(publisher)
+        if window is None:
+            row = conn.execute(
+                "SELECT first, highest, highest_sent_ns, window FROM delivery_windows WHERE publisher = ?", (publisher,)
+            ).fetchone()
+            if row is None:
+                return None
+            window = self.windows[publisher] = SequenceWindow.from_row(row, self.size)
+        self.windows.move_to_end(publisher)
+        return window
+
+    def before_insert(self, conn, rows):
+        self._undo = {}
+        self._events = {}
+        if self.shared:
+            self.windows.clear()
+        deltas = {}  # (topic, qos) -> counts in COUNTERS order
+        kept = []
+        for row in rows:
+            qos = row["qos_level"]
+            key = (row["topic"], qos)
+            delta = deltas.get(key)
+            if delta is None:
+                delta = deltas[key] = [0] * len(COUNTERS)
+            seq = row.get("seq")
+            if seq is None:
+                delta[0] += 1
+                kept.append(row)
+                continue
+
+            publisher = publisher_key(row)
+            window = self._window(conn, publisher)
+            if publisher not in self._undo:
+                self._undo[publisher] = window.copy() if window is not None else None
+            if window is None:
+                # Joined mid-stream: numbers before the first one seen are not counted as lost
+                self.windows[publisher] = SequenceWindow.start(seq, row["sent_ns"])
+                kind, lost = "next", 0
+            else:
+                kind, lost = window.accept(seq, row["sent_ns"], self.size)
+
+            if kind == "duplicate":
+                delta[2] += 1
+            else:
+                delta[0] += 1
+                delta[1] += 1
+                kept.append(row)
+                delta[4] += lost
+                if kind == "late":
+                    delta[3] += 1
+            if kind == "next" and lost:
+                self._events[("skipped", str(qos))] = self._events.get(("skipped", str(qos)), 0) + lost
+            elif kind != "next":
+                event = ("reordered" if kind == "late" else kind, str(qos))
+                self._events[event] = self._events.get(event, 0) + 1
+
+        now = time.time()
+        conn.executemany("""
+            INSERT INTO delivery_stats (topic, qos_level, received, sequenced, duplicates, reordered, lost, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(topic, qos_level) DO UPDATE SET
+                received = received + excluded.received, sequenced = sequenced + excluded.sequenced,
+                duplicates = duplicates + excluded.duplicates, reordered = reordered + excluded.reordered,
+                lost = lost + excluded.lost, updated_at = excluded.updated_at
+        """, [(*key, *delta, now) for key, delta in deltas.items()])
+        conn.executemany("""
+            INSERT INTO delivery_windows (publisher, first, highest, highest_sent_ns, window, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(publisher) DO UPDATE SET
+                first = excluded.first, highest = excluded.highest, highest_sent_ns = excluded.highest_sent_ns,
+                window = excluded.window, updated_at = excluded.updated_at
+        """, [(publisher, *self.windows[publisher].to_row(self.size), now) for publisher in self._undo])
+
+        while len(self.windows) > self.max_publishers:
+            self.windows.popitem(last=False)
+        return kept
+
+    def rollback(self):
+        for publisher, window in self._undo.items():
+            if window is None:
+                self.windows.pop(publisher, None)
+            else:
+                self.windows[publisher] = window
+        self._undo = {}
+        self._events = {}
+
+    def after_commit(self, rows):
+        for labels, count in self._events.items():
+            DELIVERY_EVENTS.inc(labels, count)
+        self._events = {}
+
+
+def backfill_delivery_stats(database_path=DATABASE_PATH):
+    """Count the rows stored before schema version 8 that latency_stats had not counted yet into delivery_stats."""
+    conn = sqlite3.connect(database_path, timeout=30)
+    try:
+        def process_chunk(conn, rows):
+            counts = {}
+            for _, topic, qos in rows:
+                counts[(topic, qos)] = counts.get((topic, qos), 0) + 1
+            now = time.time()
+            conn.executemany("""
+                INSERT INTO delivery_stats (topic, qos_level, received, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(topic, qos_level) DO UPDATE SET received = received + excluded.received
+            """, [(*key, count, now) for key, count in counts.items()])
+
+        chunked_backfill(conn, "delivery_stats", """
+            SELECT id, topic, qos_level FROM mqtt_data
+            WHERE id > ? AND id <= ? ORDER BY id LIMIT ?
+        """, process_chunk)
+    finally:
+        conn.close()
@@ -0,0 +1,84 @@
+import ttkbootstrap as ttk
+from ttkbootstrap.constants import *
+from app.metrics import registry
+from app.profiling import profiler
+from app.config import DIAGNOSTICS_REFRESH_MS, PROFILE_DEFAULT_SECONDS
+
+
+def _format(value):
+    if isinstance(value, dict):  # Histogram series
+        if not value["count"]:
+            return "no samples"
+        return f"n={value['count']} mean={value['mean'] * 1e3:.3f}ms p50<={value['p50'] * 1e3:g}ms p99<={value['p99'] * 1e3:g}ms"
+    return f"{value:.6g}" if isinstance(value, float) else str(value)
+
+
+class DiagnosticsPage(ttk.Frame):
+    """Live view of this process's metrics registry, with buttons for CPU and allocation profiles."""
+
+    def __init__(self, parent, controller):
+        super().__init__(parent)
+        self.controller = controller
+        self.shown_report = None  # (kind, started) of the report in the text box
+
+        ttk.Label(self, text="Diagnostics", font=("Arial", 16)).pack(pady=10)
+        if getattr(controller.feed, "url", None):
+            # Attached to an ingest daemon: the pipeline runs there, this process only reads
+            ttk.Label(self, text=f"Ingest metrics are served by the daemon at {controller.feed.url}/metrics").pack()
+
+        self.tree = ttk.Treeview(self, columns=("value",), show="tree headings", height=12)
+        self.tree.heading("#0", text="Metric")
+        self.tree.heading("value", text="Value")
+        self.tree.column("value", width=380)
+        self.tree.pack(pady=5, fill="both", expand=True)
+
+        buttons = ttk.Frame(self)
+        buttons.pack(pady=5)
+        self.cpu_button = ttk.Button(buttons, text="Profile CPU", bootstyle="info", command=lambda: self.start_profile("cpu"))
+        self.cpu_button.pack(side="left", padx=5)
+        self.memory_button = ttk.Button(buttons, text="Trace allocations", bootstyle="warning",
+                                        command=lambda: self.start_profile("memory"))
+        self.memory_button.pack(side="left", padx=5)
+        self.status = ttk.Label(buttons, text="")
+        self.status.pack(side="left", padx=10)
+
+        self.report = ttk.Text(self, height=12, wrap="none", font=("Courier", 9))
+        self.report.pack(pady=5, fill="both", expand=True)
+
+        self.refresh()
+
+    def refresh(self):
+        """Re-read the registry into the tree, keeping expanded metrics open, and pick up finished reports."""
+        for name, series in registry.snapshot().items():
+            if not self.tree.exists(name):
+                self.tree.insert("", "end", iid=name, text=name)
+            if len(series) == 1 and () in series:
+                self.tree.item(name, values=(_format(series[()]),))
+                continue
+            self.tree.item(name, values=(f"{len(series)} series",))
+            for labels, value in series.items():
+                iid = f"{name}|{','.join(labels)}"
+                if self.tree.exists(iid):
+                    self.tree.item(iid, values=(_format(value),))
+                else:
+                    self.tree.insert(name, "end", iid=iid, text=",".join(labels), values=(_format(value),))
+
+        status = profiler.status()
+        running = status["running"]
+        state = "disabled" if running else "normal"
+        self.cpu_button.configure(state=state)
+        self.memory_button.configure(state=state)
+        self.status.configure(text=f"{running} profile running..." if running else "")
+        latest = max(status["reports"].values(), key=lambda report: report["started"], default=None)
+        if latest is not None and (latest["kind"], latest["started"]) != self.shown_report:
+            self.shown_report = (latest["kind"], latest["started"])
+            self.report.delete("1.0", "end")
+            self.report.insert("end", latest["text"])
+
+        self.after(DIAGNOSTICS_REFRESH_MS, self.refresh)
+
+    def start_profile(self, kind):
+        try:
+            profiler.start(kind, PROFILE_DEFAULT_SECONDS)
+        except ValueError as e:
+            self.status.configure(text=str(e))
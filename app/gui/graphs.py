@@ -1,13 +1,22 @@
+import logging
 import ttkbootstrap as ttk
 from ttkbootstrap.constants import *
-import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
+from matplotlib.figure import Figure
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from collections import defaultdict
+from datetime import datetime
 import numpy as np
-import seaborn as sns
-import pandas as pd
-from app.database import get_qos_latency_data, get_qos_comparison, get_latency_dataframe
+from app.analytics import group_by, histogram, box_stats, rolling_mean, load_latencies
+from app.config import JITTER_SMOOTHING_WINDOW
+from app.database import (
+    get_qos_comparison,
+    get_latency_stats,
+    get_latency_series,
+    get_packet_latency_sample,
+)
+from app.gui.live_graph import LiveLatencyGraph
+
+logger = logging.getLogger(__name__)
 
 
 class GraphsPage(ttk.Frame):
@@ -17,49 +26,79 @@ class GraphsPage(ttk.Frame):
 
         ttk.Label(self, text="QoS Performance Graphs", font=("Arial", 16)).pack(pady=10)
 
+        ttk.Button(self, text="Live Latency", bootstyle="warning", command=self.show_live_graph).pack(pady=5)
         ttk.Button(self, text="Latency Over Time", bootstyle="primary", command=self.show_latency_graph).pack(pady=5)
         ttk.Button(self, text="Packet Size vs Latency", bootstyle="primary", command=self.show_packet_latency_graph).pack(pady=5)
         ttk.Button(self, text="Jitter Over Time", bootstyle="primary", command=self.show_jitter_graph).pack(pady=5)
         ttk.Button(self, text="QoS Comparison", bootstyle="success", command=self.show_qos_comparison_graph).pack(pady=5)
         ttk.Button(self, text="Latency Histogram", bootstyle="info", command=self.show_latency_histogram).pack(pady=5)
         ttk.Button(self, text="Latency Boxplot", bootstyle="info", command=self.show_latency_boxplot).pack(pady=5)
+        ttk.Button(self, text="Latency Statistics", bootstyle="info", command=self.show_latency_stats).pack(pady=5)
         ttk.Button(self, text="Back to Home", bootstyle="secondary", command=lambda: controller.show_frame("HomePage")).pack(pady=10)
 
         self.graph_frame = ttk.Frame(self)
         self.graph_frame.pack(fill="both", expand=True, padx=10, pady=10)
 
+        # One widget per graph type, created on first use and reused (only one is packed at a time);
+        # rebuilding canvases on every click leaked memory over long sessions
+        self.views = {}
+        self.canvases = {}
+        self.live_graph = None
+        self.message = ttk.Label(self.graph_frame, text="", font=("Arial", 14), foreground="red")
+
+    def show_view(self, widget):
+        """Show `widget` in graph_frame in place of the current graph; the live graph stops unless it is shown."""
+        if self.live_graph is not None and widget is not self.live_graph.widget:
+            self.live_graph.stop()
+        for child in self.graph_frame.pack_slaves():
+            if child is not widget:
+                child.pack_forget()
+        widget.pack(fill="both", expand=True)
+
+    def show_message(self, text):
+        self.message.config(text=text)
+        self.show_view(self.message)
+
+    def figure(self, name, figsize):
+        """The graph type's figure, emptied for redrawing; show it with draw(name)."""
+        if name not in self.canvases:
+            self.canvases[name] = FigureCanvasTkAgg(Figure(figsize=figsize), master=self.graph_frame)
+        fig = self.canvases[name].figure
+        fig.clear()
+        return fig
+
+    def draw(self, name):
+        canvas = self.canvases[name]
+        self.show_view(canvas.get_tk_widget())
+        canvas.draw_idle()
+
+    def show_live_graph(self):
+        """Latency and jitter of the newest messages, following new ones as they are stored."""
+        if self.live_graph is None:
+            self.live_graph = LiveLatencyGraph(self.graph_frame)
+        self.show_view(self.live_graph.widget)
+        self.live_graph.start()
+
     def show_packet_latency_graph(self):
         """Packet Size vs Latency comparison for each QoS level."""
-        data = get_qos_latency_data()
-        if not data:
-            print("[DEBUG] No data to display")
-            ttk.Label(self.graph_frame, text="No Data Available", font=("Arial", 14), foreground="red").pack()
+        sample = get_packet_latency_sample()
+        if not len(sample["latency"]):
+            logger.debug("No data to display")
+            self.show_message("No Data Available")
             return
 
-        qos_levels, latencies, packet_sizes, _ = zip(*data)
-
         # Organize data by QoS
-        qos_data = {0: [], 1: [], 2: []}
-        packet_data = {0: [], 1: [], 2: []}
-
-        for qos, latency, packet_size in zip(qos_levels, latencies, packet_sizes):
-            qos_data[qos].append(latency)
-            packet_data[qos].append(packet_size)
+        groups = group_by(sample["qos_level"], latency=sample["latency"], packet_size=sample["packet_size"])
 
-        # Clear previous graph
-        for widget in self.graph_frame.winfo_children():
-            widget.destroy()
-
-        # Create figure
-        fig, ax = plt.subplots(figsize=(7, 5))
+        fig = self.figure("packet_latency", figsize=(7, 5))
+        ax = fig.add_subplot()
 
         colors = {0: "blue", 1: "green", 2: "red"}
         labels = {0: "QoS 0", 1: "QoS 1", 2: "QoS 2"}
 
         # Plot latency vs packet size for each QoS
-        for qos in qos_data:
-            if qos_data[qos]:
-                ax.scatter(packet_data[qos], qos_data[qos], color=colors[qos], alpha=0.5, label=labels[qos])
+        for qos, group in groups.items():
+            ax.scatter(group["packet_size"], group["latency"], color=colors[qos], alpha=0.5, label=labels[qos])
 
         ax.set_xlabel("Packet Size (Bytes)")
         ax.set_ylabel("Avg Latency (Seconds)")
@@ -67,169 +106,140 @@ class GraphsPage(ttk.Frame):
         ax.legend()
         ax.grid(True)
 
-        # Embed graph into Tkinter
-        canvas = FigureCanvasTkAgg(fig, master=self.graph_frame)
-        canvas.draw()
-        canvas.get_tk_widget().pack(fill="both", expand=True)
+        self.draw("packet_latency")
 
-        plt.close(fig)
-        
     def show_latency_graph(self):
         """Latency over time comparison with better separation for QoS levels."""
-        data = get_qos_latency_data()
-        if not data:
-            print("[DEBUG] No latency data available.")
+        series = get_latency_series()
+        if not series:
+            logger.debug("No latency data available.")
+            self.show_message("No Data Available")
             return
 
-        qos_levels, latencies, _, _ = zip(*data)
-
-        # Organize data by QoS level
-        latency_data = {0: [], 1: [], 2: []}
-        time_index = {0: [], 1: [], 2: []}
-        message_count = {0: 0, 1: 0, 2: 0}
-
-        for i, (qos, latency) in enumerate(zip(qos_levels, latencies)):
-            if qos in latency_data and latency is not None:
-                latency_data[qos].append(latency)
-                time_index[qos].append(message_count[qos])  # X-axis is message index
-                message_count[qos] += 1
+        # Average latency per QoS comes from the streaming summary instead of re-averaging every row
+        avg_latency = {stats["qos_level"]: stats["mean"] for stats in get_latency_stats()}
 
-        # Calculate average latency per QoS
-        avg_latency = {qos: np.mean(latency_data[qos]) if latency_data[qos] else None for qos in latency_data}
-
-        # Clear previous graph
-        for widget in self.graph_frame.winfo_children():
-            widget.destroy()
-
-        # Create figure
-        fig, ax = plt.subplots(figsize=(8, 5))
+        fig = self.figure("latency", figsize=(8, 5))
+        ax = fig.add_subplot()
 
         colors = {0: "blue", 1: "green", 2: "red"}
         labels = {0: "QoS 0", 1: "QoS 1", 2: "QoS 2"}
 
-        # Plot latency for each QoS
-        for qos in latency_data:
-            if latency_data[qos]:
-                ax.plot(time_index[qos], latency_data[qos], marker="o", linestyle="-", color=colors[qos], label=f"{labels[qos]} (Avg: {avg_latency[qos]:.3f} sec)")
-
-        ax.set_xlabel("Message Index (Time)")
+        # Plot latency for each QoS; rollup buckets also get a min/max band
+        for qos, points in sorted(series.items()):
+            times = [datetime.fromtimestamp(t) for t in points["time"]]
+            avg = avg_latency.get(qos)
+            label = f"{labels[qos]} (Avg: {avg:.3f} sec)" if avg is not None else labels[qos]
+            marker = "o" if points["resolution"] == 0 else None
+            ax.plot(times, points["latency"], marker=marker, markersize=3, linestyle="-", color=colors[qos], label=label)
+            if points["resolution"]:
+                ax.fill_between(times, points["min"], points["max"], color=colors[qos], alpha=0.15)
+
+        resolution = max(points["resolution"] for points in series.values())
+        ax.set_xlabel(f"Time ({resolution}s buckets)" if resolution else "Time")
         ax.set_ylabel("Latency (Seconds)")
         ax.set_title("Latency Over Time for Different QoS Levels")
         ax.legend(loc="upper left")
         ax.grid(True)
+        fig.autofmt_xdate()
 
-        # Embed graph into Tkinter
-        canvas = FigureCanvasTkAgg(fig, master=self.graph_frame)
-        canvas.draw()
-        canvas.get_tk_widget().pack(fill="both", expand=True)
-
-        plt.close(fig)
+        self.draw("latency")
 
-                
     def show_jitter_graph(self):
         """Jitter over time comparison per QoS level."""
-        data = get_qos_latency_data()
-        if not data:
-            print("[DEBUG] No jitter data available.")
+        series = get_latency_series()
+        if not series:
+            logger.debug("No jitter data available.")
+            self.show_message("No Data Available")
             return
 
-        qos_levels, _, _, jitters = zip(*data)
-
-        # Organize data by QoS level
-        jitter_data = {0: [], 1: [], 2: []}
-        time_index = {0: [], 1: [], 2: []}
-
-        for i, (qos, jitter) in enumerate(zip(qos_levels, jitters)):
-            jitter_data[qos].append(jitter)
-            time_index[qos].append(i)  # X-axis is message index
-
-        # Clear previous graph
-        for widget in self.graph_frame.winfo_children():
-            widget.destroy()
-
-        # Create figure
-        fig, ax = plt.subplots(figsize=(7, 5))
+        fig = self.figure("jitter", figsize=(7, 5))
+        ax = fig.add_subplot()
 
         colors = {0: "blue", 1: "green", 2: "red"}
         labels = {0: "QoS 0", 1: "QoS 1", 2: "QoS 2"}
 
-        # Plot jitter for each QoS
-        for qos in jitter_data:
-            if jitter_data[qos]:
-                ax.plot(time_index[qos], jitter_data[qos], marker="o", linestyle="-", color=colors[qos], label=labels[qos])
-
-        ax.set_xlabel("Message Index (Time)")
+        # Plot jitter for each QoS; raw jitter is noisy, so it gets a rolling mean drawn over it
+        for qos, points in sorted(series.items()):
+            jitters = np.asarray(points["jitter"], dtype=np.float64)  # Rollup buckets without jitter are None
+            keep = ~np.isnan(jitters)
+            if not keep.any():
+                continue
+            times = [datetime.fromtimestamp(t) for t in np.asarray(points["time"])[keep]]
+            if points["resolution"] == 0:
+                ax.plot(times, jitters[keep], linestyle="-", color=colors[qos], alpha=0.3)
+                ax.plot(times, rolling_mean(jitters[keep], JITTER_SMOOTHING_WINDOW), linestyle="-", color=colors[qos], label=labels[qos])
+            else:
+                ax.plot(times, jitters[keep], linestyle="-", color=colors[qos], label=labels[qos])
+
+        ax.set_xlabel("Time")
         ax.set_ylabel("Jitter (Seconds)")
         ax.set_title("Jitter Over Time for Different QoS Levels")
         ax.legend()
         ax.grid(True)
+        fig.autofmt_xdate()
 
-        # Embed graph into Tkinter
-        canvas = FigureCanvasTkAgg(fig, master=self.graph_frame)
-        canvas.draw()
-        canvas.get_tk_widget().pack(fill="both", expand=True)
-
-        plt.close(fig)
+        self.draw("jitter")
 
     def show_qos_comparison_graph(self):
-        """Compare received packet count per QoS level including retransmissions."""
+        """Messages stored per QoS level, with their loss, duplicate and reorder rates from sequence numbers."""
         data = get_qos_comparison()
         if not data:
-            print("[DEBUG] No QoS comparison data available.")
-            ttk.Label(self.graph_frame, text="No Data Available", font=("Arial", 14), foreground="red").pack()
+            logger.debug("No QoS comparison data available.")
+            self.show_message("No Data Available")
             return
 
-        qos_levels, packet_counts = zip(*data)
-
-        fig, ax = plt.subplots(figsize=(6, 4))
-        
-        colors = ["red", "blue", "green"]
-        labels = ["QoS 0", "QoS 1 (Retransmissions Included)", "QoS 2"]
-        
-        ax.bar(qos_levels, packet_counts, color=colors, alpha=0.7)
-
-        ax.set_xlabel("QoS Level")
-        ax.set_ylabel("Packets Received (Including Retransmissions)")
-        ax.set_title("MQTT QoS Packet Delivery Comparison")
-        ax.set_xticks(qos_levels)
-        ax.set_xticklabels(labels)
-        ax.grid(True)
-
-        self.display_graph(fig)
-
-        plt.close(fig)
-        
-    def display_graph(self, fig):
-        """Clear previous graph and display a new one."""
-        for widget in self.graph_frame.winfo_children():
-            widget.destroy()
-
-        canvas = FigureCanvasTkAgg(fig, master=self.graph_frame)
-        canvas.draw()
-        canvas.get_tk_widget().pack(fill="both", expand=True)
-        
-        plt.close(fig)
-
+        qos_levels = [row["qos_level"] for row in data]
+        positions = np.arange(len(data))
+        labels = [f"QoS {qos}" for qos in qos_levels]
+
+        fig = self.figure("qos_comparison", figsize=(9, 4))
+        counts_ax, rates_ax = fig.subplots(1, 2)
+
+        counts_ax.bar(positions, [row["received"] for row in data],
+                      color=[{0: "red", 1: "blue", 2: "green"}.get(qos, "gray") for qos in qos_levels], alpha=0.7)
+        counts_ax.set_xlabel("QoS Level")
+        counts_ax.set_ylabel("Packets Stored (Duplicates Dropped)")
+        counts_ax.set_title("MQTT QoS Packet Delivery Comparison")
+        counts_ax.set_xticks(positions)
+        counts_ax.set_xticklabels(labels)
+        counts_ax.grid(True)
+
+        # Rates need sequence numbers from the publishers; levels without any show no bars
+        width = 0.25
+        for offset, (name, label, color) in zip((-width, 0, width), (
+            ("loss_rate", "Lost", "red"), ("duplicate_rate", "Duplicates", "orange"), ("reorder_rate", "Reordered", "purple"),
+        )):
+            rates = [100 * row[name] if row[name] is not None else 0.0 for row in data]
+            rates_ax.bar(positions + offset, rates, width, label=label, color=color, alpha=0.7)
+        rates_ax.set_xlabel("QoS Level")
+        rates_ax.set_ylabel("Rate (%)")
+        rates_ax.set_title("Loss, Duplicates and Reordering")
+        rates_ax.set_xticks(positions)
+        rates_ax.set_xticklabels(labels)
+        rates_ax.legend()
+        rates_ax.grid(True)
+        fig.tight_layout()
+
+        self.draw("qos_comparison")
 
     def show_latency_histogram(self):
         """Plot histogram of latency distributions per QoS level."""
-        df = get_latency_dataframe()
-        if df.empty:
-            ttk.Label(self.graph_frame, text="No Data Available", font=("Arial", 14), foreground="red").pack()
+        latencies = load_latencies()
+        if not len(latencies["latency"]):
+            self.show_message("No Data Available")
             return
 
-        qos_levels = sorted(df["qos_level"].unique())
-        latency_data = [df[df["qos_level"] == qos]["latency"] for qos in qos_levels]
+        groups = group_by(latencies["qos_level"], latency=latencies["latency"])
+        # Binned here over shared edges; matplotlib only draws the 30 bars per level
+        edges, counts = histogram({qos: group["latency"] for qos, group in groups.items()}, bins=30)
 
-        for widget in self.graph_frame.winfo_children():
-            widget.destroy()
-
-        fig, ax = plt.subplots(figsize=(8, 5))
-        colors = ["blue", "green", "red"]
-        labels = [f"QoS {q}" for q in qos_levels]
+        fig = self.figure("histogram", figsize=(8, 5))
+        ax = fig.add_subplot()
+        colors = {0: "blue", 1: "green", 2: "red"}
 
-        for data, color, label in zip(latency_data, colors, labels):
-            ax.hist(data, bins=30, alpha=0.5, label=label, color=color, edgecolor="black")
+        for qos, qos_counts in counts.items():
+            ax.hist(edges[:-1], bins=edges, weights=qos_counts, alpha=0.5, label=f"QoS {qos}", color=colors[qos], edgecolor="black")
 
         ax.set_title("Latency Distribution per QoS Level")
         ax.set_xlabel("Latency (seconds)")
@@ -237,24 +247,24 @@ class GraphsPage(ttk.Frame):
         ax.legend()
         ax.grid(True)
 
-        canvas = FigureCanvasTkAgg(fig, master=self.graph_frame)
-        canvas.draw()
-        canvas.get_tk_widget().pack(fill="both", expand=True)
-        plt.close(fig)
-
+        self.draw("histogram")
 
     def show_latency_boxplot(self):
         """Boxplot of latency values per QoS level."""
-        df = get_latency_dataframe()
-        if df.empty:
-            ttk.Label(self.graph_frame, text="No Data Available", font=("Arial", 14), foreground="red").pack()
+        latencies = load_latencies()
+        if not len(latencies["latency"]):
+            self.show_message("No Data Available")
             return
 
-        for widget in self.graph_frame.winfo_children():
-            widget.destroy()
+        groups = group_by(latencies["qos_level"], latency=latencies["latency"])
+        # Quartiles and whiskers are computed here so matplotlib never gets the raw values (outliers are not drawn)
+        stats = [box_stats(group["latency"], label=str(qos)) for qos, group in groups.items()]
 
-        fig, ax = plt.subplots(figsize=(6, 5))
-        sns.boxplot(x="qos_level", y="latency", data=df, palette=["blue", "green", "red"], ax=ax)
+        fig = self.figure("boxplot", figsize=(6, 5))
+        ax = fig.add_subplot()
+        boxes = ax.bxp(stats, showfliers=False, patch_artist=True)
+        for box, qos in zip(boxes["boxes"], groups):
+            box.set_facecolor({0: "blue", 1: "green", 2: "red"}[qos])
 
         ax.set_title("Latency Boxplot per QoS Level")
         ax.set_xlabel("QoS Level")
@@ -262,7 +272,30 @@ class GraphsPage(ttk.Frame):
         ax.yaxis.set_major_locator(ticker.MaxNLocator(10))
         ax.grid(True)
 
-        canvas = FigureCanvasTkAgg(fig, master=self.graph_frame)
-        canvas.draw()
-        canvas.get_tk_widget().pack(fill="both", expand=True)
-        plt.close(fig)
+        self.draw("boxplot")
+
+    def show_latency_stats(self):
+        """Table of latency mean, spread, percentiles and jitter per QoS level."""
+        stats = get_latency_stats()
+        if not stats:
+            self.show_message("No Data Available")
+            return
+
+        columns = ("qos", "count", "mean", "stddev", "p50", "p95", "p99", "max", "jitter")
+        table = self.views.get("stats")
+        if table is None:
+            table = self.views["stats"] = ttk.Treeview(self.graph_frame, columns=columns, show="headings", height=4)
+            for column in columns:
+                table.heading(column, text=column.upper() if column.startswith("p") else column.capitalize())
+                table.column(column, width=80, anchor="center")
+        table.delete(*table.get_children())
+
+        def fmt(value):
+            return f"{value:.4f}" if value is not None else "-"
+
+        for row in stats:
+            table.insert("", "end", values=(
+                f"QoS {row['qos_level']}", row["count"], fmt(row["mean"]), fmt(row["stddev"]),
+                fmt(row["p50"]), fmt(row["p95"]), fmt(row["p99"]), fmt(row["max"]), fmt(row["jitter"]),
+            ))
+        self.show_view(table)
@@ -0,0 +1,129 @@
+import time
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from app.analytics import QOS_LEVELS, RingBuffer, group_by
+from app.config import LIVE_GRAPH_WINDOW, LIVE_GRAPH_POINTS, LIVE_GRAPH_FPS
+from app.database import get_max_row_id, get_live_rows
+
+COLORS = {0: "blue", 1: "green", 2: "red"}
+
+
+class LiveLatencyGraph:
+    """Latency and jitter of the newest messages per QoS level, updated in place while running.
+
+    One figure and canvas live for the whole session. Each frame (at most
+    `fps` per second) reads only the rows stored since the last frame, appends
+    them to per-QoS ring buffers and moves the existing lines with set_data.
+    The axes are drawn once and cached; frames only blit the lines over that
+    background, unless the data outgrows the y range and the axes are rescaled.
+    """
+
+    def __init__(self, master, window=LIVE_GRAPH_WINDOW, capacity=LIVE_GRAPH_POINTS, fps=LIVE_GRAPH_FPS):
+        self.window = window
+        self.capacity = capacity
+        self.interval_ms = max(1, round(1000 / fps))
+
+        self.figure = Figure(figsize=(8, 5))
+        self.latency_ax, self.jitter_ax = self.figure.subplots(2, 1, sharex=True)
+        self.canvas = FigureCanvasTkAgg(self.figure, master=master)
+        self.widget = self.canvas.get_tk_widget()
+
+        self.buffers = {
+            qos: {name: RingBuffer(capacity) for name in ("time", "latency", "jitter")} for qos in QOS_LEVELS
+        }
+        # Animated lines are left out of full draws and blitted over the cached background
+        self.lines = {
+            qos: (
+                self.latency_ax.plot([], [], color=COLORS[qos], label=f"QoS {qos}", animated=True)[0],
+                self.jitter_ax.plot([], [], color=COLORS[qos], animated=True)[0],
+            )
+            for qos in QOS_LEVELS
+        }
+
+        self.latency_ax.set_title("Live Latency and Jitter")
+        self.latency_ax.set_ylabel("Latency (Seconds)")
+        self.jitter_ax.set_ylabel("Jitter (Seconds)")
+        self.jitter_ax.set_xlabel("Seconds Ago")
+        self.jitter_ax.set_xlim(-window, 0)
+        for ax in (self.latency_ax, self.jitter_ax):
+            ax.set_ylim(0, 0.1)
+            ax.grid(True)
+        self.latency_ax.legend(handles=[lines[0] for lines in self.lines.values()], loc="upper left")
+
+        self.background = None
+        self.canvas.mpl_connect("draw_event", self.on_draw)
+        self.last_id = None
+        self._job = None
+
+    def start(self):
+        """Fill the buffers with the newest stored rows and start following new ones."""
+        if self._job is not None:
+            return
+        for buffers in self.buffers.values():
+            for buffer in buffers.values():
+                buffer.clear()
+        self.last_id = max(0, get_max_row_id() - self.capacity * len(QOS_LEVELS))
+        self._job = self.widget.after(0, self.tick)
+
+    def stop(self):
+        if self._job is not None:
+            self.widget.after_cancel(self._job)
+            self._job = None
+
+    def tick(self):
+        """One frame: append the rows stored since the last one and redraw the lines."""
+        rows = get_live_rows(self.last_id)
+        if len(rows["id"]):
+            self.last_id = int(rows["id"][-1])
+            groups = group_by(rows["qos_level"], time=rows["received_time"], latency=rows["latency"], jitter=rows["jitter"])
+            for qos, group in groups.items():
+                for name, values in group.items():
+                    self.buffers[qos][name].extend(values)
+        self.redraw(time.time())
+        self._job = self.widget.after(self.interval_ms, self.tick)
+
+    def redraw(self, now):
+        # x is relative to now, so the axes stay fixed and the lines scroll
+        for qos, (latency_line, jitter_line) in self.lines.items():
+            buffers = self.buffers[qos]
+            ago = buffers["time"].values() - now
+            latency_line.set_data(ago, buffers["latency"].values())
+            jitter_line.set_data(ago, buffers["jitter"].values())
+
+        if self._rescale(now) or self.background is None:
+            self.canvas.draw()  # on_draw caches the new background and draws the lines
+            return
+        self.canvas.restore_region(self.background)
+        self._draw_lines()
+        self.canvas.blit(self.figure.bbox)
+
+    def _rescale(self, now):
+        """Fit each y axis to the visible data when it overflows or would fit in a quarter of the range."""
+        rescaled = False
+        for ax, name in ((self.latency_ax, "latency"), (self.jitter_ax, "jitter")):
+            peaks = []
+            for buffers in self.buffers.values():
+                visible = buffers["time"].values() >= now - self.window
+                values = buffers[name].values()[visible]
+                if len(values) and not np.isnan(values).all():
+                    peaks.append(np.nanmax(values))
+            if not peaks:
+                continue
+            peak = max(peaks)
+            top = ax.get_ylim()[1]
+            fitted = max(peak * 1.5, 1e-3)
+            if peak > top or fitted < top / 4:
+                ax.set_ylim(0, fitted)
+                rescaled = True
+        return rescaled
+
+    def _draw_lines(self):
+        for latency_line, jitter_line in self.lines.values():
+            self.latency_ax.draw_artist(latency_line)
+            self.jitter_ax.draw_artist(jitter_line)
+
+    def on_draw(self, event):
+        """After a full draw (first show, resize, rescale) cache the background and put the lines back."""
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self._draw_lines()
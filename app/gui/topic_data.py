@@ -1,6 +1,7 @@
 import ttkbootstrap as ttk
 from ttkbootstrap.constants import *
-from app.database import get_data_for_topic
+from app.database import get_topic_page
+from app.gui.virtual_table import VirtualTable
 
 class TopicDataPage(ttk.Frame):
     def __init__(self, parent, controller):
@@ -11,8 +12,14 @@ class TopicDataPage(ttk.Frame):
         self.label = ttk.Label(self, text="Select a Topic", font=("Arial", 16))
         self.label.pack(pady=10)
 
-        self.data_box = ttk.ScrolledText(self, width=50, height=15)
-        self.data_box.pack(pady=10)
+        # Only a window of rows is loaded; more are paged in while scrolling
+        self.data_table = VirtualTable(
+            self,
+            columns=[("Received", 200), ("Data", 400)],
+            cursor_of=lambda row: (row[1], row[0]),
+            values_of=lambda row: (row[2], row[3]),
+        )
+        self.data_table.pack(pady=10, fill="both", expand=True)
 
         ttk.Button(self, text="Back to Topics", bootstyle="secondary", command=lambda: controller.show_frame("TopicsPage")).pack(pady=10)
 
@@ -23,8 +30,6 @@ class TopicDataPage(ttk.Frame):
         self.load_data()
 
     def load_data(self):
-        """Load data for the current topic into the data box."""
-        self.data_box.delete("1.0", "end")
-        data = get_data_for_topic(self.topic)
-        for entry in data:
-            self.data_box.insert("end", f"{entry[1]}: {entry[0]}\n")
+        """Show the newest rows of the current topic and follow new ones as they arrive."""
+        topic = self.topic
+        self.data_table.set_source(lambda **page: get_topic_page(topic, **page))
@@ -1,18 +1,35 @@
+import logging
+import time
+from datetime import datetime
 import ttkbootstrap as ttk
 from ttkbootstrap.constants import *
-from app.mqtt_client import mqtt_client
-from app.database import get_topics
+from app.database import get_topic_summaries
+from app.topic_tree import TopicIndex
+from app.config import TOPIC_TREE_REFRESH_MS
+
+logger = logging.getLogger(__name__)
+
+# Child item that makes a collapsed node expandable until its real children are loaded
+PLACEHOLDER = "__placeholder__"
 
 class TopicsPage(ttk.Frame):
     def __init__(self, parent, controller):
         super().__init__(parent)
         self.controller = controller
         self.current_qos = 0  # Default QoS level
+        self.index = TopicIndex()
+        self.pending = {}  # topic -> [new messages, last seen] waiting for the next tree refresh
 
         ttk.Label(self, text="Discovered Topics", font=("Arial", 16)).pack(pady=10)
 
-        # Treeview for Topics
-        self.topic_listbox = ttk.Treeview(self, columns=("Topics"), show="tree")
+        # Treeview for the topic hierarchy; children are only created when a node is expanded
+        self.topic_listbox = ttk.Treeview(self, columns=("count", "last_seen"), show="tree headings")
+        self.topic_listbox.heading("#0", text="Topic")
+        self.topic_listbox.heading("count", text="Messages")
+        self.topic_listbox.heading("last_seen", text="Last Seen")
+        self.topic_listbox.column("count", width=90, anchor="e")
+        self.topic_listbox.column("last_seen", width=150, anchor="center")
+        self.topic_listbox.bind("<<TreeviewOpen>>", self.on_expand)
         self.topic_listbox.pack(pady=10, fill="both", expand=True)
         self.view_button = ttk.Button(self, text="View Topic Data", bootstyle="primary", command=self.view_topic_data)
         self.view_button.pack(pady=5)
@@ -31,45 +48,109 @@ class TopicsPage(ttk.Frame):
 
         # Initial subscription to all topics
         self.subscribe_to_all(self.current_qos)
+        self.after(TOPIC_TREE_REFRESH_MS, self.refresh_tree)
 
     def load_topics(self):
-        """Load topics from the database into the Treeview."""
-        topics = get_topics()
-        for topic in topics:
-            self.topic_listbox.insert("", "end", text=topic)
+        """Seed the topic index from the topics table and show the top level of the hierarchy."""
+        for topic, count, last_seen in get_topic_summaries():
+            self.index.add(topic, count, last_seen)
+        self.populate(self.index.root)
 
     def subscribe_to_all(self, qos):
         """Subscribe to all topics with the given QoS level."""
-        mqtt_client.subscribe("#", self.on_new_message, qos)
-        print(f"[INFO] Subscribed to all topics with QoS {qos}")
+        self.controller.feed.subscribe("#", self.on_new_message, qos)
+        logger.info("Subscribed to all topics with QoS %s", qos)
 
     def change_qos(self, qos):
-        """Unsubscribe and resubscribe to all topics with a new QoS level."""
+        """Switch the `#` subscription to a new QoS level without interrupting delivery."""
         if qos != self.current_qos:
-            mqtt_client.subscribe("#", self.on_new_message, qos)  # Triggers resubscription
+            self.controller.feed.subscribe("#", self.on_new_message, qos)  # Broker replaces the subscription in place
             self.current_qos = qos
-            print(f"[INFO] Changed QoS level to {qos}")
+            logger.info("Changed QoS level to %s", qos)
 
     def on_new_message(self, payload, topic):
-        """Callback for MQTT messages."""
-        if not self.topic_exists_in_treeview(topic):
-            self.controller.after(0, lambda: self.topic_listbox.insert("", "end", text=topic))
+        """Callback for MQTT messages; only records the hit, the tree is updated in batches."""
+        entry = self.pending.get(topic)
+        if entry is None:
+            self.pending[topic] = [1, time.time()]
+        else:
+            entry[0] += 1
+            entry[1] = time.time()
+
+    def refresh_tree(self):
+        """Apply the messages recorded since the last refresh to the index and the visible nodes."""
+        pending, self.pending = self.pending, {}
+        changed = {}
+        for topic, (count, last_seen) in pending.items():
+            for node in self.index.add(topic, count, last_seen):
+                changed[node.path] = node
+
+        for node in changed.values():
+            iid = self.node_id(node)
+            if self.topic_listbox.exists(iid):
+                self.topic_listbox.item(iid, values=self.node_values(node))
+                continue
+            parent = node.parent
+            parent_iid = "" if parent is self.index.root else self.node_id(parent)
+            if parent_iid and not self.topic_listbox.exists(parent_iid):
+                continue  # An ancestor is not shown yet; it will be built on expansion
+            children = self.topic_listbox.get_children(parent_iid)
+            if parent_iid and children == (self.placeholder_id(parent),):
+                continue  # Parent is collapsed and already expandable
+            if parent_iid and not children:
+                self.topic_listbox.insert(parent_iid, "end", iid=self.placeholder_id(parent), text="")
+                continue
+            self.insert_node(parent_iid, node)
+
+        self.after(TOPIC_TREE_REFRESH_MS, self.refresh_tree)
+
+    def on_expand(self, event):
+        """Build the children of a node the first time it is expanded."""
+        iid = self.topic_listbox.focus()
+        node = self.index.node(self.path_of(iid))
+        if node is not None and self.topic_listbox.exists(self.placeholder_id(node)):
+            self.topic_listbox.delete(self.placeholder_id(node))
+            self.populate(node)
+
+    def populate(self, node):
+        parent_iid = "" if node is self.index.root else self.node_id(node)
+        for name in sorted(node.children):
+            self.insert_node(parent_iid, node.children[name])
+
+    def insert_node(self, parent_iid, node):
+        iid = self.node_id(node)
+        self.topic_listbox.insert(parent_iid, "end", iid=iid, text=node.name or "/", values=self.node_values(node))
+        if node.children:
+            self.topic_listbox.insert(iid, "end", iid=self.placeholder_id(node), text="")
+
+    @staticmethod
+    def node_id(node):
+        return f"node:{node.path}"
+
+    @staticmethod
+    def placeholder_id(node):
+        return f"{PLACEHOLDER}:{node.path}"
+
+    @staticmethod
+    def path_of(iid):
+        return iid[len("node:"):] if iid.startswith("node:") else None
+
+    @staticmethod
+    def node_values(node):
+        last_seen = datetime.fromtimestamp(node.last_seen).strftime("%Y-%m-%d %H:%M:%S") if node.last_seen else "-"
+        return (node.count, last_seen)
 
     def topic_exists_in_treeview(self, topic):
-        """Check if a topic already exists in the Treeview."""
-        for child in self.topic_listbox.get_children():
-            if self.topic_listbox.item(child)["text"] == topic:
-                return True
-        return False
-    
+        """Check if a topic is known (O(1) index lookup)."""
+        return topic in self.index
+
     def view_topic_data(self):
         """Open the selected topic's data page."""
         selected_item = self.topic_listbox.selection()
-        if selected_item:
-            topic = self.topic_listbox.item(selected_item, "text")
-            topic_frame = self.controller.frames["TopicDataPage"]
+        topic = self.path_of(selected_item[0]) if selected_item else None
+        if topic is not None and topic in self.index:
+            topic_frame = self.controller.get_frame("TopicDataPage")
             topic_frame.set_topic(topic)
             self.controller.show_frame("TopicDataPage")
         else:
-            print("[WARNING] No topic selected.")
-
+            logger.warning("No topic selected.")
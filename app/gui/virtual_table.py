@@ -0,0 +1,126 @@
+from collections import deque
+import ttkbootstrap as ttk
+from ttkbootstrap.constants import *
+from app.config import TOPIC_PAGE_SIZE, TOPIC_VIEW_WINDOW, TOPIC_TAIL_INTERVAL_MS
+
+# Fraction of the scroll range from either end at which the next page is loaded
+EDGE = 0.05
+
+
+class VirtualTable(ttk.Frame):
+    """Treeview that pages rows in from a keyset-paginated source as the user scrolls.
+
+    `fetch(after=None, before=None, limit=...)` returns rows oldest first;
+    `cursor_of(row)` gives the key to page from and `values_of(row)` the cells.
+    At most `window` rows are kept: loading a page at one end trims the other.
+    While the newest rows are loaded the table polls for new ones (live tail).
+    """
+
+    def __init__(self, parent, columns, cursor_of, values_of, page_size=TOPIC_PAGE_SIZE,
+                 window=TOPIC_VIEW_WINDOW, tail_interval=TOPIC_TAIL_INTERVAL_MS):
+        super().__init__(parent)
+        self.cursor_of = cursor_of
+        self.values_of = values_of
+        self.page_size = page_size
+        self.window = window
+        self.tail_interval = tail_interval
+
+        self.tree = ttk.Treeview(self, columns=[name for name, _ in columns], show="headings")
+        for name, width in columns:
+            self.tree.heading(name, text=name)
+            self.tree.column(name, width=width, anchor="w")
+        self.scrollbar = ttk.Scrollbar(self, orient="vertical", command=self.tree.yview)
+        self.tree.configure(yscrollcommand=self._on_scroll)
+        self.tree.pack(side="left", fill="both", expand=True)
+        self.scrollbar.pack(side="right", fill="y")
+
+        self.fetch = None
+        self.entries = deque()  # (iid, cursor) in display order
+        self.at_head = True  # no older rows beyond the first loaded one
+        self.at_tail = True  # the newest row is loaded
+        self._loading = False
+        self._tail_job = None
+
+    def set_source(self, fetch):
+        """Show rows from a new source, starting at its newest page and following the live tail."""
+        self._cancel_tail()
+        self.tree.delete(*self.tree.get_children())
+        self.entries.clear()
+        self.fetch = fetch
+
+        rows = fetch(before=None, limit=self.page_size)
+        self._insert_end(rows)
+        self.at_head = len(rows) < self.page_size
+        self.at_tail = True
+        self.tree.yview_moveto(1.0)
+        self._schedule_tail()
+
+    def destroy(self):
+        self._cancel_tail()
+        super().destroy()
+
+    def _on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        if self._loading or self.fetch is None or not self.entries:
+            return
+        if float(first) <= EDGE and not self.at_head:
+            self._loading = True
+            self.after_idle(self._load_older)
+        elif float(last) >= 1 - EDGE and not self.at_tail:
+            self._loading = True
+            self.after_idle(self._load_newer)
+
+    def _load_older(self):
+        try:
+            anchor = self.entries[0][0]
+            rows = self.fetch(before=self.entries[0][1], limit=self.page_size)
+            self.at_head = len(rows) < self.page_size
+            for row in reversed(rows):
+                iid = self.tree.insert("", 0, values=self.values_of(row))
+                self.entries.appendleft((iid, self.cursor_of(row)))
+            while len(self.entries) > self.window:
+                self.tree.delete(self.entries.pop()[0])
+                self.at_tail = False
+            self.tree.see(anchor)  # Keep the row the user was looking at in view
+        finally:
+            self._loading = False
+
+    def _load_newer(self):
+        try:
+            anchor = self.entries[-1][0]
+            rows = self.fetch(after=self.entries[-1][1], limit=self.page_size)
+            self.at_tail = len(rows) < self.page_size
+            self._insert_end(rows)
+            self.tree.see(anchor)
+        finally:
+            self._loading = False
+
+    def _insert_end(self, rows):
+        for row in rows:
+            iid = self.tree.insert("", "end", values=self.values_of(row))
+            self.entries.append((iid, self.cursor_of(row)))
+        while len(self.entries) > self.window:
+            self.tree.delete(self.entries.popleft()[0])
+            self.at_head = False
+
+    def _schedule_tail(self):
+        self._tail_job = self.after(self.tail_interval, self._poll_tail)
+
+    def _cancel_tail(self):
+        if self._tail_job is not None:
+            self.after_cancel(self._tail_job)
+            self._tail_job = None
+
+    def _poll_tail(self):
+        """Append rows that arrived since the newest loaded one, without reloading history."""
+        if self.at_tail and not self._loading and self.fetch is not None:
+            following = self.tree.yview()[1] >= 0.999
+            if self.entries:
+                rows = self.fetch(after=self.entries[-1][1], limit=self.page_size)
+            else:
+                rows = self.fetch(before=None, limit=self.page_size)
+            if rows:
+                self._insert_end(rows)
+                if following:
+                    self.tree.yview_moveto(1.0)
+        self._schedule_tail()
@@ -0,0 +1,185 @@
+import logging
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from app.config import INGEST_WORKERS, INGEST_MODE, INGEST_QUEUE_SIZE, INGEST_PROCESS_BATCH
+from app.metrics import MESSAGES, STAGE_SECONDS, registry
+from app.profiling import profiler
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def _parse_batch(parse, items):
+    """Run `parse` over a batch of raw messages inside a worker process.
+
+    Returns a (row, error) pair per message, the error as text so it always
+    pickles; one bad message leaves the rest of the batch alone.
+    """
+    results = []
+    for item in items:
+        try:
+            results.append((parse(*item), None))
+        except Exception as e:
+            results.append((None, f"{type(e).__name__}: {e}"))
+    return results
+
+
+def process_shard(topic, processes):
+    """Index of the ingest process that owns `topic` when topics are hash-sharded over `processes`.
+
+    Uses a different hash from the worker queues of a pipeline, so each
+    process's topics still spread over all of its workers.
+    """
+    return zlib.adler32(topic.encode()) % processes
+
+
+class IngestPipeline:
+    """Moves message processing off the paho network thread.
+
+    Raw messages are sharded by topic onto per-worker queues so messages of one
+    topic are always handled in arrival order. Each worker runs `parse` to turn
+    a raw message into a row and hands the row to `sink`. In "process" mode the
+    parsing step runs in a process pool, one batch per round trip.
+    """
+
+    def __init__(self, parse, sink, workers=INGEST_WORKERS, mode=INGEST_MODE,
+                 queue_size=INGEST_QUEUE_SIZE, process_batch=INGEST_PROCESS_BATCH):
+        if mode not in ("thread", "process"):
+            raise ValueError(f"Unknown ingest mode: {mode!r}")
+
+        self.parse = parse
+        self.sink = sink
+        self.mode = mode
+        self.process_batch = process_batch
+
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._processed = [0] * workers
+        self._errors = [0] * workers
+        self._last_lag = [0.0] * workers
+        self._executor = ProcessPoolExecutor(max_workers=workers) if mode == "process" else None
+
+        registry.gauge("iot_ingest_queue_depth", "Raw messages waiting per ingest worker", ("worker",),
+                       function=lambda: {(str(index),): q.qsize() for index, q in enumerate(self._queues)})
+        registry.gauge("iot_ingest_lag_seconds", "How long the oldest queued message has waited",
+                       function=lambda: self.metrics()["lag"])
+        registry.counter("iot_ingest_errors_total", "Messages that failed to parse or persist",
+                         function=lambda: sum(self._errors))
+
+        self._threads = []
+        for index in range(workers):
+            thread = threading.Thread(target=self._run, args=(index,), name=f"ingest-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, topic, payload, qos, received_ns, precise_received_time):
+        """Enqueue a raw message; blocks when the topic's shard is full."""
+        shard = zlib.crc32(topic.encode()) % len(self._queues)
+        self._queues[shard].put((topic, payload, qos, received_ns, precise_received_time))
+
+    def stop(self, timeout=None):
+        """Process everything already queued, then stop the workers."""
+        for q in self._queues:
+            q.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def metrics(self):
+        """Return queue depths, throughput counters and ingest lag in seconds."""
+        now = time.monotonic()
+        depths = [q.qsize() for q in self._queues]
+
+        # Lag is how long the oldest waiting message has been queued
+        oldest_wait = 0.0
+        for q in self._queues:
+            with q.mutex:
+                head = q.queue[0] if q.queue else None
+            if head is not None and head is not _STOP:
+                oldest_wait = max(oldest_wait, now - head[4])
+
+        return {
+            "queue_depth": sum(depths),
+            "queue_depths": depths,
+            "processed": sum(self._processed),
+            "errors": sum(self._errors),
+            "lag": oldest_wait,
+            "last_processing_lag": max(self._last_lag),
+        }
+
+    def _run(self, index):
+        q = self._queues[index]
+        while True:
+            item = q.get()
+            if item is _STOP:
+                return
+            profiler.checkpoint()
+
+            if self._executor is None:
+                self._handle(index, [item])
+                continue
+
+            # Gather whatever else is already waiting so one IPC round trip covers many messages
+            items = [item]
+            stop = False
+            while len(items) < self.process_batch:
+                try:
+                    item = q.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                items.append(item)
+            self._handle(index, items)
+            if stop:
+                return
+
+    def _handle(self, index, items):
+        now = time.monotonic()
+        self._last_lag[index] = now - items[0][4]
+        for item in items:
+            STAGE_SECONDS.observe(now - item[4], ("queue",))
+            MESSAGES.inc((item[0],))
+        if self._executor is None:
+            results = []
+            for item in items:
+                started = time.perf_counter()
+                try:
+                    results.append((self.parse(*item), None))
+                except Exception as e:
+                    logger.exception("Failed to parse message on %s: %s", item[0], e)
+                    results.append((None, e))
+                STAGE_SECONDS.observe(time.perf_counter() - started, ("parse",))
+        else:
+            started = time.perf_counter()
+            try:
+                results = self._executor.submit(_parse_batch, self.parse, items).result()
+            except Exception as e:
+                self._errors[index] += len(items)
+                logger.exception("Failed to parse %s message(s) on %s: %s", len(items), items[0][0], e)
+                return
+            # Each message gets its share of the round trip; decode timings stay in the worker processes
+            share = (time.perf_counter() - started) / len(items)
+            for item, (_, error) in zip(items, results):
+                STAGE_SECONDS.observe(share, ("parse",))
+                if error is not None:
+                    logger.error("Failed to parse message on %s: %s", item[0], error)
+
+        for item, (row, error) in zip(items, results):
+            if error is not None:
+                self._errors[index] += 1
+                continue
+            started = time.perf_counter()
+            try:
+                self.sink(row)
+            except Exception as e:
+                self._errors[index] += 1
+                logger.exception("Failed to persist message on %s: %s", item[0], e)
+                continue
+            STAGE_SECONDS.observe(time.perf_counter() - started, ("persist",))
+            self._processed[index] += 1
@@ -0,0 +1,158 @@
+import atexit
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from app.config import LOG_LEVEL, LOG_FORMAT, LOG_FILE, LOG_QUEUE_SIZE, LOG_RATE_LIMIT
+from app.metrics import registry
+
+# Attributes every LogRecord has; anything else was passed with `extra=` and is a structured field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "suppressed"}
+
+
+class TextFormatter(logging.Formatter):
+    """`[LEVEL] message key=value ...`, the format the console output has always had."""
+
+    def format(self, record):
+        line = f"[{record.levelname}] {record.getMessage()}"
+        fields = structured_fields(record)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        exception = format_exception(self, record)
+        if exception:
+            line += "\n" + exception
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and any structured fields."""
+
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(structured_fields(record))
+        exception = format_exception(self, record)
+        if exception:
+            entry["exception"] = exception
+        return json.dumps(entry, default=str)
+
+
+def format_exception(formatter, record):
+    # Records from the queue carry the traceback already formatted (see DroppingQueueHandler.prepare)
+    if record.exc_info:
+        return formatter.formatException(record.exc_info)
+    return record.exc_text
+
+
+def structured_fields(record):
+    fields = {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+    if getattr(record, "suppressed", 0):
+        fields["suppressed"] = record.suppressed
+    return fields
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets at most `rate` records per second through from each logging call site.
+
+    Records dropped from a site are counted and reported on the next record
+    from that site that gets through, so a flood of per-message warnings
+    becomes a few lines a second that say how much was left out.
+    """
+
+    def __init__(self, rate=LOG_RATE_LIMIT):
+        super().__init__()
+        self.rate = rate
+        self.sites = {}  # (pathname, lineno) -> [window start, records in window, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            site = self.sites.setdefault((record.pathname, record.lineno), [now, 0, 0])
+            if now - site[0] >= 1:
+                site[0], site[1] = now, 0
+            if site[1] >= self.rate:
+                site[2] += 1
+                return False
+            site[1] += 1
+            record.suppressed, site[2] = site[2], 0
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that drops (and counts) records instead of blocking or raising when the queue is full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # Formatting happens on the listener thread; only make the record safe to hand over
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener = None
+_handler = None
+
+
+def configure(level=LOG_LEVEL, log_format=LOG_FORMAT, path=LOG_FILE):
+    """Send the `app` loggers through a bounded queue to a background writer thread.
+
+    Callers only pay for a level check and, when enabled, a rate-limit check
+    and a queue put; formatting and writing happen on the listener thread.
+    `log_format` is "text" or "json"; `path` is a file to append to, or empty
+    for standard output. Calling it again replaces the previous setup.
+    """
+    global _listener, _handler
+    shutdown()
+
+    output = logging.FileHandler(path, encoding="utf-8") if path else logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if log_format == "json" else TextFormatter())
+    _handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    _handler.addFilter(RateLimitFilter())
+    _listener = QueueListener(_handler.queue, output)
+    _listener.start()
+
+    logger = logging.getLogger("app")
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(_handler)
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    logger.propagate = False
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """Write out the queued records and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def dropped():
+    """Records lost because the log queue was full."""
+    return _handler.dropped if _handler is not None else 0
+
+
+registry.counter("iot_log_dropped_total", "Log records lost because the log queue was full", function=dropped)
@@ -0,0 +1,304 @@
+import bisect
+import json
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from app.config import METRICS_HISTOGRAM_BUCKETS, METRICS_MAX_SERIES, PROFILE_DEFAULT_SECONDS
+from app.profiling import profiler
+
+OTHER = "_other"  # Label value that stands in for series past a metric's max_series
+
+
+class _Metric:
+    """Base of the metric types; counters and gauges with a `function` are read at collection time instead.
+
+    `function()` returns a number, a dict of label values tuple -> number, or
+    None for no samples. It lets existing stats dicts be exported without
+    touching the code that updates them.
+    """
+
+    kind = None
+
+    def __init__(self, name, help, labelnames=(), max_series=METRICS_MAX_SERIES, function=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.max_series = max_series
+        self.function = function
+        self.series = {}  # label values tuple -> value (or histogram state)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        """Series key for `labels`, folded into OTHER once max_series distinct ones exist (lock held)."""
+        if labels in self.series or len(self.series) < self.max_series:
+            return labels
+        return (OTHER,) * len(self.labelnames)
+
+    def samples(self):
+        """(name suffix, label values, value) triples in exposition order."""
+        if self.function is not None:
+            value = self.function()
+            if value is None:
+                return []
+            if not isinstance(value, dict):
+                value = {(): value}
+            return [("", labels, item) for labels, item in sorted(value.items())]
+        with self._lock:
+            return [("", labels, value) for labels, value in sorted(self.series.items())]
+
+
+class Counter(_Metric):
+    """Monotonic count, per label values."""
+
+    kind = "counter"
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            key = self._key(labels)
+            self.series[key] = self.series.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Current value, per label values."""
+
+    kind = "gauge"
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self.series[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """Distribution of observed values (seconds by default) over fixed cumulative buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), max_series=METRICS_MAX_SERIES, buckets=METRICS_HISTOGRAM_BUCKETS):
+        super().__init__(name, help, labelnames, max_series)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            key = self._key(labels)
+            state = self.series.get(key)
+            if state is None:
+                state = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]  # per-bucket counts, sum, count
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            series = sorted((labels, (list(state[0]), state[1], state[2])) for labels, state in self.series.items())
+        for labels, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                samples.append(("_bucket", labels + (_format_value(bound),), cumulative))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, count))
+        return samples
+
+    def quantile(self, q, labels=()):
+        """Upper bound of the bucket holding quantile `q` of the observations, or None if there are none."""
+        with self._lock:
+            state = self.series.get(labels)
+            if state is None or not state[2]:
+                return None
+            counts, count = list(state[0]), state[2]
+        rank = q * count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return bound
+        return math.inf
+
+
+class Timer:
+    """Context manager that observes its block's duration into a histogram."""
+
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram, labels=()):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, self.labels)
+
+
+class Registry:
+    """Named metrics of this process, rendered in the Prometheus text format.
+
+    Asking for an existing name returns that metric (with the new function,
+    if one is given), so modules can declare their metrics at import and
+    owners of function metrics can re-register them when they are rebuilt.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, **kwargs):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, **kwargs)
+            elif type(metric) is not cls:
+                raise ValueError(f"Metric {name!r} is already registered as a {metric.kind}")
+            elif kwargs.get("function") is not None:
+                metric.function = kwargs["function"]
+            return metric
+
+    def counter(self, name, help, labelnames=(), **kwargs):
+        return self._get(Counter, name, help, labelnames=labelnames, **kwargs)
+
+    def gauge(self, name, help, labelnames=(), **kwargs):
+        return self._get(Gauge, name, help, labelnames=labelnames, **kwargs)
+
+    def histogram(self, name, help, labelnames=(), **kwargs):
+        return self._get(Histogram, name, help, labelnames=labelnames, **kwargs)
+
+    def collect(self):
+        """(name, kind, help, samples) per metric, samples being (name suffix, ((label, value), ...), value).
+
+        Plain data, so the metrics of another process can be shipped here and
+        rendered through add_collector().
+        """
+        with self._lock:
+            metrics = list(self.metrics.values())
+        families = []
+        for metric in metrics:
+            samples = []
+            for suffix, labels, value in metric.samples():
+                names = metric.labelnames + ("le",) if suffix == "_bucket" else metric.labelnames
+                samples.append((suffix, tuple(zip(names, labels)), value))
+            families.append((metric.name, metric.kind, metric.help, samples))
+        return families
+
+    def add_collector(self, collector):
+        """Also render the families `collector()` returns, in the form of collect(); same-named ones are merged."""
+        with self._lock:
+            self.collectors.append(collector)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+        with self._lock:
+            collectors = list(self.collectors)
+        families = {}  # name -> (kind, help, samples)
+        for name, kind, help, samples in self.collect() + [family for collector in collectors for family in collector()]:
+            families.setdefault(name, (kind, help, []))[2].extend(samples)
+        lines = []
+        for name, (kind, help, samples) in families.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in samples:
+                label_text = ",".join(f'{label}="{_escape(str(item))}"' for label, item in labels)
+                lines.append(f"{name}{suffix}{{{label_text}}} {_format_value(value)}" if label_text
+                             else f"{name}{suffix} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """{metric name: {label values: value}} for display; histograms give count, mean, p50 and p99 (bucket bounds)."""
+        with self._lock:
+            metrics = list(self.metrics.values())
+        result = {}
+        for metric in metrics:
+            if isinstance(metric, Histogram):
+                with metric._lock:
+                    keys = {labels: (state[1], state[2]) for labels, state in metric.series.items()}
+                result[metric.name] = {
+                    labels: {
+                        "count": count,
+                        "mean": total / count if count else None,
+                        "p50": metric.quantile(0.5, labels),
+                        "p99": metric.quantile(0.99, labels),
+                    }
+                    for labels, (total, count) in sorted(keys.items())
+                }
+            else:
+                result[metric.name] = {labels: value for _, labels, value in metric.samples()}
+        return result
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value is None:
+        return "NaN"
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+
+# Ingest pipeline stages, shared by the modules that time them
+STAGE_SECONDS = registry.histogram(
+    "iot_ingest_stage_seconds",
+    "Time per message (per batch for commit) in each ingest stage: "
+    "receive (network thread), queue (waiting for a worker), decode, parse, persist (hand-off to the writer), commit",
+    ("stage",),
+)
+MESSAGES = registry.counter("iot_ingest_messages_total", "Messages taken off the ingest queues, per topic", ("topic",))
+
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """GET /metrics from the registry; GET /profile for profiler status and reports, POST /profile?kind=&seconds= to start one."""
+
+    registry = registry
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/metrics":
+            self._send(200, PROMETHEUS_CONTENT_TYPE, self.registry.render().encode())
+        elif path == "/profile":
+            self._send(200, "application/json", json.dumps(profiler.status()).encode())
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/profile":
+            self.send_error(404)
+            return
+        params = parse_qs(url.query)
+        try:
+            profiler.start(params.get("kind", ["cpu"])[0], params.get("seconds", [PROFILE_DEFAULT_SECONDS])[0])
+        except ValueError as e:
+            self.send_error(409, str(e))
+            return
+        self._send(202, "application/json", json.dumps(profiler.status()).encode())
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # One line per scrape
+
+
+def start_metrics_server(host, port):
+    """Serve /metrics and /profile on (host, port) from a daemon thread; returns the server."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,302 @@
+import logging
+import sqlite3
+import time
+from app.config import DATABASE_PATH, BACKFILL_CHUNK_SIZE
+from app.timeutil import parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+
+def _v1_time_columns(conn):
+    """Epoch time columns, the topics dimension table and the (topic|qos, time) indexes.
+
+    Existing rows are counted into topics by backfill_time_columns rather
+    than here. The index builds are the one step that still waits on the
+    size of mqtt_data (a sort of its rows); they stay in the migration
+    because building them later would hold the write lock against ingest.
+    """
+    conn.execute("ALTER TABLE mqtt_data ADD COLUMN sent_time REAL")
+    conn.execute("ALTER TABLE mqtt_data ADD COLUMN received_time REAL")
+    conn.execute("ALTER TABLE mqtt_data ADD COLUMN topic_id INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_mqtt_data_topic_time ON mqtt_data (topic, received_time)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_mqtt_data_qos_time ON mqtt_data (qos_level, received_time)")
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS topics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            topic TEXT NOT NULL UNIQUE,
+            first_seen REAL,
+            last_seen REAL,
+            message_count INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    # Existing rows are converted later in chunks; remember where the old data ends
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS backfill_progress (
+            name TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL,
+            target_id INTEGER NOT NULL,
+            done INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        INSERT OR IGNORE INTO backfill_progress (name, last_id, target_id)
+        SELECT 'time_columns', 0, COALESCE(MAX(id), 0) FROM mqtt_data
+    """)
+
+
+def _v2_latency_stats(conn):
+    """Per-(topic, QoS) streaming latency summary, seeded from existing rows by a backfill."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS latency_stats (
+            topic TEXT NOT NULL,
+            qos_level INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            mean REAL,
+            m2 REAL,
+            min_latency REAL,
+            max_latency REAL,
+            sketch TEXT,
+            jitter REAL,
+            last_latency REAL,
+            last_time REAL,
+            updated_at REAL,
+            PRIMARY KEY (topic, qos_level)
+        )
+    """)
+    conn.execute("""
+        INSERT OR IGNORE INTO backfill_progress (name, last_id, target_id)
+        SELECT 'latency_stats', 0, COALESCE(MAX(id), 0) FROM mqtt_data
+    """)
+
+
+def _v3_latency_rollup(conn):
+    """Time-bucketed latency aggregates per topic and QoS at each ROLLUP_RESOLUTIONS width."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS latency_rollup (
+            resolution INTEGER NOT NULL,  -- bucket width in seconds
+            topic TEXT NOT NULL,
+            qos_level INTEGER NOT NULL,
+            bucket_start INTEGER NOT NULL,  -- epoch seconds, multiple of resolution
+            count INTEGER NOT NULL,
+            min_latency REAL,
+            max_latency REAL,
+            sum_latency REAL NOT NULL,
+            jitter_sum REAL NOT NULL,
+            jitter_count INTEGER NOT NULL,
+            packet_size_sum INTEGER NOT NULL,
+            sketch TEXT,
+            PRIMARY KEY (resolution, topic, qos_level, bucket_start)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_latency_rollup_time ON latency_rollup (resolution, bucket_start)")
+    conn.execute("""
+        INSERT OR IGNORE INTO backfill_progress (name, last_id, target_id)
+        SELECT 'latency_rollup', 0, COALESCE(MAX(id), 0) FROM mqtt_data
+    """)
+
+
+def _v4_epoch_ns(conn):
+    """Exact integer epoch-nanosecond send/receive times for rows ingested from here on."""
+    conn.execute("ALTER TABLE mqtt_data ADD COLUMN sent_ns INTEGER")
+    conn.execute("ALTER TABLE mqtt_data ADD COLUMN received_ns INTEGER")
+
+
+def _v5_archive_legacy(conn):
+    """Progress of archiving the pre-partitioning mqtt_data rows to columnar files."""
+    conn.execute("""
+        INSERT OR IGNORE INTO backfill_progress (name, last_id, target_id)
+        SELECT 'archive_legacy', 0, COALESCE(MAX(id), 0) FROM mqtt_data
+    """)
+
+
+def _v6_value(conn):
+    """Typed REAL column for numeric readings, which no longer go into the `data` TEXT column."""
+    conn.execute("ALTER TABLE mqtt_data ADD COLUMN value REAL")
+
+
+def _v7_clock_sync(conn):
+    """Publisher id and applied clock correction per row, and the per-publisher clock models."""
+    conn.execute("ALTER TABLE mqtt_data ADD COLUMN client_id TEXT")
+    conn.execute("ALTER TABLE mqtt_data ADD COLUMN clock_offset REAL")
+    conn.execute("ALTER TABLE mqtt_data ADD COLUMN latency_error REAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS clock_offsets (
+            client_id TEXT PRIMARY KEY,
+            reference REAL NOT NULL,  -- our epoch ns the offset applies at
+            offset REAL NOT NULL,  -- ns to add to the publisher's clock
+            drift REAL NOT NULL,  -- ns of offset per ns
+            error REAL NOT NULL,  -- ns
+            updated INTEGER NOT NULL,  -- our epoch ns of the newest probe
+            samples INTEGER NOT NULL
+        )
+    """)
+
+
+def _v8_delivery(conn):
+    """Delivery counters per topic and QoS, and each publisher's sequence window, kept by DeliveryTracker."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS delivery_stats (
+            topic TEXT NOT NULL,
+            qos_level INTEGER NOT NULL,
+            received INTEGER NOT NULL DEFAULT 0,  -- rows stored
+            sequenced INTEGER NOT NULL DEFAULT 0,  -- of which carried a sequence number
+            duplicates INTEGER NOT NULL DEFAULT 0,  -- redeliveries dropped
+            reordered INTEGER NOT NULL DEFAULT 0,  -- arrived after a higher sequence number
+            lost INTEGER NOT NULL DEFAULT 0,  -- sequence numbers skipped and not (yet) filled in
+            updated_at REAL,
+            PRIMARY KEY (topic, qos_level)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS delivery_windows (
+            publisher TEXT PRIMARY KEY,
+            first INTEGER NOT NULL,  -- number the window started at; gaps below it were never counted lost
+            highest INTEGER NOT NULL,
+            highest_sent_ns INTEGER,
+            window BLOB NOT NULL,  -- bit i (little-endian) set: sequence number highest - i arrived
+            updated_at REAL
+        )
+    """)
+    # Earlier rows carry no sequence numbers. latency_stats already counts those (with a latency) ingested
+    # since version 2 and the legacy rows its backfill has reached; backfill_delivery_stats counts the rest
+    conn.execute("""
+        INSERT OR IGNORE INTO delivery_stats (topic, qos_level, received, updated_at)
+        SELECT topic, qos_level, count, updated_at FROM latency_stats
+    """)
+    conn.execute("""
+        INSERT OR IGNORE INTO backfill_progress (name, last_id, target_id)
+        SELECT 'delivery_stats', last_id, target_id FROM backfill_progress WHERE name = 'latency_stats'
+    """)
+
+
+# (version, step) pairs; a database at user_version N has had every step <= N applied
+MIGRATIONS = [
+    (1, _v1_time_columns),
+    (2, _v2_latency_stats),
+    (3, _v3_latency_rollup),
+    (4, _v4_epoch_ns),
+    (5, _v5_archive_legacy),
+    (6, _v6_value),
+    (7, _v7_clock_sync),
+    (8, _v8_delivery),
+]
+
+
+def migrate(conn, migrations=MIGRATIONS, name="database"):
+    """Apply every pending migration, each in its own transaction.
+
+    Each step takes the write lock and checks the version again first, so
+    processes starting together apply it once.
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, step in migrations:
+        if target <= version:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if target <= version:
+                conn.rollback()  # Applied by another process meanwhile
+                continue
+            logger.info("Migrating %s schema to version %s", name, target)
+            started = time.monotonic()
+            step(conn)
+            conn.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+            logger.info("Migrated %s schema to version %s in %.1fs", name, target, time.monotonic() - started)
+        except Exception:
+            conn.rollback()
+            raise
+        version = target
+    return version
+
+
+def chunked_backfill(conn, name, select_sql, process_chunk, chunk_size=BACKFILL_CHUNK_SIZE):
+    """Drive the resumable backfill `name` over rows with last_id < id <= target_id.
+
+    `select_sql` takes (last_id, target_id, limit) and must return the row id
+    first. `process_chunk(conn, rows)` runs in the same IMMEDIATE transaction
+    as the progress update, so an interrupted run never applies a chunk twice.
+    Returns True once the backfill has completed.
+    """
+    progress = conn.execute(
+        "SELECT last_id, target_id, done FROM backfill_progress WHERE name = ?", (name,)
+    ).fetchone()
+    if progress is None or progress[2]:
+        return False
+
+    last_id, target_id, _ = progress
+    while last_id < target_id:
+        rows = conn.execute(select_sql, (last_id, target_id, chunk_size)).fetchall()
+        if not rows:
+            break
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Another process may be running the same backfill
+            current = conn.execute("SELECT last_id FROM backfill_progress WHERE name = ?", (name,)).fetchone()[0]
+            if current != last_id:
+                conn.rollback()
+                return False
+            process_chunk(conn, rows)
+            last_id = rows[-1][0]
+            conn.execute("UPDATE backfill_progress SET last_id = ? WHERE name = ?", (last_id, name))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    with conn:
+        conn.execute("UPDATE backfill_progress SET last_id = ?, done = 1 WHERE name = ?", (target_id, name))
+    logger.info("Backfill '%s' complete up to row %s", name, target_id)
+    return True
+
+
+def backfill_time_columns(database_path=DATABASE_PATH):
+    """Fill the epoch/topic_id columns of rows stored before schema version 1.
+
+    The rows are also counted into the topics table chunk by chunk; rows
+    stored since then were counted by the TopicRegistry writer hook.
+    """
+    conn = sqlite3.connect(database_path, timeout=30)
+    try:
+        topic_ids = dict(conn.execute("SELECT topic, id FROM topics"))
+
+        def process_chunk(conn, rows):
+            counts = {}
+            for _, topic, _, _ in rows:
+                counts[topic] = counts.get(topic, 0) + 1
+            conn.executemany("""
+                INSERT INTO topics (topic, message_count) VALUES (?, ?)
+                ON CONFLICT(topic) DO UPDATE SET message_count = message_count + excluded.message_count
+            """, counts.items())
+            for topic in counts:
+                if topic not in topic_ids:
+                    topic_ids[topic] = conn.execute("SELECT id FROM topics WHERE topic = ?", (topic,)).fetchone()[0]
+            conn.executemany(
+                "UPDATE mqtt_data SET sent_time = ?, received_time = ?, topic_id = ? WHERE id = ?",
+                [(parse_timestamp(sent), parse_timestamp(received), topic_ids.get(topic), row_id)
+                 for row_id, topic, sent, received in rows],
+            )
+
+        completed = chunked_backfill(conn, "time_columns", """
+            SELECT id, topic, sent_timestamp, received_timestamp FROM mqtt_data
+            WHERE id > ? AND id <= ? ORDER BY id LIMIT ?
+        """, process_chunk)
+
+        if completed:
+            # Rows ingested meanwhile went to day partitions and are already in topics, so only widen the range
+            with conn:
+                conn.execute("""
+                    UPDATE topics SET
+                        first_seen = MIN(COALESCE(topics.first_seen, legacy.first), legacy.first),
+                        last_seen = MAX(COALESCE(topics.last_seen, legacy.last), legacy.last)
+                    FROM (
+                        SELECT topic, MIN(received_time) AS first, MAX(received_time) AS last
+                        FROM mqtt_data WHERE received_time IS NOT NULL GROUP BY topic
+                    ) AS legacy
+                    WHERE legacy.topic = topics.topic
+                """)
+    finally:
+        conn.close()
@@ -1,72 +1,284 @@
+import logging
 import time
-from datetime import datetime
+import threading
+from collections import deque
 import paho.mqtt.client as mqtt
 import ssl
-from app.config import BROKER_IP, PORT
-from app.database import save_data
+from app.config import BROKER_IP, PORT, MQTT_RECONNECT_MIN_DELAY, MQTT_RECONNECT_MAX_DELAY
+from app.config import DISPATCH_INTERVAL_MS, DISPATCH_BATCH_SIZE
+from app.database import get_writer, parse_message, store_row, writer_metrics
+from app.ingest import IngestPipeline, process_shard
+from app.metrics import STAGE_SECONDS
+from app.timesync import clock_sync
+from app.topic_tree import TopicMatcher
+from app.writer import WriterHook
 from app.config import MQTT_USERNAME, MQTT_PASSWORD
 
+logger = logging.getLogger(__name__)
+
+
+class CallbackDispatcher:
+    """Hands matched messages to subscriber callbacks.
+
+    Once attached to a Tk widget, callbacks run on the Tk thread: messages are
+    queued and drained in batches by one periodic `after()` job rather than an
+    `after(0, ...)` per message. Until then callbacks run on the calling thread.
+    """
+
+    def __init__(self, interval_ms=DISPATCH_INTERVAL_MS, batch_size=DISPATCH_BATCH_SIZE):
+        self.interval_ms = interval_ms
+        self.batch_size = batch_size
+        self.queue = deque()
+        self.widget = None
+
+    def attach(self, widget):
+        """Start delivering callbacks on `widget`'s Tk thread."""
+        self.widget = widget
+        widget.after(self.interval_ms, self._drain)
+
+    def put(self, callback, payload, topic):
+        if self.widget is None:
+            callback(payload, topic)
+        else:
+            self.queue.append((callback, payload, topic))
+
+    def _drain(self):
+        for _ in range(min(len(self.queue), self.batch_size)):
+            callback, payload, topic = self.queue.popleft()
+            try:
+                callback(payload, topic)
+            except Exception as e:
+                logger.exception("Callback for %s failed: %s", topic, e)
+        self.widget.after(self.interval_ms, self._drain)
+
+
+class _Notifier(WriterHook):
+    """Writer hook that passes committed rows to an MQTTClient's callbacks, so redeliveries dropped at ingest never reach them."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def after_commit(self, rows):
+        self.client.notify(rows)
+
+
 class MQTTClient:
-    def __init__(self):
-        self.client = mqtt.Client()
+    def __init__(self, client_id="", clean_session=True, time_sync=True):
+        self.client = mqtt.Client(client_id=client_id, clean_session=clean_session)
         self.client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
         #self.client.tls_set(cert_reqs=ssl.CERT_NONE)
-        #self.client.tls_insecure_set(True)        
+        #self.client.tls_insecure_set(True)
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
-        self.client.connect(BROKER_IP, PORT, 60)
-        self.client.loop_start()
+        self.client.on_subscribe = self.on_subscribe
+        self.client.on_unsubscribe = self.on_unsubscribe
+        self.client.on_disconnect = self.on_disconnect
+        self.client.reconnect_delay_set(MQTT_RECONNECT_MIN_DELAY, MQTT_RECONNECT_MAX_DELAY)
+        self.pipeline = None  # Started by start()
+        self.time_sync = time_sync  # Answer clock probes (only one of several ingest processes does)
+        self.share_group = None  # Subscribe through $share/<group>/ so the broker balances messages over the group
+        self.shard = None  # (index, processes): only ingest the topics process_shard() assigns to `index`
 
-        self.topic_callbacks = {}
+        # topic filter -> {"qos": requested, "granted": QoS from SUBACK or None while pending,
+        #                  "mid": message id of the SUBSCRIBE whose SUBACK sets "granted"}
+        self.subscriptions = {}
+        self.callbacks = TopicMatcher()
+        self.dispatcher = CallbackDispatcher()
+        self.notifier = _Notifier(self)
         self.message_log = {}
-        self.current_qos = 0  # Track current QoS for `#` wildcard subscription
+        self._lock = threading.Lock()
+        self._pending_acks = {}  # mid -> ("subscribe" | "unsubscribe" | "clock", topic filter)
+        self._early_acks = {}  # acks that arrived before the request's mid was recorded
+
+    def start(self, host=BROKER_IP, port=PORT):
+        """Start the ingest workers and connect in the background.
+
+        Returns immediately even if the broker is unreachable; the network
+        thread keeps retrying with exponential backoff, and subscriptions made
+        in the meantime are sent once the connection is up.
+        """
+        if self.pipeline is not None:
+            return
+        writer = get_writer()
+        if self.notifier not in writer.hooks:
+            writer.hooks.append(self.notifier)
+        self.pipeline = IngestPipeline(parse_message, self.handle_row)
+        self.client.connect_async(host, port, 60)
+        self.client.loop_start()
+
+    def stop(self, timeout=None):
+        """Disconnect and let the ingest workers finish the messages already received."""
+        if self.pipeline is None:
+            return
+        self.client.disconnect()
+        self.client.loop_stop()
+        self.pipeline.stop(timeout)
+        self.pipeline = None
 
     def on_connect(self, client, userdata, flags, rc):
-        print("[DEBUG] Connected to MQTT Broker with result code:", rc)
+        logger.debug("Connected to MQTT Broker with result code: %s", rc)
+        # A clean session starts with no subscriptions; restore ours after every (re)connect
+        with self._lock:
+            # Requests of the previous connection are never answered, and their mids get reused
+            self._pending_acks.clear()
+            self._early_acks.clear()
+            wanted = [(topic, sub["qos"]) for topic, sub in self.subscriptions.items()]
+        for topic, qos in wanted:
+            self._send_subscribe(topic, qos)
+        # Clock probes go at QoS 0: a retransmitted probe would only report a long round trip
+        if self.time_sync:
+            for topic in clock_sync.filters():
+                rc, mid = client.subscribe(topic, 0)
+                if rc == mqtt.MQTT_ERR_SUCCESS:
+                    self._track(mid, "clock", topic)
+
+    def on_disconnect(self, client, userdata, rc):
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            logger.warning("Lost connection to MQTT Broker (code %s); reconnecting", rc)
 
     def on_message(self, client, userdata, message):
-        """Process MQTT messages and track timestamps more accurately."""
-        topic = message.topic
-        payload = message.payload.decode()
-        qos = message.qos
-        packet_size = len(message.payload)
+        """Timestamp the raw message and hand it to the ingest workers; only clock probes are answered here.
+
+        Nothing under TIME_SYNC_TOPIC is stored, including the pongs the `#` subscription brings back to us.
+        """
+        received_ns = time.time_ns()
+        started = time.perf_counter()
+        if clock_sync.is_reserved(message.topic):
+            if self.time_sync:
+                clock_sync.handle(message.topic, message.payload, received_ns, self.client.publish)
+            return
+        if self.shard is not None and process_shard(message.topic, self.shard[1]) != self.shard[0]:
+            return
+        self.pipeline.submit(message.topic, message.payload, message.qos, received_ns, time.monotonic())
+        STAGE_SECONDS.observe(time.perf_counter() - started, ("receive",))  # Includes waiting for room in a full shard
+
+    def handle_row(self, row):
+        """Persist a parsed message (ingest worker thread); callbacks are notified once it is committed."""
+        store_row(row)
 
-        # Use time.monotonic() to track precise message arrival time
-        received_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-        precise_received_time = time.monotonic()
+    def notify(self, rows):
+        """Pass committed rows to the callbacks whose filter matches their topic (writer thread)."""
+        if not len(self.callbacks):
+            return
+        for row in rows:
+            data = row["value"] if row["value"] is not None else row["data"]  # Numeric readings are stored in `value`
+            for callback in self.callbacks.match(row["topic"]):
+                try:
+                    self.dispatcher.put(callback, data, row["topic"])
+                except Exception as e:  # Raised by a callback run inline; must not fail the committed batch
+                    logger.exception("Callback for %s failed: %s", row["topic"], e)
 
-        print(f"[DEBUG] Received MQTT: Topic={topic}, QoS={qos}, PacketSize={packet_size} bytes, Payload={payload}")
-        print(f"[DEBUG] Local system time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')}")
-        try:
-            save_data(topic, payload, qos, received_timestamp, packet_size, precise_received_time)
-        except TypeError as e:
-            print(f"[ERROR] Failed to save data: {e}")
+    def is_connected(self):
+        return self.client.is_connected()
 
-        print(f"[INFO] Message successfully processed for {topic} at QoS {qos}")
+    def ingest_metrics(self):
+        """Return ingest queue depth and lag for monitoring."""
+        return self.pipeline.metrics() if self.pipeline is not None else None
 
+    def writer_metrics(self):
+        return writer_metrics()
+
+    def clock_metrics(self):
+        return clock_sync.metrics()
 
     def subscribe(self, topic, callback, qos=0):
-        """Ensure proper resubscription to all topics when changing QoS."""
-        if topic == "#" and qos != self.current_qos:
-            print(f"[INFO] Changing QoS for `#`: Unsubscribing and resubscribing with QoS {qos}")
-            
-            # First, check if the client is already subscribed before unsubscribing
-            self.client.unsubscribe("#")
-            
-            # Allow some time for the broker to process the unsubscription
-            time.sleep(1)
-
-            # Resubscribe with the new QoS level
-            self.client.subscribe("#", qos)
-            self.current_qos = qos  # Track the current QoS level
-            print(f"[INFO] Successfully resubscribed to `#` with QoS {qos}")
-
-        # Ensure the callback is registered
-        if topic not in self.topic_callbacks:
-            self.topic_callbacks[topic] = []
-        self.topic_callbacks[topic].append(callback)
-
-        print(f"[DEBUG] Subscription active for {topic} at QoS {qos}")
+        """Register `callback` for `topic` (wildcards allowed) and make sure the broker subscription has `qos`.
+
+        A None `callback` only holds the broker subscription, for ingest.
+        Changing the QoS of an existing filter just re-sends SUBSCRIBE: the broker
+        replaces the subscription in place, so no messages are lost to a gap and
+        nothing blocks waiting for the acknowledgement.
+        """
+        if callback is not None and callback not in self.callbacks.filters(topic):
+            self.callbacks.add(topic, callback)
+
+        with self._lock:
+            current = self.subscriptions.get(topic)
+            if current is not None and current["qos"] == qos:
+                return
+            self.subscriptions[topic] = {"qos": qos, "granted": None, "mid": None}
+
+        if current is not None:
+            logger.info("Changing QoS for `%s` from %s to %s", topic, current['qos'], qos)
+        self._send_subscribe(topic, qos)
+
+    def unsubscribe(self, topic, callback=None):
+        """Remove `callback` (or every callback) for `topic`; the broker subscription goes when none remain."""
+        callbacks = [callback] if callback is not None else self.callbacks.filters(topic)
+        for registered in callbacks:
+            self.callbacks.remove(topic, registered)
+        if self.callbacks.filters(topic):
+            return
+
+        with self._lock:
+            if self.subscriptions.pop(topic, None) is None:
+                return
+        rc, mid = self.client.unsubscribe(self._broker_filter(topic))
+        if rc == mqtt.MQTT_ERR_SUCCESS:  # Otherwise the next connection simply does not restore it
+            self._track(mid, "unsubscribe", topic)
+
+    def is_subscribed(self, topic):
+        """True once the broker has acknowledged the current subscription for `topic`."""
+        with self._lock:
+            sub = self.subscriptions.get(topic)
+            return sub is not None and sub["granted"] is not None
+
+    def _broker_filter(self, topic):
+        return f"$share/{self.share_group}/{topic}" if self.share_group else topic
+
+    def _send_subscribe(self, topic, qos):
+        rc, mid = self.client.subscribe(self._broker_filter(topic), qos)
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            # Not connected yet; on_connect sends it once the connection is up
+            return
+        with self._lock:
+            sub = self.subscriptions.get(topic)
+            if sub is not None and sub["qos"] == qos:  # Not replaced by a newer request meanwhile
+                sub["mid"] = mid
+        self._track(mid, "subscribe", topic)
+
+    def _track(self, mid, action, topic):
+        with self._lock:
+            early = self._early_acks.pop(mid, None)
+            if early is None:
+                self._pending_acks[mid] = (action, topic)
+                return
+        self._acknowledge(mid, action, topic, early)
+
+    def on_subscribe(self, client, userdata, mid, granted_qos):
+        self._ack(mid, granted_qos[0])
+
+    def on_unsubscribe(self, client, userdata, mid):
+        self._ack(mid, None)
+
+    def _ack(self, mid, granted):
+        with self._lock:
+            pending = self._pending_acks.pop(mid, None)
+            if pending is None:
+                self._early_acks[mid] = granted if granted is not None else "unsubscribed"
+                return
+        self._acknowledge(mid, *pending, granted)
+
+    def _acknowledge(self, mid, action, topic, granted):
+        if action == "unsubscribe":
+            logger.debug("Unsubscribed from %s", topic)
+            return
+        if action == "clock":
+            if granted == 0x80:
+                logger.error("Broker rejected clock sync subscription to %s", topic)
+            return
+        with self._lock:
+            sub = self.subscriptions.get(topic)
+            if sub is None or sub["mid"] != mid:
+                # A request replaced by a later QoS change; its SUBACK may still arrive after the current one
+                logger.debug("Ignoring SUBACK of a superseded subscription to %s", topic)
+                return
+            if granted != 0x80:
+                sub["granted"] = granted
+        if granted == 0x80:
+            logger.error("Broker rejected subscription to %s", topic)
+            return
+        logger.debug("Subscription active for %s at QoS %s", topic, granted)
 
     def publish(self, topic, message, qos=0):
         """Publish a message and track its send time."""
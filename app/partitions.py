@@ -0,0 +1,229 @@
+import os
+import re
+import sqlite3
+from datetime import datetime, timezone
+from urllib.request import pathname2url
+from app.config import DATABASE_PATH, PARTITION_DIR, WRITE_SYNCHRONOUS
+from app.metrics import registry
+from app.migrations import migrate
+from app.pool import ReaderPool
+from app.writer import WriterHook
+
+DAY = 86400
+# Row ids of a partition start at day * ID_STRIDE so they stay unique (and time ordered) across files
+ID_STRIDE = 10 ** 10
+# SQLite's default SQLITE_MAX_ATTACHED; a transaction can write to at most this many partitions
+MAX_ATTACHED = 10
+_PARTITION_FILE = re.compile(r"^mqtt_data_(\d{4}-\d{2}-\d{2})\.db$")
+
+
+def _p1_schema(conn):
+    """mqtt_data with every column of the main table as of schema version 4, and its time indexes."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS mqtt_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            topic TEXT NOT NULL,
+            topic_id INTEGER,
+            data TEXT NOT NULL,
+            qos_level INTEGER NOT NULL,
+            packet_size INTEGER NOT NULL,
+            sent_timestamp TEXT NOT NULL,
+            received_timestamp TEXT NOT NULL,
+            sent_time REAL,
+            received_time REAL,
+            sent_ns INTEGER,
+            received_ns INTEGER,
+            precise_received_time REAL,
+            latency REAL,
+            jitter REAL,
+            previous_latency REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_mqtt_data_topic_time ON mqtt_data (topic, received_time)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_mqtt_data_qos_time ON mqtt_data (qos_level, received_time)")
+
+
+def _p2_value(conn):
+    """The `value` column of main schema version 6."""
+    conn.execute("ALTER TABLE mqtt_data ADD COLUMN value REAL")
+
+
+def _p3_clock_sync(conn):
+    """The client_id, clock_offset and latency_error columns of main schema version 7."""
+    conn.execute("ALTER TABLE mqtt_data ADD COLUMN client_id TEXT")
+    conn.execute("ALTER TABLE mqtt_data ADD COLUMN clock_offset REAL")
+    conn.execute("ALTER TABLE mqtt_data ADD COLUMN latency_error REAL")
+
+
+# Schema steps for partition files, applied like MIGRATIONS; keep in step with mqtt_data changes there
+PARTITION_MIGRATIONS = [
+    (1, _p1_schema),
+    (2, _p2_value),
+    (3, _p3_clock_sync),
+]
+
+
+def partition_day(epoch):
+    """UTC day number (days since 1970-01-01) holding epoch seconds `epoch`."""
+    return int(epoch // DAY)
+
+
+def partition_path(day):
+    date = datetime.fromtimestamp(day * DAY, timezone.utc).strftime("%Y-%m-%d")
+    return os.path.join(PARTITION_DIR, f"mqtt_data_{date}.db")
+
+
+def schema_name(day):
+    """Name a partition is ATTACHed under."""
+    return f"p{day}"
+
+
+def list_partition_days():
+    """Days that have a partition file, oldest first."""
+    if not os.path.isdir(PARTITION_DIR):
+        return []
+    days = []
+    for name in os.listdir(PARTITION_DIR):
+        match = _PARTITION_FILE.match(name)
+        if match:
+            date = datetime.strptime(match.group(1), "%Y-%m-%d").replace(tzinfo=timezone.utc)
+            days.append(partition_day(date.timestamp()))
+    return sorted(days)
+
+
+def create_partition(day):
+    """Create (or upgrade) the partition file for `day` and return its path."""
+    path = partition_path(day)
+    os.makedirs(PARTITION_DIR, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        migrate(conn, PARTITION_MIGRATIONS, name=f"partition {os.path.basename(path)}")
+        with conn:
+            conn.execute("""
+                INSERT INTO sqlite_sequence (name, seq)
+                SELECT 'mqtt_data', ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'mqtt_data')
+            """, (day * ID_STRIDE,))
+    finally:
+        conn.close()
+    return path
+
+
+def upgrade_partitions():
+    """Bring every existing partition to the current schema; new ones are migrated when created."""
+    for day in list_partition_days():
+        create_partition(day)
+
+
+def sources(start=None, end=None):
+    """Database files that can hold mqtt_data rows received in [start, end), oldest first.
+
+    That is the main database, whose mqtt_data holds the rows stored before
+    partitioning, followed by every day partition overlapping the range.
+    """
+    first = partition_day(start) if start is not None else None
+    last = partition_day(end) if end is not None else None
+    return [DATABASE_PATH] + [
+        partition_path(day) for day in list_partition_days()
+        if (first is None or day >= first) and (last is None or day <= last)
+    ]
+
+
+def _connect_source(path):
+    # Partitions are opened read-only so a dropped one is not recreated
+    if path == DATABASE_PATH:
+        return sqlite3.connect(path, check_same_thread=False)
+    return sqlite3.connect(f"file:{pathname2url(path)}?mode=ro", uri=True, check_same_thread=False)
+
+
+readers = ReaderPool(_connect_source)
+registry.gauge("iot_reader_connections", "Pooled read-only connections by state", ("state",),
+               function=lambda: {(state,): readers.metrics()[state] for state in ("in_use", "idle")})
+registry.counter("iot_reader_checkouts_total", "Reader connection checkouts", function=lambda: readers.stats["checkouts"])
+registry.counter("iot_reader_waits_total", "Checkouts that waited for a free connection", function=lambda: readers.stats["waits"])
+registry.counter("iot_reader_wait_seconds_total", "Time spent waiting for a free connection",
+                 function=lambda: readers.stats["wait_time"])
+
+
+def read_source(path=DATABASE_PATH):
+    """Pooled read-only connection to a source (the main database by default), as a context manager.
+
+    Raises sqlite3.OperationalError if the partition has been dropped.
+    """
+    return readers.connection(path)
+
+
+def query_partitions(sql, params=(), start=None, end=None, newest_first=False, limit=None):
+    """Run `sql` (which reads the table `mqtt_data`) on every source overlapping [start, end) and concatenate the rows.
+
+    Sources are visited in time order (newest first if asked), so per-source
+    ordered results stay ordered. With `limit`, `sql` must end in `LIMIT ?`;
+    the remaining row budget is bound to it and later sources are skipped once
+    it is spent.
+    """
+    paths = sources(start, end)
+    if newest_first:
+        paths.reverse()
+
+    rows = []
+    for path in paths:
+        bound = list(params)
+        if limit is not None:
+            if len(rows) >= limit:
+                break
+            bound.append(limit - len(rows))
+        try:
+            with read_source(path) as conn:
+                rows.extend(conn.execute(sql, bound).fetchall())
+        except sqlite3.OperationalError:
+            if os.path.exists(path):
+                raise
+            # Dropped by compaction since it was listed
+    return rows
+
+
+class PartitionRouter(WriterHook):
+    """Writes each row into the partition of the UTC day it was received.
+
+    Partitions are ATTACHed to the writer connection before the batch
+    transaction (ATTACH is not allowed inside one) and `insert` is the
+    writer's insert step. Days older than the newest day in a batch are
+    detached, so compaction can drop them, as are other days not in the
+    batch once more than MAX_ATTACHED would be attached. Batches spanning
+    more days than that are split into several transactions.
+    """
+
+    def __init__(self, insert_sql):
+        self.insert_sql = insert_sql  # with a {schema} placeholder for the table's database
+        self.attached = set()
+
+    def split(self, rows):
+        """Consecutive groups of `rows` spanning at most MAX_ATTACHED days each (a replayed or late backlog can span more)."""
+        groups, days = [[]], set()
+        for row in rows:
+            day = partition_day(row["received_time"])
+            if day not in days and len(days) == MAX_ATTACHED:
+                groups.append([])
+                days = set()
+            days.add(day)
+            groups[-1].append(row)
+        return groups
+
+    def before_transaction(self, conn, rows):
+        days = {partition_day(row["received_time"]) for row in rows}
+        newest = max(days)
+        for day in sorted(self.attached - days):
+            if day < newest or len(self.attached | days) > MAX_ATTACHED:
+                conn.execute(f"DETACH DATABASE {schema_name(day)}")
+                self.attached.discard(day)
+        for day in sorted(days - self.attached):
+            conn.execute(f"ATTACH DATABASE ? AS {schema_name(day)}", (create_partition(day),))
+            conn.execute(f"PRAGMA {schema_name(day)}.synchronous={WRITE_SYNCHRONOUS}")
+            self.attached.add(day)
+
+    def insert(self, conn, rows):
+        by_day = {}
+        for row in rows:
+            by_day.setdefault(partition_day(row["received_time"]), []).append(row)
+        for day, day_rows in by_day.items():
+            conn.executemany(self.insert_sql.format(schema=schema_name(day)), day_rows)
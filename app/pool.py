@@ -0,0 +1,171 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from app.config import READ_POOL_SIZE, READ_POOL_TIMEOUT, READ_POOL_MAX_FILES, DB_CACHE_SIZE, DB_MMAP_SIZE
+
+
+def tune(conn):
+    """Apply the configured page cache and memory-map sizes to a connection."""
+    conn.execute(f"PRAGMA cache_size={int(DB_CACHE_SIZE)}")
+    conn.execute(f"PRAGMA mmap_size={int(DB_MMAP_SIZE)}")
+
+
+class _FilePool:
+    def __init__(self):
+        self.idle = []
+        self.open = 0  # Pooled connections of this file, idle or checked out
+
+
+class ReaderPool:
+    """Reusable read-only connections, up to `size` per database file.
+
+    A checkout waits up to `timeout` seconds for a connection of its file to
+    be returned; past that it gets an extra connection that is closed again
+    on return, so nested or bursty reads never deadlock. Idle connections are
+    kept for the `max_files` most recently read files only. Connections move
+    between threads (Tk, ingest workers, HTTP handlers) but are only ever used
+    by one at a time.
+    """
+
+    def __init__(self, connect, size=READ_POOL_SIZE, timeout=READ_POOL_TIMEOUT, max_files=READ_POOL_MAX_FILES):
+        self.connect = connect  # path -> new sqlite3 connection (check_same_thread=False)
+        self.size = size
+        self.timeout = timeout
+        self.max_files = max_files
+        self.files = OrderedDict()  # path -> _FilePool, least recently used first
+        self.stats = {"checkouts": 0, "waits": 0, "wait_time": 0.0, "max_wait": 0.0, "overflow": 0, "opened": 0, "closed": 0}
+        self._owners = {}  # id(checked out connection) -> its _FilePool, or None for overflow connections
+        self._cond = threading.Condition()
+
+    def _open(self, path):
+        conn = self.connect(path)
+        tune(conn)
+        conn.execute("PRAGMA query_only=1")
+        return conn
+
+    def checkout(self, path):
+        """Take a connection to `path`; give it back with checkin()."""
+        started = time.monotonic()
+        waited = False
+        with self._cond:
+            self.stats["checkouts"] += 1
+            while True:
+                pool = self.files.get(path)
+                if pool is None:
+                    pool = self.files[path] = _FilePool()
+                self.files.move_to_end(path)
+                if pool.idle:
+                    conn = pool.idle.pop()
+                    break
+                if pool.open < self.size:
+                    pool.open += 1
+                    conn = None
+                    break
+                remaining = self.timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    self.stats["overflow"] += 1
+                    pool, conn = None, None  # An extra connection, not counted against the pool
+                    break
+                waited = True
+                self._cond.wait(remaining)
+            if waited:
+                wait = time.monotonic() - started
+                self.stats["waits"] += 1
+                self.stats["wait_time"] += wait
+                self.stats["max_wait"] = max(self.stats["max_wait"], wait)
+            if conn is not None:
+                self._owners[id(conn)] = pool
+                return conn
+
+        try:
+            conn = self._open(path)
+        except Exception:
+            if pool is not None:
+                self._release(pool)
+            raise
+        with self._cond:
+            self.stats["opened"] += 1
+            self._owners[id(conn)] = pool
+        return conn
+
+    def checkin(self, path, conn, broken=False):
+        if not broken:
+            try:
+                conn.rollback()  # End any read transaction so WAL checkpoints can proceed
+            except sqlite3.Error:
+                broken = True
+        with self._cond:
+            pool = self._owners.pop(id(conn), None)
+            if broken or pool is None or self.files.get(path) is not pool:
+                # Broken, an overflow connection, or its file was discarded meanwhile
+                if pool is not None:
+                    pool.open -= 1
+                conn.close()
+                self.stats["closed"] += 1
+            else:
+                pool.idle.append(conn)
+                self._trim()
+            self._cond.notify_all()
+
+    def _release(self, pool):
+        with self._cond:
+            pool.open -= 1
+            self._cond.notify_all()
+
+    def _trim(self):
+        """Close idle connections of the least recently used files beyond max_files (lock held)."""
+        excess = len(self.files) - self.max_files
+        for path in list(self.files):
+            if excess <= 0:
+                break
+            pool = self.files[path]
+            for conn in pool.idle:
+                conn.close()
+                self.stats["closed"] += 1
+            pool.open -= len(pool.idle)
+            pool.idle.clear()
+            if not pool.open:
+                del self.files[path]
+                excess -= 1
+
+    def discard(self, path):
+        """Close the idle connections to a file that is about to be deleted; busy ones are closed on return."""
+        with self._cond:
+            pool = self.files.pop(path, None)
+            if pool is None:
+                return
+            for conn in pool.idle:
+                conn.close()
+                self.stats["closed"] += 1
+            pool.open -= len(pool.idle)
+            pool.idle.clear()
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            for path in list(self.files):
+                self.discard(path)
+
+    def metrics(self):
+        with self._cond:
+            snapshot = dict(self.stats)
+            snapshot["files"] = len(self.files)
+            snapshot["in_use"] = sum(pool.open - len(pool.idle) for pool in self.files.values())
+            snapshot["idle"] = sum(len(pool.idle) for pool in self.files.values())
+        snapshot["mean_wait"] = snapshot["wait_time"] / snapshot["waits"] if snapshot["waits"] else 0.0
+        return snapshot
+
+    @contextmanager
+    def connection(self, path):
+        """Context manager around checkout()/checkin()."""
+        conn = self.checkout(path)
+        broken = False
+        try:
+            yield conn
+        except sqlite3.DatabaseError:
+            broken = True
+            raise
+        finally:
+            self.checkin(path, conn, broken)
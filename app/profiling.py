@@ -0,0 +1,137 @@
+import cProfile
+import io
+import logging
+import pstats
+import threading
+import time
+import tracemalloc
+from app.config import PROFILE_MAX_SECONDS, PROFILE_TOP
+
+logger = logging.getLogger(__name__)
+
+KINDS = ("cpu", "memory")
+
+
+class Profiler:
+    """On-demand capture windows: cProfile over the ingest threads, or tracemalloc over the whole process.
+
+    cProfile only sees the thread that enabled it, so the pipeline threads
+    (ingest workers, the writer) call checkpoint() once per loop iteration;
+    while a CPU window is open each of them profiles itself and hands its
+    profile back when the window closes. Outside a window checkpoint() is one
+    attribute check. A thread that is idle when the window closes reports at
+    its next iteration, or not at all if that comes after the report is built.
+    From Python 3.12 only one profiler can be active in the interpreter, so
+    only the first thread to reach a checkpoint is profiled there; the report
+    names the threads it covers and those it had to skip.
+    """
+
+    def __init__(self, top=PROFILE_TOP):
+        self.top = top
+        self.kind = None  # Kind of the open window, or None
+        self.deadline = None  # time.monotonic() the open CPU window closes at
+        self.reports = {}  # kind -> report of the last finished window
+        self._window = 0  # Number of the current/last window, so late profiles of old ones are dropped
+        self._profiles = []  # (thread name, profile)
+        self._skipped = []  # Names of threads that could not be profiled in the current window
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def start(self, kind, seconds):
+        """Open a `kind` window for `seconds`; raises ValueError if one is already open."""
+        if kind not in KINDS:
+            raise ValueError(f"Unknown profile kind {kind!r} (expected one of {', '.join(KINDS)})")
+        seconds = min(float(seconds), PROFILE_MAX_SECONDS)
+        with self._lock:
+            if self.kind is not None:
+                raise ValueError(f"A {self.kind} profile is already running")
+            self.kind = kind
+            self._window += 1
+            self._profiles = []
+            self._skipped = []
+            started = time.time()
+            if kind == "cpu":
+                self.deadline = time.monotonic() + seconds
+            else:
+                tracemalloc.start()
+        logger.info("Started %s profile for %ss", kind, seconds)
+        # Leave the CPU threads a moment past the deadline to hand in their profiles
+        delay = seconds + 0.5 if kind == "cpu" else seconds
+        timer = threading.Timer(delay, self._finish, args=(kind, self._window, started, seconds))
+        timer.daemon = True
+        timer.start()
+
+    def checkpoint(self):
+        """Start or stop profiling the calling thread to follow the CPU window (pipeline loops call this)."""
+        local = self._local
+        profile = getattr(local, "profile", None)
+        if self.deadline is None and profile is None:
+            return
+        open_window = self.deadline is not None and time.monotonic() < self.deadline
+        if open_window and profile is None and getattr(local, "window", None) != self._window:
+            local.window = self._window  # One attempt per window
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except Exception as e:  # "Another profiling tool is already active" (Python 3.12+); never fail the pipeline
+                logger.debug("Not profiling %s: %s", threading.current_thread().name, e)
+                with self._lock:
+                    self._skipped.append(threading.current_thread().name)
+                return
+            local.profile = profile
+        elif not open_window and profile is not None:
+            profile.disable()
+            local.profile = None
+            with self._lock:
+                if local.window == self._window:
+                    self._profiles.append((threading.current_thread().name, profile))
+
+    def _finish(self, kind, window, started, seconds):
+        with self._lock:
+            profiles, self._profiles = self._profiles, []
+            skipped, self._skipped = self._skipped, []
+            self.deadline = None
+        report = {"kind": kind, "started": started, "seconds": seconds}
+        try:
+            if kind == "cpu":
+                report["threads"] = [name for name, _ in profiles]
+                report["skipped"] = skipped
+                report["text"] = self._cpu_report(profiles, skipped)
+            else:
+                snapshot = tracemalloc.take_snapshot()
+                report["text"] = self._memory_report(snapshot)
+        finally:
+            if kind == "memory":
+                tracemalloc.stop()
+            with self._lock:
+                self.reports[kind] = report
+                self.kind = None
+        logger.info("Finished %s profile", kind)
+
+    def _cpu_report(self, profiles, skipped):
+        out = io.StringIO()
+        if skipped:
+            out.write(f"Not profiled (only one profiler can be active at a time): {', '.join(sorted(skipped))}\n")
+        if not profiles:
+            out.write("No pipeline thread was profiled during the window.\n")
+            return out.getvalue()
+        out.write(f"Profiled threads: {', '.join(sorted(name for name, _ in profiles))}\n")
+        stats = pstats.Stats(*(profile for _, profile in profiles), stream=out)
+        stats.sort_stats("cumulative").print_stats(self.top)
+        return out.getvalue()
+
+    def _memory_report(self, snapshot):
+        # Allocations made during the window that are still alive at its end, by line
+        snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+        stats = snapshot.statistics("lineno")
+        total = sum(stat.size for stat in stats)
+        lines = [f"{total / 1024:.1f} KiB in {sum(stat.count for stat in stats)} blocks allocated and still live"]
+        lines.extend(str(stat) for stat in stats[:self.top])
+        return "\n".join(lines)
+
+    def status(self):
+        with self._lock:
+            return {"running": self.kind, "reports": dict(self.reports)}
+
+
+profiler = Profiler()
@@ -0,0 +1,83 @@
+import json
+import logging
+import threading
+from urllib.error import URLError
+from urllib.request import urlopen
+from app.cache import REWRITE, query_cache
+from app.config import LIVE_POLL_TIMEOUT, MQTT_RECONNECT_MIN_DELAY, MQTT_RECONNECT_MAX_DELAY
+from app.mqtt_client import CallbackDispatcher
+from app.topic_tree import TopicMatcher
+
+logger = logging.getLogger(__name__)
+
+
+class RemoteFeed:
+    """Live messages from an ingest daemon's read API, in place of a broker subscription.
+
+    Offers the subscribe/unsubscribe/dispatcher surface of MQTTClient that the
+    GUI pages use. Every message captured by the daemon is long-polled from
+    /live and matched against the registered filters locally; the QoS given to
+    subscribe() is ignored since the daemon owns the broker subscription.
+
+    The daemon does the writing, so each poll also carries the reader cache
+    watermarks the daemon's commits moved since the last one, and they are
+    moved here in turn.
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.callbacks = TopicMatcher()
+        self.dispatcher = CallbackDispatcher()
+        self.seq = None
+        self.version = None  # The daemon's cache watermark version as of the last poll
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._poll, name="remote-feed", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def subscribe(self, topic, callback, qos=0):
+        if callback not in self.callbacks.filters(topic):
+            self.callbacks.add(topic, callback)
+
+    def unsubscribe(self, topic, callback=None):
+        callbacks = [callback] if callback is not None else self.callbacks.filters(topic)
+        for registered in callbacks:
+            self.callbacks.remove(topic, registered)
+
+    def _poll(self):
+        delay = MQTT_RECONNECT_MIN_DELAY
+        while not self._stopping.is_set():
+            # The first request only fetches the daemon's current position; history is in the database
+            query = f"?after={self.seq}&version={self.version}" if self.seq is not None else ""
+            try:
+                with urlopen(f"{self.url}/live{query}", timeout=LIVE_POLL_TIMEOUT + 10) as response:
+                    body = json.load(response)
+            except (URLError, OSError, ValueError) as e:
+                logger.warning("Ingest daemon at %s unreachable (%s); retrying in %ss", self.url, e, delay)
+                self._stopping.wait(delay)
+                delay = min(delay * 2, MQTT_RECONNECT_MAX_DELAY)
+                continue
+            delay = MQTT_RECONNECT_MIN_DELAY
+
+            if self.seq is None or body["seq"] < self.seq or body["version"] < self.version:
+                # First poll, or the daemon restarted and what it committed in between is unknown
+                if self.seq is not None:
+                    query_cache.bump([REWRITE])
+                self.seq, self.version = body["seq"], body["version"]
+                continue
+            if body["missed"]:
+                logger.warning("Missed %s live messages from the ingest daemon", body['missed'])
+            for seq, topic, payload in body["messages"]:
+                for callback in self.callbacks.match(topic):
+                    self.dispatcher.put(callback, payload, topic)
+            # JSON turns the (kind, name) watermarks into lists
+            query_cache.bump([tuple(name) if isinstance(name, list) else name for name in body["moved"]])
+            self.seq, self.version = body["seq"], body["version"]
@@ -0,0 +1,193 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from app.config import (
+    DATABASE_PATH,
+    RETENTION_POLICIES,
+    ROLLUP_RETENTION,
+    COMPACTION_INTERVAL,
+    BACKFILL_CHUNK_SIZE,
+)
+from app.partitions import DAY, list_partition_days, partition_day, partition_path, readers
+from app.topic_tree import TopicMatcher
+from app.cache import REWRITE, query_cache
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionPolicy:
+    """How long raw rows of each topic are kept, from (topic filter, days) rules; the first match wins."""
+
+    def __init__(self, rules=RETENTION_POLICIES):
+        self.matcher = TopicMatcher()
+        self.rules = list(rules)
+        for index, (topic_filter, days) in enumerate(self.rules):
+            self.matcher.add(topic_filter, index)
+
+    def days(self, topic):
+        """Days to keep `topic`'s raw rows, or None to keep them forever."""
+        matches = self.matcher.match(topic)
+        return self.rules[min(matches)][1] if matches else None
+
+    def cutoff(self, topic, now):
+        """Epoch seconds before which `topic`'s raw rows have expired, or None."""
+        days = self.days(topic)
+        return now - days * DAY if days is not None else None
+
+    def longest(self):
+        """Retention of the longest-lived topic, or None if any topic is kept forever.
+
+        Filters match only what they name, so unless a `#` rule exists some
+        topic may match nothing and is kept forever.
+        """
+        if not any(topic_filter == "#" for topic_filter, _ in self.rules):
+            return None
+        days = [days for _, days in self.rules]
+        return None if None in days else max(days)
+
+
+def rollup_cutoff(resolution, now=None):
+    """Epoch seconds before which `resolution`-second rollup buckets are deleted, or None."""
+    days = dict(ROLLUP_RETENTION).get(resolution)
+    return (now or time.time()) - days * DAY if days is not None else None
+
+
+def _remove_partition(day):
+    path = partition_path(day)
+    readers.discard(path)
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+    logger.info("Dropped expired partition %s", os.path.basename(path))
+
+
+def _delete_chunked(conn, where, params, table="mqtt_data"):
+    """Delete matching rows a chunk per transaction so readers and the writer are never blocked for long."""
+    deleted = 0
+    while True:
+        with conn:
+            count = conn.execute(
+                f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE {where} LIMIT ?)",
+                list(params) + [BACKFILL_CHUNK_SIZE],
+            ).rowcount
+        deleted += count
+        if count < BACKFILL_CHUNK_SIZE:
+            return deleted
+
+
+def compact_partitions(policy, now):
+    """Apply raw-row retention to day partitions; returns (partitions dropped, rows deleted).
+
+    A partition every topic has expired from is deleted as a file, without
+    opening it. Partitions that only some topics have expired from lose those
+    topics' rows and are vacuumed, which only locks that one small file. The
+    current and previous day are left alone while the writer may have them open.
+    """
+    longest = policy.longest()
+    dropped = deleted = 0
+    for day in list_partition_days():
+        day_end = (day + 1) * DAY
+        if day >= partition_day(now) - 1:
+            break
+        if longest is not None and day_end <= now - longest * DAY:
+            _remove_partition(day)
+            dropped += 1
+            continue
+
+        conn = sqlite3.connect(partition_path(day), timeout=30)
+        try:
+            topics = [row[0] for row in conn.execute("SELECT DISTINCT topic FROM mqtt_data")]
+            cutoffs = {topic: policy.cutoff(topic, now) for topic in topics}
+            expired = bool(topics) and all(cutoff is not None and cutoff >= day_end for cutoff in cutoffs.values())
+            if not expired:
+                removed = 0
+                for topic, cutoff in cutoffs.items():
+                    if cutoff is not None and cutoff > day * DAY:
+                        removed += _delete_chunked(conn, "topic = ? AND received_time < ?", (topic, cutoff))
+                deleted += removed
+                expired = conn.execute("SELECT 1 FROM mqtt_data LIMIT 1").fetchone() is None
+                if removed and not expired:
+                    conn.execute("VACUUM")
+        finally:
+            conn.close()
+        if expired:
+            _remove_partition(day)
+            dropped += 1
+    return dropped, deleted
+
+
+def compact_main(policy, now, database_path=DATABASE_PATH):
+    """Expire rows of the pre-partitioning mqtt_data table and old rollup buckets; returns rows deleted.
+
+    Raw rows are only removed once the backfills have folded them into the
+    latency_stats and latency_rollup summaries and the archive.
+    """
+    conn = sqlite3.connect(database_path, timeout=30)
+    try:
+        deleted = 0
+        pending = {name for (name,) in conn.execute("SELECT name FROM backfill_progress WHERE done = 0")}
+        if _archive_backend() is None:
+            pending.discard("archive_legacy")  # Nothing will ever archive them
+        if not pending:
+            for (topic,) in conn.execute("SELECT topic FROM topics").fetchall():
+                cutoff = policy.cutoff(topic, now)
+                if cutoff is not None:
+                    deleted += _delete_chunked(conn, "topic = ? AND received_time < ?", (topic, cutoff))
+
+        for resolution, _ in ROLLUP_RETENTION:
+            cutoff = rollup_cutoff(resolution, now)
+            if cutoff is not None:
+                deleted += _delete_chunked(
+                    conn, "resolution = ? AND bucket_start < ?", (resolution, cutoff), table="latency_rollup"
+                )
+        return deleted
+    finally:
+        conn.close()
+
+
+def _archive_backend():
+    try:
+        from app.archive import backend
+    except ImportError:
+        return None  # numpy is not installed
+    return backend()
+
+
+def compact(now=None):
+    """One retention pass over the partitions, the main database and the archive."""
+    now = time.time() if now is None else now
+    policy = RetentionPolicy()
+    dropped, deleted = compact_partitions(policy, now)
+    deleted += compact_main(policy, now)
+    if _archive_backend() is not None:
+        from app.archive import compact_archive
+        files, rows = compact_archive(policy, now)  # Same rules, so archived history expires with the partitions
+        dropped += files
+        deleted += rows
+    if dropped or deleted:
+        query_cache.bump([REWRITE])
+        logger.info("Compaction dropped %s partitions or archive files and deleted %s rows", dropped, deleted)
+    return dropped, deleted
+
+
+def start_compaction(interval=COMPACTION_INTERVAL):
+    """Archive closed partitions and run compact() now and every `interval` seconds on a background thread."""
+    def run():
+        while True:
+            try:
+                if _archive_backend() is not None:
+                    from app.archive import archive_partitions
+                    archive_partitions(time.time())  # Before compaction may drop the partitions
+                compact()
+            except Exception:
+                # Archive I/O and numpy errors too; the next pass tries again
+                logger.exception("Compaction failed")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name="db-compaction", daemon=True)
+    thread.start()
+    return thread
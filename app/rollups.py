@@ -0,0 +1,107 @@
+import sqlite3
+from app.config import DATABASE_PATH, ROLLUP_RESOLUTIONS
+from app.writer import WriterHook
+from app.migrations import chunked_backfill
+from app.stats import DDSketch
+
+
+class RollupBucket:
+    """Aggregate of the messages of one (resolution, topic, QoS, bucket_start)."""
+
+    __slots__ = ("count", "min", "max", "sum", "jitter_sum", "jitter_count", "packet_sum", "sketch")
+
+    def __init__(self):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+        self.jitter_sum = 0.0
+        self.jitter_count = 0
+        self.packet_sum = 0
+        self.sketch = DDSketch()
+
+    def add(self, latency, jitter, packet_size):
+        self.count += 1
+        self.min = latency if self.min is None else min(self.min, latency)
+        self.max = latency if self.max is None else max(self.max, latency)
+        self.sum += latency
+        if jitter is not None:
+            self.jitter_sum += jitter
+            self.jitter_count += 1
+        self.packet_sum += packet_size or 0
+        self.sketch.add(latency)
+
+
+def aggregate(rows, resolutions=ROLLUP_RESOLUTIONS):
+    """Bucket (topic, qos, received_time, latency, jitter, packet_size) tuples at every resolution."""
+    buckets = {}
+    for topic, qos, received_time, latency, jitter, packet_size in rows:
+        if latency is None or received_time is None:
+            continue
+        for resolution in resolutions:
+            key = (resolution, topic, qos, int(received_time // resolution) * resolution)
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = RollupBucket()
+            bucket.add(latency, jitter, packet_size)
+    return buckets
+
+
+def merge_buckets(conn, buckets):
+    """Add bucket aggregates into latency_rollup, merging quantile sketches in Python."""
+    for (resolution, topic, qos, bucket_start), bucket in buckets.items():
+        existing = conn.execute("""
+            SELECT sketch FROM latency_rollup
+            WHERE resolution = ? AND topic = ? AND qos_level = ? AND bucket_start = ?
+        """, (resolution, topic, qos, bucket_start)).fetchone()
+        sketch = bucket.sketch
+        if existing is not None:
+            sketch = DDSketch.from_json(existing[0])
+            sketch.merge(bucket.sketch)
+
+        conn.execute("""
+            INSERT INTO latency_rollup (resolution, topic, qos_level, bucket_start, count, min_latency, max_latency,
+                                        sum_latency, jitter_sum, jitter_count, packet_size_sum, sketch)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(resolution, topic, qos_level, bucket_start) DO UPDATE SET
+                count = count + excluded.count,
+                min_latency = MIN(COALESCE(min_latency, excluded.min_latency), excluded.min_latency),
+                max_latency = MAX(COALESCE(max_latency, excluded.max_latency), excluded.max_latency),
+                sum_latency = sum_latency + excluded.sum_latency,
+                jitter_sum = jitter_sum + excluded.jitter_sum,
+                jitter_count = jitter_count + excluded.jitter_count,
+                packet_size_sum = packet_size_sum + excluded.packet_size_sum,
+                sketch = excluded.sketch
+        """, (resolution, topic, qos, bucket_start, bucket.count, bucket.min, bucket.max, bucket.sum,
+              bucket.jitter_sum, bucket.jitter_count, bucket.packet_sum, sketch.to_json()))
+
+
+class RollupHook(WriterHook):
+    """Writer hook that maintains latency_rollup for every batch; runs after StatsEngine fills jitter."""
+
+    def before_insert(self, conn, rows):
+        merge_buckets(conn, aggregate(
+            (row["topic"], row["qos_level"], row["received_time"], row["latency"], row["jitter"], row["packet_size"])
+            for row in rows
+        ))
+        return rows
+
+
+def backfill_rollups(database_path=DATABASE_PATH):
+    """Build rollups for rows stored before schema version 3."""
+    conn = sqlite3.connect(database_path, timeout=30)
+    try:
+        chunked_backfill(conn, "latency_rollup", """
+            SELECT id, topic, qos_level, received_time, latency, jitter, packet_size FROM mqtt_data
+            WHERE id > ? AND id <= ? ORDER BY id LIMIT ?
+        """, lambda conn, rows: merge_buckets(conn, aggregate(row[1:] for row in rows)))
+    finally:
+        conn.close()
+
+
+def choose_resolution(span, target_points, resolutions=ROLLUP_RESOLUTIONS):
+    """Finest resolution that covers `span` seconds in at most target_points buckets."""
+    for resolution in sorted(resolutions):
+        if span / resolution <= target_points:
+            return resolution
+    return max(resolutions)
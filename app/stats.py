@@ -0,0 +1,302 @@
+import json
+import math
+import sqlite3
+import time
+from app.config import DATABASE_PATH, SKETCH_RELATIVE_ACCURACY, SKETCH_MAX_BINS
+from app.writer import WriterHook
+from app.migrations import chunked_backfill
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class DDSketch:
+    """Quantile sketch with bounded relative error (DDSketch).
+
+    Values are counted in logarithmic bins, so two sketches merge by adding
+    bin counts. Negative values (possible under clock skew) get their own bins.
+    """
+
+    def __init__(self, relative_accuracy=SKETCH_RELATIVE_ACCURACY, max_bins=SKETCH_MAX_BINS):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+        self.count = 0
+
+    # Values closer to zero than this are counted as zero
+    MIN_VALUE = 1e-9
+
+    def _key(self, value):
+        return math.ceil(math.log(value) / self.log_gamma)
+
+    def _value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value, count=1):
+        if value > self.MIN_VALUE:
+            bins = self.positive
+            key = self._key(value)
+        elif value < -self.MIN_VALUE:
+            bins = self.negative
+            key = self._key(-value)
+        else:
+            self.zero_count += count
+            self.count += count
+            return
+        bins[key] = bins.get(key, 0) + count
+        self.count += count
+        if len(bins) > self.max_bins:
+            self._collapse(bins)
+
+    def _collapse(self, bins):
+        """Fold the smallest-magnitude bins together to respect max_bins."""
+        keys = sorted(bins)
+        excess = keys[:len(keys) - self.max_bins + 1]
+        folded = sum(bins.pop(key) for key in excess)
+        bins[excess[-1]] = folded
+
+    def merge(self, other):
+        for key, count in other.positive.items():
+            self.positive[key] = self.positive.get(key, 0) + count
+        for key, count in other.negative.items():
+            self.negative[key] = self.negative.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        for bins in (self.positive, self.negative):
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self._value(key)
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self._value(key)
+        return self._value(max(self.positive)) if self.positive else 0.0
+
+    def to_json(self):
+        return json.dumps({
+            "a": self.relative_accuracy,
+            "p": self.positive,
+            "n": self.negative,
+            "z": self.zero_count,
+        })
+
+    @classmethod
+    def from_json(cls, text):
+        raw = json.loads(text)
+        sketch = cls(relative_accuracy=raw["a"])
+        sketch.positive = {int(k): v for k, v in raw["p"].items()}
+        sketch.negative = {int(k): v for k, v in raw["n"].items()}
+        sketch.zero_count = raw["z"]
+        sketch.count = sketch.zero_count + sum(sketch.positive.values()) + sum(sketch.negative.values())
+        return sketch
+
+
+class LatencySummary:
+    """Count, Welford mean/variance, min/max and a quantile sketch for one (topic, QoS) pair."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.sketch = DDSketch()
+
+    def add(self, latency):
+        self.count += 1
+        delta = latency - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (latency - self.mean)
+        self.min = latency if self.min is None else min(self.min, latency)
+        self.max = latency if self.max is None else max(self.max, latency)
+        self.sketch.add(latency)
+
+    def merge(self, other):
+        """Combine two summaries (Chan et al. parallel variance)."""
+        if other.count == 0:
+            return
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / total
+        self.m2 += other.m2 + delta * delta * self.count * other.count / total
+        self.count = total
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.sketch.merge(other.sketch)
+
+    @property
+    def stddev(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+
+def _update_jitter(state, latency):
+    """RFC 3550 interarrival jitter: J += (|D| - J) / 16, D being the change in transit time."""
+    previous = state["last_latency"]
+    if previous is not None:
+        state["jitter"] += (abs(latency - previous) - state["jitter"]) / 16
+    state["last_latency"] = latency
+    return previous
+
+
+def _load_summary(conn, topic, qos):
+    row = conn.execute("""
+        SELECT count, mean, m2, min_latency, max_latency, sketch FROM latency_stats
+        WHERE topic = ? AND qos_level = ?
+    """, (topic, qos)).fetchone()
+    summary = LatencySummary()
+    if row is not None:
+        summary.count, summary.mean, summary.m2, summary.min, summary.max = row[:5]
+        summary.sketch = DDSketch.from_json(row[5])
+    return summary
+
+
+def merge_into_table(conn, deltas, continuity):
+    """Fold per-key batch summaries into latency_stats.
+
+    `continuity` maps each key to its latest jitter state; the stored jitter is
+    only replaced by a state that is at least as recent.
+    """
+    for (topic, qos), delta in deltas.items():
+        summary = _load_summary(conn, topic, qos)
+        summary.merge(delta)
+        state = continuity[(topic, qos)]
+        conn.execute("""
+            INSERT INTO latency_stats (topic, qos_level, count, mean, m2, min_latency, max_latency, sketch,
+                                       jitter, last_latency, last_time, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(topic, qos_level) DO UPDATE SET
+                count = excluded.count, mean = excluded.mean, m2 = excluded.m2,
+                min_latency = excluded.min_latency, max_latency = excluded.max_latency,
+                sketch = excluded.sketch, updated_at = excluded.updated_at,
+                jitter = CASE WHEN last_time IS NULL OR excluded.last_time >= last_time THEN excluded.jitter ELSE jitter END,
+                last_latency = CASE WHEN last_time IS NULL OR excluded.last_time >= last_time THEN excluded.last_latency ELSE last_latency END,
+                last_time = MAX(COALESCE(last_time, excluded.last_time), COALESCE(excluded.last_time, last_time))
+        """, (topic, qos, summary.count, summary.mean, summary.m2, summary.min, summary.max,
+              summary.sketch.to_json(), state["jitter"], state["last_latency"], state["last_time"], time.time()))
+
+
+class StatsEngine(WriterHook):
+    """Writer hook that fills jitter/previous_latency and keeps latency_stats current.
+
+    Jitter is carried across batches in memory per (topic, QoS), seeded from
+    latency_stats the first time a key is seen. With `shared` (other
+    processes store the same topics) it is seeded again in every batch.
+    """
+
+    def __init__(self, shared=False):
+        self.shared = shared
+        self.continuity = {}
+        self._undo = {}
+
+    def _state(self, conn, key):
+        state = self.continuity.get(key)
+        if state is None:
+            row = conn.execute(
+                "SELECT jitter, last_latency, last_time FROM latency_stats WHERE topic = ? AND qos_level = ?", key
+            ).fetchone()
+            jitter, last_latency, last_time = row if row else (0.0, None, None)
+            state = {"jitter": jitter or 0.0, "last_latency": last_latency, "last_time": last_time}
+            self.continuity[key] = state
+        return state
+
+    def before_insert(self, conn, rows):
+        self._undo = {}
+        if self.shared:
+            self.continuity.clear()
+        deltas = {}
+        for row in rows:
+            latency = row["latency"]
+            if latency is None:
+                continue
+            key = (row["topic"], row["qos_level"])
+            state = self._state(conn, key)
+            if key not in self._undo:
+                self._undo[key] = dict(state)
+
+            row["previous_latency"] = _update_jitter(state, latency)
+            row["jitter"] = state["jitter"]
+            state["last_time"] = row["received_time"]
+
+            delta = deltas.get(key)
+            if delta is None:
+                delta = deltas[key] = LatencySummary()
+            delta.add(latency)
+
+        merge_into_table(conn, deltas, self.continuity)
+        return rows
+
+    def rollback(self):
+        self.continuity.update(self._undo)
+        self._undo = {}
+
+
+def backfill_latency_stats(database_path=DATABASE_PATH):
+    """Compute jitter for rows stored before schema version 2 and seed latency_stats from them."""
+    conn = sqlite3.connect(database_path, timeout=30)
+    try:
+        progress = conn.execute(
+            "SELECT last_id, done FROM backfill_progress WHERE name = 'latency_stats'"
+        ).fetchone()
+        if progress is None or progress[1]:
+            return
+
+        # Resume jitter from rows already converted by an interrupted run
+        continuity = {}
+        for topic, qos, jitter, latency, received_time in conn.execute("""
+            SELECT m.topic, m.qos_level, m.jitter, m.latency, m.received_time FROM mqtt_data m
+            JOIN (SELECT MAX(id) AS id FROM mqtt_data WHERE id <= ? AND latency IS NOT NULL
+                  GROUP BY topic, qos_level) latest ON latest.id = m.id
+        """, (progress[0],)):
+            continuity[(topic, qos)] = {"jitter": jitter or 0.0, "last_latency": latency, "last_time": received_time}
+
+        def process_chunk(conn, rows):
+            deltas, updates = {}, []
+            for row_id, topic, qos, latency, received_time in rows:
+                if latency is None:
+                    continue
+                key = (topic, qos)
+                state = continuity.setdefault(key, {"jitter": 0.0, "last_latency": None, "last_time": None})
+                previous = _update_jitter(state, latency)
+                state["last_time"] = received_time
+                updates.append((state["jitter"], previous, row_id))
+                deltas.setdefault(key, LatencySummary()).add(latency)
+            conn.executemany("UPDATE mqtt_data SET jitter = ?, previous_latency = ? WHERE id = ?", updates)
+            merge_into_table(conn, deltas, continuity)
+
+        chunked_backfill(conn, "latency_stats", """
+            SELECT id, topic, qos_level, latency, received_time FROM mqtt_data
+            WHERE id > ? AND id <= ? ORDER BY id LIMIT ?
+        """, process_chunk)
+    finally:
+        conn.close()
+
+
+def summary_to_dict(topic, qos, summary, jitter):
+    stats = {
+        "topic": topic,
+        "qos_level": qos,
+        "count": summary.count,
+        "mean": summary.mean,
+        "stddev": summary.stddev,
+        "min": summary.min,
+        "max": summary.max,
+        "jitter": jitter,
+    }
+    for q in QUANTILES:
+        stats[f"p{round(q * 100)}"] = summary.sketch.quantile(q)
+    return stats
@@ -0,0 +1,255 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from app.config import TIME_SYNC_TOPIC, TIME_SYNC_WINDOW, TIME_SYNC_MIN_SPAN, TIME_SYNC_MAX_AGE, TIME_SYNC_RELOAD
+from app.config import TIME_SYNC_MAX_LOADED
+from app.metrics import registry
+from app.timeutil import NS_PER_SECOND
+from app.writer import WriterHook
+
+logger = logging.getLogger(__name__)
+
+# Probe exchange, NTP style, over {TIME_SYNC_TOPIC}/<client id>/...:
+#   publisher -> ping   {"t0": its send time}
+#   app       -> pong   {"t0", "t1": our receive time, "t2": our send time, "server": our id}
+#   publisher -> result {"t0", "t1", "t2", "t3": its receive time of the pong, "server"}
+# All times are integer epoch nanoseconds on the clock of whoever took them.
+
+
+def probe_sample(t0, t1, t2, t3):
+    """(offset, round trip) in ns of one exchange; offset is our clock minus the publisher's."""
+    return ((t1 - t0) + (t2 - t3)) / 2, (t3 - t0) - (t2 - t1)
+
+
+class ClockModel:
+    """Offset and drift of one publisher's clock relative to ours, fitted to its recent probes.
+
+    A probe's offset is off by at most half its round trip, and queueing
+    delays make some round trips much longer than others, so only the faster
+    half of the window is fitted. The offset is a least-squares line over
+    time once the probes span TIME_SYNC_MIN_SPAN seconds, otherwise that of
+    the fastest probe. The error bound is half the fastest round trip plus
+    the largest distance of a fitted probe from the line.
+    """
+
+    def __init__(self, window=TIME_SYNC_WINDOW):
+        self.samples = deque(maxlen=window)  # (our time ns, offset ns, round trip ns)
+        self.reference = None  # Our time (ns) the offset below applies at
+        self.offset = 0.0  # ns
+        self.drift = 0.0  # ns of offset per ns
+        self.error = None  # ns
+        self.updated = None  # Our time (ns) of the newest probe
+
+    def add(self, t0, t1, t2, t3):
+        offset, rtt = probe_sample(t0, t1, t2, t3)
+        if rtt < 0:
+            return False  # Not a consistent exchange (clock stepped mid-probe)
+        self.samples.append(((t1 + t2) / 2, offset, rtt))
+        self.updated = t2
+        self._fit()
+        return True
+
+    def _fit(self):
+        fast = sorted(self.samples, key=lambda sample: sample[2])[:max(2, (len(self.samples) + 1) // 2)]
+        times = [sample[0] for sample in fast]
+        if len(fast) >= 2 and max(times) - min(times) >= TIME_SYNC_MIN_SPAN * NS_PER_SECOND:
+            mean_time = sum(times) / len(fast)
+            mean_offset = sum(sample[1] for sample in fast) / len(fast)
+            spread = sum((t - mean_time) ** 2 for t in times)
+            self.drift = sum((t - mean_time) * (sample[1] - mean_offset) for t, sample in zip(times, fast)) / spread
+            self.reference, self.offset = mean_time, mean_offset
+        else:
+            self.reference, self.offset, self.drift = fast[0][0], fast[0][1], 0.0
+        residual = max(abs(sample[1] - self.offset_at(sample[0])) for sample in fast)
+        self.error = fast[0][2] / 2 + residual
+
+    def offset_at(self, at_ns):
+        return self.offset + self.drift * (at_ns - self.reference)
+
+    def to_row(self):
+        return (self.reference, self.offset, self.drift, self.error, self.updated, len(self.samples))
+
+    @classmethod
+    def from_row(cls, row):
+        model = cls()
+        model.reference, model.offset, model.drift, model.error, model.updated, _ = row
+        return model
+
+
+class ClockSync:
+    """Answers publishers' clock probes and keeps a ClockModel per client id."""
+
+    def __init__(self, topic=TIME_SYNC_TOPIC, max_age=TIME_SYNC_MAX_AGE, reload=TIME_SYNC_RELOAD,
+                 max_loaded=TIME_SYNC_MAX_LOADED):
+        self.topic = topic
+        self.max_age = max_age
+        self.reload = reload
+        self.max_loaded = max_loaded
+        self.server = uuid.uuid4().hex[:12]  # Tells our pongs apart from other apps' on the same broker
+        self.models = {}  # client id -> ClockModel
+        # client id -> time.monotonic() its stored model (or its absence) was read, least recently used first
+        self.loaded = OrderedDict()
+        self.dirty = set()  # Client ids whose model changed since it was last stored
+        self.stats = {"pings": 0, "samples": 0, "rejected": 0}
+        self._lock = threading.Lock()
+
+    def filters(self):
+        return [f"{self.topic}/+/ping", f"{self.topic}/+/result"]
+
+    def is_reserved(self, topic):
+        """True for every topic of the probe exchange, including our own pongs; none of them are stored."""
+        return topic == self.topic or topic.startswith(f"{self.topic}/")
+
+    def is_probe(self, topic):
+        parts = topic.split("/")
+        return len(parts) == 3 and parts[0] == self.topic and parts[2] in ("ping", "result")
+
+    def handle(self, topic, payload, received_ns, publish):
+        """Process a probe message received at `received_ns`; False if `topic` is not a probe topic.
+
+        Runs on the MQTT network thread so the pong goes out without queueing
+        behind ingest; `publish(topic, payload)` sends it.
+        """
+        if not self.is_probe(topic):
+            return False
+        parts = topic.split("/")
+        client_id = parts[1]
+        try:
+            message = json.loads(payload)
+            if parts[2] == "ping":
+                reply = {"t0": int(message["t0"]), "t1": received_ns, "server": self.server}
+                reply["t2"] = time.time_ns()
+                publish(f"{self.topic}/{client_id}/pong", json.dumps(reply))
+                self.stats["pings"] += 1
+            elif message.get("server") == self.server:
+                self.add_sample(client_id, *(int(message[name]) for name in ("t0", "t1", "t2", "t3")))
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning("Malformed time sync message on %s: %s", topic, e)
+        return True
+
+    def add_sample(self, client_id, t0, t1, t2, t3):
+        with self._lock:
+            model = self.models.get(client_id)
+            if model is None or not model.samples:
+                model = self.models[client_id] = ClockModel()  # Stored estimates are replaced by live probes
+            if model.add(t0, t1, t2, t3):
+                self.dirty.add(client_id)
+                self.stats["samples"] += 1
+            else:
+                self.stats["rejected"] += 1
+
+    def estimate(self, client_id, at_ns, conn=None):
+        """(offset ns, error ns) to add to `client_id`'s timestamps taken around `at_ns`, or None.
+
+        Models not probed in this process are loaded from clock_offsets
+        through `conn`, and loaded again after `reload` seconds in case
+        another process keeps them current. Only the `max_loaded` most
+        recently used loads (found or not) are remembered. Estimates whose
+        newest probe is older than `max_age` seconds are not used.
+        """
+        with self._lock:
+            model = self.models.get(client_id)
+            loaded = self.loaded.get(client_id)
+            if loaded is not None:
+                self.loaded.move_to_end(client_id)
+            stale = (model is None or not model.samples) and (loaded is None or time.monotonic() - loaded >= self.reload)
+        if stale and conn is not None:
+            row = conn.execute("""
+                SELECT reference, offset, drift, error, updated, samples FROM clock_offsets WHERE client_id = ?
+            """, (client_id,)).fetchone()
+            with self._lock:
+                model = self.models.get(client_id)
+                if model is None or not model.samples:  # Not replaced by a live probe meanwhile
+                    model = ClockModel.from_row(row) if row else None
+                    if model is not None:
+                        self.models[client_id] = model
+                    else:
+                        self.models.pop(client_id, None)
+                    self.loaded[client_id] = time.monotonic()
+                    self.loaded.move_to_end(client_id)
+                    while len(self.loaded) > self.max_loaded:
+                        evicted, _ = self.loaded.popitem(last=False)
+                        stored = self.models.get(evicted)
+                        if stored is not None and not stored.samples:
+                            del self.models[evicted]  # Read again from clock_offsets when next needed
+        if model is None or model.reference is None or at_ns - model.updated > self.max_age * NS_PER_SECOND:
+            return None
+        with self._lock:
+            return model.offset_at(at_ns), model.error
+
+    def take_dirty(self):
+        """Stored-form rows of the models changed since the last call."""
+        with self._lock:
+            dirty, self.dirty = self.dirty, set()
+            return [(client_id, *self.models[client_id].to_row()) for client_id in dirty]
+
+    def mark_dirty(self, client_ids):
+        """Store these models again with the next batch (their last write was rolled back)."""
+        with self._lock:
+            self.dirty.update(client_ids)
+
+    def metrics(self):
+        with self._lock:
+            snapshot = dict(self.stats)
+            snapshot["clients"] = {
+                client_id: {
+                    "offset": model.offset_at(time.time_ns()) / NS_PER_SECOND,
+                    "drift_ppm": model.drift * 1e6,
+                    "error": model.error / NS_PER_SECOND,
+                    "samples": len(model.samples),
+                }
+                for client_id, model in self.models.items() if model.reference is not None
+            }
+        return snapshot
+
+
+clock_sync = ClockSync()
+registry.gauge("iot_clock_offset_seconds", "Estimated offset added to each publisher's clock", ("client",),
+               function=lambda: {(client,): model["offset"] for client, model in clock_sync.metrics()["clients"].items()})
+registry.gauge("iot_clock_error_seconds", "Error bound of each publisher's clock offset", ("client",),
+               function=lambda: {(client,): model["error"] for client, model in clock_sync.metrics()["clients"].items()})
+registry.counter("iot_clock_probes_total", "Time sync probe messages by kind", ("kind",),
+                 function=lambda: {(kind,): count for kind, count in clock_sync.stats.items()})
+
+
+class ClockCorrector(WriterHook):
+    """Writer hook that corrects the latency of rows from synced publishers and stores their clock models.
+
+    Runs before StatsEngine so jitter, summaries and rollups all see the
+    corrected latency. A row's `clock_offset` (seconds added to its send
+    time) and `latency_error` record what was applied; rows that already
+    have an offset are left alone, so a retried batch is not corrected twice.
+    """
+
+    def __init__(self, sync=clock_sync):
+        self.sync = sync
+        self._stored = []
+
+    def before_insert(self, conn, rows):
+        for row in rows:
+            if row.get("client_id") is None or row["clock_offset"] is not None or row["sent_ns"] is None:
+                continue
+            estimate = self.sync.estimate(row["client_id"], row["received_ns"], conn)
+            if estimate is None:
+                continue
+            offset, error = estimate
+            row["clock_offset"] = offset / NS_PER_SECOND
+            row["latency_error"] = error / NS_PER_SECOND
+            row["latency"] = (row["received_ns"] - row["sent_ns"] - offset) / NS_PER_SECOND
+
+        self._stored = self.sync.take_dirty()
+        conn.executemany("""
+            INSERT INTO clock_offsets (client_id, reference, offset, drift, error, updated, samples)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(client_id) DO UPDATE SET
+                reference = excluded.reference, offset = excluded.offset, drift = excluded.drift,
+                error = excluded.error, updated = excluded.updated, samples = excluded.samples
+        """, self._stored)
+        return rows
+
+    def rollback(self):
+        self.sync.mark_dirty(row[0] for row in self._stored)
+        self._stored = []
@@ -0,0 +1,55 @@
+import time
+from datetime import datetime
+from functools import lru_cache
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+NS_PER_SECOND = 1_000_000_000
+
+# Layout of TIMESTAMP_FORMAT: "YYYY-MM-DD HH:MM:SS.ffffff"
+_SEPARATORS = ((4, "-"), (7, "-"), (10, " "), (13, ":"), (16, ":"), (19, "."))
+
+
+@lru_cache(maxsize=1024)
+def _minute_start(prefix):
+    """Epoch seconds of the local-time minute "YYYY-MM-DD HH:MM".
+
+    UTC offsets change on whole minutes (some zones shift by 30 or 45), so
+    every timestamp within the minute is this value plus its seconds.
+    """
+    return datetime(int(prefix[0:4]), int(prefix[5:7]), int(prefix[8:10]),
+                    int(prefix[11:13]), int(prefix[14:16])).timestamp()
+
+
+def parse_timestamp_ns(value):
+    """Convert a local-time TIMESTAMP_FORMAT string to integer epoch nanoseconds, or None if it is malformed.
+
+    The fixed layout is sliced directly and the minute's epoch is cached, so a
+    stream of messages costs a few int() calls each instead of a strptime.
+    """
+    try:
+        if len(value) != 26 or any(value[i] != sep for i, sep in _SEPARATORS):
+            parsed = datetime.strptime(value, TIMESTAMP_FORMAT)
+            return int(parsed.replace(microsecond=0).timestamp()) * NS_PER_SECOND + parsed.microsecond * 1000
+        seconds, micros = int(value[17:19]), int(value[20:26])
+        if seconds > 59:
+            return None
+        return (int(_minute_start(value[:16])) + seconds) * NS_PER_SECOND + micros * 1000
+    except (ValueError, TypeError):
+        return None
+
+
+def parse_timestamp(value):
+    """Convert a local-time TIMESTAMP_FORMAT string to epoch seconds, or None if it is malformed."""
+    epoch_ns = parse_timestamp_ns(value)
+    return epoch_ns / NS_PER_SECOND if epoch_ns is not None else None
+
+
+@lru_cache(maxsize=64)
+def _second_text(second):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+
+
+def format_timestamp_ns(epoch_ns):
+    """Render epoch nanoseconds as a local-time TIMESTAMP_FORMAT string (formatting cached per second)."""
+    second, rest = divmod(epoch_ns, NS_PER_SECOND)
+    return f"{_second_text(second)}.{rest // 1000:06d}"
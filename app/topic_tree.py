@@ -0,0 +1,155 @@
+class _Node:
+    __slots__ = ("children", "values")
+
+    def __init__(self):
+        self.children = {}
+        self.values = []
+
+
+class TopicMatcher:
+    """Trie of MQTT topic filters that finds every filter matching a topic.
+
+    Filters may use the `+` (one level) and `#` (this level and below)
+    wildcards. As in the MQTT spec, wildcards at the first level do not match
+    topics starting with `$`.
+    """
+
+    def __init__(self):
+        self.root = _Node()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, topic_filter, value):
+        node = self.root
+        for segment in topic_filter.split("/"):
+            node = node.children.setdefault(segment, _Node())
+        node.values.append(value)
+        self.size += 1
+
+    def remove(self, topic_filter, value):
+        """Remove one registration of `value` under `topic_filter`; returns False if absent."""
+        path = [self.root]
+        for segment in topic_filter.split("/"):
+            node = path[-1].children.get(segment)
+            if node is None:
+                return False
+            path.append(node)
+
+        node = path[-1]
+        if value not in node.values:
+            return False
+        node.values.remove(value)
+        self.size -= 1
+
+        # Prune branches that no longer lead to any filter
+        segments = topic_filter.split("/")
+        for depth in range(len(segments), 0, -1):
+            child = path[depth]
+            if child.values or child.children:
+                break
+            del path[depth - 1].children[segments[depth - 1]]
+        return True
+
+    def filters(self, topic_filter):
+        """Values registered under exactly `topic_filter`."""
+        node = self.root
+        for segment in topic_filter.split("/"):
+            node = node.children.get(segment)
+            if node is None:
+                return []
+        return list(node.values)
+
+    def match(self, topic):
+        """Values of every filter that matches `topic`."""
+        segments = topic.split("/")
+        matches = []
+        self._match(self.root, segments, 0, matches, topic.startswith("$"))
+        return matches
+
+    def _match(self, node, segments, depth, matches, system_topic):
+        wildcards_allowed = not (depth == 0 and system_topic)
+
+        if wildcards_allowed:
+            hash_node = node.children.get("#")
+            if hash_node is not None:
+                matches.extend(hash_node.values)
+
+        if depth == len(segments):
+            matches.extend(node.values)
+            return
+
+        child = node.children.get(segments[depth])
+        if child is not None:
+            self._match(child, segments, depth + 1, matches, system_topic)
+        if wildcards_allowed:
+            plus = node.children.get("+")
+            if plus is not None:
+                self._match(plus, segments, depth + 1, matches, system_topic)
+
+
+class TopicNode:
+    """One `/`-separated level of the topic hierarchy with subtree totals."""
+
+    __slots__ = ("name", "path", "parent", "children", "count", "last_seen", "is_topic")
+
+    def __init__(self, name, path, parent):
+        self.name = name
+        self.path = path
+        self.parent = parent
+        self.children = {}
+        self.count = 0  # messages on this topic and every topic below it
+        self.last_seen = None
+        self.is_topic = False
+
+
+class TopicIndex:
+    """In-memory index of known topics: O(1) membership plus a segment trie for hierarchical views."""
+
+    def __init__(self):
+        self.root = TopicNode("", None, None)
+        self.topics = {}  # topic -> TopicNode
+
+    def __contains__(self, topic):
+        return topic in self.topics
+
+    def __len__(self):
+        return len(self.topics)
+
+    def add(self, topic, count=1, last_seen=None):
+        """Record `count` messages on `topic`; returns the nodes whose totals changed, leaf first.
+
+        Nodes created by this call are included, so callers can diff them into a view.
+        """
+        node = self.topics.get(topic)
+        if node is None:
+            node = self.root
+            segments = topic.split("/")
+            for depth, segment in enumerate(segments):
+                child = node.children.get(segment)
+                if child is None:
+                    child = node.children[segment] = TopicNode(segment, "/".join(segments[:depth + 1]), node)
+                node = child
+            node.is_topic = True
+            self.topics[topic] = node
+
+        changed = []
+        while node is not self.root:
+            node.count += count
+            if last_seen is not None and (node.last_seen is None or last_seen > node.last_seen):
+                node.last_seen = last_seen
+            changed.append(node)
+            node = node.parent
+        return changed
+
+    def node(self, path):
+        """Node for a prefix path as produced by TopicNode.path, or the root for None."""
+        if path is None:
+            return self.root
+        node = self.root
+        for segment in path.split("/"):
+            node = node.children.get(segment)
+            if node is None:
+                return None
+        return node
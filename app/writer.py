@@ -0,0 +1,313 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from app.config import (
+    DATABASE_PATH,
+    WRITE_BATCH_SIZE,
+    WRITE_FLUSH_INTERVAL,
+    WRITE_QUEUE_SIZE,
+    WRITE_BACKPRESSURE,
+    WRITE_SYNCHRONOUS,
+    WRITE_LOCK_TIMEOUT,
+    SPILL_PATH,
+)
+from app.metrics import STAGE_SECONDS, registry
+from app.pool import tune
+from app.profiling import profiler
+
+logger = logging.getLogger(__name__)
+
+BACKPRESSURE_POLICIES = ("block", "drop_oldest", "spill")
+BATCH_ROWS = registry.histogram("iot_writer_batch_rows", "Rows per committed batch",
+                                buckets=(1, 10, 50, 100, 250, 500, 1000, 5000))
+
+
+class WriterHook:
+    """Runs inside the writer's transaction just before a batch is inserted (and once it commits)."""
+
+    def split(self, rows):
+        """Groups of `rows` that must go in separate transactions (in this order); one group by default."""
+        return [rows]
+
+    def before_transaction(self, conn, rows):
+        """Prepare the connection (e.g. ATTACH databases) before the batch transaction starts."""
+
+    def before_insert(self, conn, rows):
+        """Inspect or enrich `rows` in place; return the rows that should be inserted."""
+        return rows
+
+    def rollback(self):
+        """Called when the transaction fails so cached state can be discarded."""
+
+    def after_commit(self, rows):
+        """Called once `rows` are committed and visible to readers."""
+
+
+class BatchWriter:
+    """Persistent SQLite writer that group-commits queued rows from a background thread.
+
+    Rows are dicts matching the named placeholders of `insert`, an INSERT
+    statement or a callable(conn, rows) that inserts them. A batch is
+    committed once `batch_size` rows are waiting or the oldest row has waited
+    `flush_interval` seconds, whichever comes first.
+    """
+
+    def __init__(self, insert, database_path=DATABASE_PATH, batch_size=WRITE_BATCH_SIZE,
+                 flush_interval=WRITE_FLUSH_INTERVAL, queue_size=WRITE_QUEUE_SIZE,
+                 backpressure=WRITE_BACKPRESSURE, spill_path=SPILL_PATH, hooks=()):
+        if backpressure not in BACKPRESSURE_POLICIES:
+            raise ValueError(f"Unknown backpressure policy: {backpressure!r}")
+
+        self.insert = insert
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.backpressure = backpressure
+        self.spill_path = spill_path
+        self.hooks = list(hooks)
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stats = {"written": 0, "dropped": 0, "spilled": 0, "failed": 0, "commits": 0}
+
+        # Rows accepted but not yet committed (queued or spilled)
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._spill_lock = threading.Lock()
+        self._spill_rows = self._count_spilled()
+        self._closing = threading.Event()
+
+        self.conn = sqlite3.connect(database_path, timeout=WRITE_LOCK_TIMEOUT, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(f"PRAGMA synchronous={WRITE_SYNCHRONOUS}")
+        tune(self.conn)
+
+        registry.counter("iot_writer_rows_total", "Rows by outcome: written, dropped, spilled or failed", ("outcome",),
+                         function=lambda: {(name,): self.stats[name] for name in ("written", "dropped", "spilled", "failed")})
+        registry.counter("iot_writer_commits_total", "Committed batch transactions", function=lambda: self.stats["commits"])
+        registry.gauge("iot_writer_queue_depth", "Rows waiting for the writer", function=self.queue.qsize)
+        registry.gauge("iot_writer_pending_rows", "Rows accepted but not yet committed, spilled ones included",
+                       function=lambda: self._pending)
+        registry.gauge("iot_writer_spill_rows", "Rows waiting in the spill file", function=lambda: self._spill_rows)
+
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, row):
+        """Queue a row for insertion, applying the backpressure policy if the queue is full."""
+        if self._closing.is_set():
+            raise RuntimeError("BatchWriter is closed")
+
+        with self._cond:
+            self._pending += 1
+
+        if self.backpressure == "block":
+            self.queue.put(row)
+            return
+
+        while True:
+            try:
+                self.queue.put_nowait(row)
+                return
+            except queue.Full:
+                pass
+
+            if self.backpressure == "spill":
+                self._spill(row)
+                return
+
+            # drop_oldest: make room by discarding the row that has waited longest
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                continue
+            with self._cond:
+                self._pending -= 1
+                self.stats["dropped"] += 1
+                self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Block until every submitted row (including spilled ones) is committed."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending == 0, timeout)
+
+    def close(self, timeout=None):
+        """Flush outstanding rows and stop the flusher thread, which closes the connection on its way out."""
+        if self._closing.is_set():
+            return
+        self.flush(timeout)
+        self._closing.set()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning("Writer still busy after %ss; its thread closes the connection once the batch is done", timeout)
+
+    def metrics(self):
+        """Return a snapshot of writer counters and queue depth."""
+        with self._cond:
+            snapshot = dict(self.stats)
+            snapshot["pending"] = self._pending
+        snapshot["queue_depth"] = self.queue.qsize()
+        snapshot["spill_rows"] = self._spill_rows
+        return snapshot
+
+    def _run(self):
+        try:
+            while not (self._closing.is_set() and self.queue.empty()):
+                profiler.checkpoint()
+                batch = self._collect()
+                if batch:
+                    self._write(batch)
+                elif self._spill_rows:
+                    self._replay_spill()
+        finally:
+            self.conn.close()  # Here rather than in close(), which may give up waiting mid-transaction
+
+    def _collect(self):
+        """Gather up to batch_size rows, waiting at most flush_interval after the first one."""
+        try:
+            batch = [self.queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _insert(self, rows):
+        """Run the hooks and insert `rows` in one transaction; returns the rows committed."""
+        started = time.perf_counter()
+        try:
+            for hook in self.hooks:
+                hook.before_transaction(self.conn, rows)
+            with self.conn:
+                # Take the write lock before the hooks read what they merge into, so writers in other processes cannot interleave
+                self.conn.execute("BEGIN IMMEDIATE")
+                for hook in self.hooks:
+                    rows = hook.before_insert(self.conn, rows)
+                if callable(self.insert):
+                    self.insert(self.conn, rows)
+                else:
+                    self.conn.executemany(self.insert, rows)
+        except Exception:
+            for hook in self.hooks:
+                hook.rollback()
+            raise
+        STAGE_SECONDS.observe(time.perf_counter() - started, ("commit",))
+        BATCH_ROWS.observe(len(rows))
+        return rows
+
+    def _committed(self, rows):
+        """Count committed `rows` and run the after_commit hooks, whose failures cannot undo the commit."""
+        self.stats["written"] += len(rows)
+        self.stats["commits"] += 1
+        for hook in self.hooks:
+            try:
+                hook.after_commit(rows)
+            except Exception:
+                logger.exception("after_commit hook %s failed", type(hook).__name__)
+
+    def _write(self, batch):
+        try:
+            groups = [batch]
+            for hook in self.hooks:
+                groups = [part for group in groups for part in hook.split(group)]
+            for group in groups:
+                try:
+                    rows = self._insert(group)
+                except Exception as e:
+                    logger.error("Failed to write batch of %s rows, retrying row by row: %s", len(group), e)
+                    self._write_rows(group)
+                else:
+                    self._committed(rows)
+        finally:
+            with self._cond:
+                self._pending -= len(batch)
+                self._cond.notify_all()
+
+    def _write_rows(self, batch):
+        """Fallback path that isolates the rows that made a batch fail."""
+        for row in batch:
+            try:
+                rows = self._insert([row])
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.error("Dropping row that failed to insert: %s", e)
+            else:
+                self._committed(rows)
+
+    def _spill(self, row):
+        """Append a row to the on-disk spill file; it is replayed once the queue drains."""
+        with self._spill_lock:
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(row) + "\n")
+            self._spill_rows += 1
+        with self._cond:
+            self.stats["spilled"] += 1
+
+    def _count_spilled(self):
+        count = 0
+        for path, offset in ((self.spill_path + ".replay", self._replay_offset()), (self.spill_path, 0)):
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    f.seek(offset)
+                    count += sum(1 for _ in f)
+        # Rows left over from a previous run were never counted as pending
+        with self._cond:
+            self._pending += count
+        return count
+
+    def _replay_spill(self):
+        """Move spilled rows back into the database in batch_size chunks."""
+        replay_path = self.spill_path + ".replay"
+        with self._spill_lock:
+            if not os.path.exists(replay_path):
+                if not os.path.exists(self.spill_path):
+                    self._spill_rows = 0
+                    return
+                if os.path.exists(replay_path + ".offset"):
+                    os.remove(replay_path + ".offset")  # Left by a run that stopped between removing the two
+                os.replace(self.spill_path, replay_path)
+
+        # Resume after the last batch a previous run committed, so a crash mid-replay inserts nothing twice
+        offset = self._replay_offset()
+        batch = []
+        with open(replay_path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                batch.append(json.loads(line))
+                offset += len(line)
+                if len(batch) >= self.batch_size:
+                    self._replayed(batch, offset)
+                    batch = []
+        if batch:
+            self._replayed(batch, offset)
+        os.remove(replay_path)
+        if os.path.exists(replay_path + ".offset"):
+            os.remove(replay_path + ".offset")
+
+    def _replayed(self, batch, offset):
+        """Write a batch of spilled rows and checkpoint the replay file `offset` bytes in."""
+        self._write(batch)
+        path = self.spill_path + ".replay.offset"
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(str(offset))
+        os.replace(path + ".tmp", path)
+        with self._spill_lock:
+            self._spill_rows -= len(batch)
+
+    def _replay_offset(self):
+        """Bytes of the replay file committed by earlier batches (0 when there is no checkpoint)."""
+        try:
+            with open(self.spill_path + ".replay.offset", encoding="utf-8") as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return 0
@@ -0,0 +1,63 @@
+import math
+
+
+class HdrHistogram:
+    """Log-linear histogram in the HdrHistogram layout.
+
+    Non-negative integer values (e.g. microseconds) are recorded with a
+    relative error of at most 10^-significant_digits at every magnitude, in
+    memory that grows with the value range rather than the sample count.
+    Histograms from several processes can be merged.
+    """
+
+    def __init__(self, significant_digits=3):
+        self.significant_digits = significant_digits
+        self.sub_bucket_bits = math.ceil(math.log2(2 * 10 ** significant_digits))
+        self.counts = {}
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.sum = 0
+
+    def _index(self, value):
+        shift = max(0, value.bit_length() - self.sub_bucket_bits)
+        return shift, value >> shift
+
+    @staticmethod
+    def _value(index):
+        # Midpoint of the range of values that share this bucket
+        shift, sub = index
+        return (sub << shift) + ((1 << shift) >> 1)
+
+    def record(self, value, count=1):
+        value = max(0, int(value))
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + count
+        self.total += count
+        self.sum += value * count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.total += other.total
+        self.sum += other.sum
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def value_at_percentile(self, percentile):
+        if self.total == 0:
+            return None
+        target = max(1, math.ceil(percentile / 100 * self.total))
+        seen = 0
+        for index in sorted(self.counts, key=self._value):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self._value(index), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.sum / self.total if self.total else None
@@ -1,9 +1,22 @@
 import paho.mqtt.client as mqtt
+import argparse
 import json
+import multiprocessing
+import os
 import time
 import random
+import socket
+import subprocess
+import sys
+import uuid
 from datetime import datetime
 import ssl
+from histogram import HdrHistogram
+from spool import CATCH_UP_RATE, MAX_BYTES, Spool, SpoolPublisher
+
+# Payload codecs are shared with the ingest side
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from app.payload import CODECS, StructCodec, decode, encode, get_codec
 
 # MQTT Broker details
 BROKER = "10.245.30.78"  #broker's address
@@ -18,68 +31,350 @@ password = "admin"
 #TLS configuration
 tls_version = ssl.PROTOCOL_TLSv1_2
 
-# Latency tracking
-data_stats = {"latencies": [], "received": 0}
-
-def on_connect(client, userdata, flags, rc):
-    if rc == 0:
-        print("Connected to MQTT Broker!")
-        client.subscribe(TOPIC, qos=QOS)
-    else:
-        print(f"Failed to connect, return code {rc}")
-
-def on_message(client, userdata, msg):
-    recv_time = time.time()
-    payload = json.loads(msg.payload.decode())
-    sent_time = datetime.strptime(payload["sent_timestamp"], '%Y-%m-%d %H:%M:%S.%f').timestamp()
-    latency = recv_time - sent_time
-    userdata["latencies"].append(latency)
-    userdata["received"] += 1
-
-def generate_payload(packet_size):
-    """Generates a JSON payload of approximately packet_size bytes"""
+# Benchmark defaults
+BENCH_TOPIC_PREFIX = "bench"
+BROKER_CONF = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "broker", "mosquitto.conf")
+DRAIN_TIMEOUT = 10  # Seconds to wait for in-flight messages after publishing stops
+PERCENTILES = (50, 90, 99, 99.9)
+
+# Clock sync with the ingest app (see app/timesync.py)
+TIME_SYNC_TOPIC = "timesync"
+TIME_SYNC_PROBES = 8  # Probes sent before publishing starts
+TIME_SYNC_INTERVAL = 10  # Seconds between probes while publishing
+
+def generate_payload(packet_size, device=None, seq=None, legacy_timestamp=False, codec="json", client_id=None):
+    """Generates a payload of approximately packet_size bytes, encoded with `codec` (see app/payload.py)
+
+    The send time goes out as integer epoch nanoseconds (`sent_ns`); the
+    string `sent_timestamp` is only added for ingest servers that predate it.
+    `client_id` lets the ingest app correct the latency for this client's
+    clock offset (struct layouts have no room for it). `seq` counts up per
+    client from 0; the ingest app uses it to drop redeliveries and to count
+    lost and reordered messages per topic and QoS.
+    """
+    sent_ns = time.time_ns()
     base_data = {
-        "sent_timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'),
+        "sent_ns": sent_ns,
         "data": round(random.uniform(10.0, 25.0), 2),
         "packet_size": packet_size,
     }
-    base_json = json.dumps(base_data)
-    remaining_size = packet_size - len(base_json.encode("utf-8"))
-    if remaining_size > 0:
-        base_data["filler"] = "X" * remaining_size  # Adding filler characters
-    return json.dumps(base_data)
-
-def publish_data(client):
-    for i in range(PACKET_COUNT):
-        packet_size = 1
-        payload = generate_payload(packet_size)
-        result = client.publish(TOPIC, payload, qos=QOS)
-        status = result.rc
-        if status == 0:
-            print(f"Sent message of size {len(payload.encode('utf-8'))} bytes to topic `{TOPIC}` with QoS {QOS}")
+    if legacy_timestamp:
+        base_data["sent_timestamp"] = datetime.fromtimestamp(sent_ns / 1e9).strftime('%Y-%m-%d %H:%M:%S.%f')
+    if device is not None:
+        base_data["device"] = device
+        base_data["seq"] = seq
+    if client_id is not None:
+        base_data["client_id"] = client_id
+    base_payload = encode(base_data, codec)
+    remaining_size = packet_size - len(base_payload)
+    if remaining_size <= 0:
+        return base_payload
+    if isinstance(get_codec(codec), StructCodec):
+        return base_payload + bytes(remaining_size)  # Bytes past the fixed layout are ignored
+    base_data["filler"] = "X" * remaining_size  # Adding filler characters
+    return encode(base_data, codec)
+
+def rate_at(profile, t, rate, duration):
+    """Per-device publish rate (msgs/s) at `t` seconds into a trial."""
+    if profile == "constant":
+        return rate
+    if profile == "ramp":
+        return 2 * rate * t / duration  # 0 -> 2x rate, averaging `rate`
+    if profile == "burst":
+        return rate * 5 if t % 5 < 1 else 0.0  # 1 s at 5x rate every 5 s, averaging `rate`
+    raise ValueError(f"Unknown rate profile: {profile}")
+
+def make_client(client_id, options, userdata=None):
+    client = mqtt.Client(client_id, userdata=userdata)
+    client.username_pw_set(options["username"], options["password"])
+    if options["tls"]:
+        client.tls_set(cert_reqs=ssl.CERT_NONE)
+    client.connect(options["broker"], options["port"], 60)
+    client.loop_start()
+    return client
+
+def wait_connected(clients, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not all(client.is_connected() for client in clients):
+        if time.monotonic() > deadline:
+            raise TimeoutError("Devices could not connect to the broker")
+        time.sleep(0.05)
+
+class ClockProbe:
+    """Publisher side of the ingest app's clock sync: pings the app and reports each exchange back.
+
+    The app fits this client's clock offset and drift from the reports and
+    corrects the latency of messages that carry the same `client_id`.
+    """
+
+    def __init__(self, client, client_id):
+        self.client = client
+        self.prefix = f"{TIME_SYNC_TOPIC}/{client_id}"
+        self.exchanges = 0
+        client.message_callback_add(f"{self.prefix}/pong", self.on_pong)
+        client.subscribe(f"{self.prefix}/pong", 0)
+
+    def ping(self):
+        self.client.publish(f"{self.prefix}/ping", json.dumps({"t0": time.time_ns()}), qos=0)
+
+    def on_pong(self, client, userdata, msg):
+        t3 = time.time_ns()
+        report = json.loads(msg.payload)
+        report["t3"] = t3
+        client.publish(f"{self.prefix}/result", json.dumps(report), qos=0)
+        self.exchanges += 1
+
+def run_devices(options, run_id, devices, qos, packet_size):
+    """Publisher process: drive `devices` simulated sensors, each with its own connection."""
+    client_ids = [f"bench-{run_id}-{device}" for device in devices]
+    clients = [make_client(client_id, options) for client_id in client_ids]
+    wait_connected(clients)
+
+    probes = []
+    if options["time_sync"]:
+        probes = [ClockProbe(client, client_id) for client, client_id in zip(clients, client_ids)]
+        for _ in range(TIME_SYNC_PROBES):
+            for probe in probes:
+                probe.ping()
+            time.sleep(0.05)
+        if not any(probe.exchanges for probe in probes):
+            print("No clock sync replies; is the ingest app subscribed to this broker?")
+    last_probe = time.monotonic()
+
+    # Store-and-forward: readings go to a durable spool per device and survive broker outages
+    publishers = None
+    if options["spool"]:
+        publishers = [
+            SpoolPublisher(client, Spool(os.path.join(options["spool"], f"device-{device}"), max_bytes=options["spool_bytes"]),
+                           rate=options["catch_up_rate"])
+            for client, device in zip(clients, devices)
+        ]
+
+    sent = {device: 0 for device in devices}
+    failed = 0
+    last_info = {}
+    credit = 0.0
+    turn = 0
+    start = last = time.monotonic()
+    while True:
+        now = time.monotonic()
+        elapsed = now - start
+        if elapsed >= options["duration"]:
+            break
+        credit += rate_at(options["profile"], elapsed, options["rate"], options["duration"]) * len(devices) * (now - last)
+        last = now
+        if probes and now - last_probe >= TIME_SYNC_INTERVAL:
+            for probe in probes:
+                probe.ping()
+            last_probe = now
+        while credit >= 1:
+            index = turn % len(devices)
+            device = devices[index]
+            payload = generate_payload(packet_size, device, sent[device], options["legacy_timestamps"], options["codec"],
+                                       client_ids[index])
+            topic = f"{BENCH_TOPIC_PREFIX}/{run_id}/{device}"
+            if publishers is not None:
+                publishers[index].publish(topic, payload, qos)
+                sent[device] += 1
+            else:
+                info = clients[index].publish(topic, payload, qos=qos)
+                if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                    sent[device] += 1
+                    last_info[index] = info
+                else:
+                    failed += 1
+            turn += 1
+            credit -= 1
+        time.sleep(0.001)
+
+    # Let QoS 1/2 handshakes finish before disconnecting
+    for info in last_info.values():
+        info.wait_for_publish(DRAIN_TIMEOUT)
+    backlog = 0
+    if publishers is not None:
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        for publisher in publishers:
+            publisher.drain(max(0.0, deadline - time.monotonic()))
+            backlog += publisher.spool.depth()  # Kept on disk; sent by the next run with the same --spool
+            publisher.close()
+    for client in clients:
+        client.loop_stop()
+        client.disconnect()
+    return {"sent": sent, "failed": failed, "spooled": backlog}
+
+class Collector:
+    """Subscriber-side accounting: latency, loss, duplicates and reordering per device."""
+
+    def __init__(self):
+        self.histogram = HdrHistogram()  # microseconds
+        self.seen = {}
+        self.highest = {}
+        self.received = 0
+        self.duplicates = 0
+        self.reordered = 0
+
+    def on_message(self, client, userdata, msg):
+        recv_ns = time.time_ns()
+        payload = decode(msg.payload)
+        device, seq = payload["device"], payload["seq"]
+        self.received += 1
+
+        seen = self.seen.setdefault(device, set())
+        if seq in seen:
+            self.duplicates += 1
+            return
+        seen.add(seq)
+        if seq < self.highest.get(device, -1):
+            self.reordered += 1
         else:
-            print(f"Failed to send message to topic {TOPIC}")
-        time.sleep(1)
+            self.highest[device] = seq
+        self.histogram.record((recv_ns - payload["sent_ns"]) / 1000)
 
-def print_results():
-    received = data_stats["received"]
-    lost = PACKET_COUNT - received
-    avg_latency = sum(data_stats["latencies"]) / received if received else float('inf')
-    print(f"Sent={PACKET_COUNT}, Received={received}, Lost={lost}, Avg Latency={avg_latency:.4f}s")
+    @property
+    def unique(self):
+        return sum(len(seqs) for seqs in self.seen.values())
+
+def run_trial(options, qos, packet_size):
+    """One load level: publish from every simulated device, collect at a single subscriber."""
+    run_id = uuid.uuid4().hex[:8]
+    collector = Collector()
+    subscriber = make_client(f"bench-{run_id}-collector", options)
+    subscriber.on_message = collector.on_message
+    wait_connected([subscriber])
+    subscriber.subscribe(f"{BENCH_TOPIC_PREFIX}/{run_id}/#", qos)
+    time.sleep(0.5)  # Let the SUBACK land before publishers start
+
+    devices = list(range(options["devices"]))
+    groups = [devices[i::options["processes"]] for i in range(options["processes"])]
+    groups = [group for group in groups if group]
+
+    start = time.monotonic()
+    with multiprocessing.Pool(len(groups)) as pool:
+        reports = pool.starmap(run_devices, [(options, run_id, group, qos, packet_size) for group in groups])
+    publish_elapsed = time.monotonic() - start
+
+    sent = sum(sum(report["sent"].values()) for report in reports)
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while collector.unique < sent and time.monotonic() < deadline:
+        time.sleep(0.05)
+    subscriber.loop_stop()
+    subscriber.disconnect()
+
+    unique = collector.unique
+    histogram = collector.histogram
+    latency_ms = {f"p{p:g}": (histogram.value_at_percentile(p) or 0) / 1000 for p in PERCENTILES}
+    latency_ms["mean"] = (histogram.mean or 0) / 1000
+    latency_ms["max"] = (histogram.max or 0) / 1000
+    return {
+        "run_id": run_id,
+        "timestamp": datetime.now().isoformat(),
+        "broker": f"{options['broker']}:{options['port']}",
+        "qos": qos,
+        "payload_size": packet_size,
+        "codec": options["codec"],
+        "devices": options["devices"],
+        "processes": len(groups),
+        "profile": options["profile"],
+        "rate_per_device": options["rate"],
+        "duration": options["duration"],
+        "sent": sent,
+        "publish_failures": sum(report["failed"] for report in reports),
+        "spool_backlog": sum(report["spooled"] for report in reports),
+        "received": collector.received,
+        "lost": sent - unique,
+        "loss_rate": (sent - unique) / sent if sent else 0.0,
+        "duplicates": collector.duplicates,
+        "reordered": collector.reordered,
+        "throughput": unique / publish_elapsed if publish_elapsed else 0.0,
+        "latency_ms": latency_ms,
+    }
+
+def print_results(result):
+    latency = result["latency_ms"]
+    print(f"QoS={result['qos']} Size={result['payload_size']}B Codec={result['codec']} Sent={result['sent']}, Received={result['received']}, "
+          f"Lost={result['lost']} ({result['loss_rate']:.2%}), Spooled={result['spool_backlog']}, Dup={result['duplicates']}, Reordered={result['reordered']}, "
+          f"Throughput={result['throughput']:.1f} msg/s, "
+          f"Latency p50={latency['p50']:.3f}ms p99={latency['p99']:.3f}ms max={latency['max']:.3f}ms")
+
+def start_local_broker(port):
+    """Run mosquitto with broker/mosquitto.conf and wait until it accepts connections."""
+    process = subprocess.Popen(["mosquitto", "-c", BROKER_CONF])
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError("mosquitto exited during startup; check broker/mosquitto.conf")
+            time.sleep(0.1)
+    process.terminate()
+    raise TimeoutError("mosquitto did not start listening")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="MQTT load generator and end-to-end ingest benchmark")
+    parser.add_argument("--broker", default=BROKER)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--tls", action=argparse.BooleanOptionalAction, default=True, help="TLS without certificate checks")
+    parser.add_argument("--local", action="store_true", help="Start mosquitto with broker/mosquitto.conf and use its plain 1883 listener")
+    parser.add_argument("--devices", type=int, default=1, help="Simulated devices, each with its own connection")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="Publisher processes")
+    parser.add_argument("--profile", choices=("constant", "ramp", "burst"), default="constant")
+    parser.add_argument("--rate", type=float, default=1.0, help="Average messages per second per device")
+    parser.add_argument("--duration", type=float, default=PACKET_COUNT, help="Seconds of publishing per trial")
+    parser.add_argument("--sizes", default="1", help="Comma-separated payload sizes in bytes to sweep")
+    parser.add_argument("--qos", default=str(QOS), help="Comma-separated QoS levels to sweep")
+    parser.add_argument("--legacy-timestamps", action="store_true", help="Also send the string sent_timestamp for older ingest servers")
+    parser.add_argument("--time-sync", action="store_true",
+                        help="Probe the ingest app's clock so it can correct latencies for this host's clock offset")
+    parser.add_argument("--codec", choices=sorted(CODECS), default="json",
+                        help="Payload encoding; struct layouts need device and seq fields (struct-seq)")
+    parser.add_argument("--spool", metavar="DIR",
+                        help="Publish through a durable on-disk spool per device, replayed after broker outages")
+    parser.add_argument("--catch-up-rate", type=float, default=CATCH_UP_RATE,
+                        help="Most messages per second per device a spool sends (e.g. replaying after an outage)")
+    parser.add_argument("--spool-size", type=float, default=MAX_BYTES / 2**20,
+                        help="MiB of messages a device spool keeps before dropping the oldest")
+    parser.add_argument("--output", default="bench_results.jsonl", help="JSON lines file results are appended to")
+    args = parser.parse_args(argv)
+    if args.local:
+        args.broker, args.port, args.tls = "127.0.0.1", 1883, False
+    codec = get_codec(args.codec)
+    if isinstance(codec, StructCodec) and "seq" not in codec.fields:
+        parser.error(f"--codec {args.codec} has no device/seq fields; use struct-seq")
+    return args
 
 if __name__ == "__main__":
-    client = mqtt.Client(CLIENT_ID, userdata=data_stats)
-    client.username_pw_set(username, password)
-    client.on_connect = on_connect
-    client.on_message = on_message
-    client.tls_set(cert_reqs=ssl.CERT_NONE)
-    client.connect(BROKER, PORT, 60)
-    client.loop_start()
+    args = parse_args()
+    options = {
+        "broker": args.broker,
+        "port": args.port,
+        "tls": args.tls,
+        "username": username,
+        "password": password,
+        "devices": args.devices,
+        "processes": min(args.processes, args.devices),
+        "profile": args.profile,
+        "rate": args.rate,
+        "duration": args.duration,
+        "legacy_timestamps": args.legacy_timestamps,
+        "codec": args.codec,
+        "time_sync": args.time_sync,
+        "spool": args.spool,
+        "catch_up_rate": args.catch_up_rate,
+        "spool_bytes": int(args.spool_size * 2**20),
+    }
+
+    broker_process = start_local_broker(args.port) if args.local else None
     try:
-        publish_data(client)
-        time.sleep(5)  # Allow time for messages to be received
-        print_results()
+        for qos in (int(q) for q in args.qos.split(",")):
+            for packet_size in (int(s) for s in args.sizes.split(",")):
+                result = run_trial(options, qos, packet_size)
+                print_results(result)
+                with open(args.output, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(result) + "\n")
     finally:
-        print("Disconnecting...")
-        client.loop_stop()
-        client.disconnect()
+        if broker_process is not None:
+            print("Stopping local broker...")
+            broker_process.terminate()
+            broker_process.wait()
@@ -0,0 +1,350 @@
+import collections
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+import paho.mqtt.client as mqtt
+
+SEGMENT_SIZE = 4 * 1024 * 1024  # Bytes per memory-mapped segment file
+MAX_BYTES = 64 * 1024 * 1024  # Bound on the segments kept; the oldest is dropped to make room
+SYNC_INTERVAL = 1.0  # Seconds between msyncs; a process crash loses nothing, a power cut up to this much
+CATCH_UP_RATE = 200.0  # Messages per second replayed after an outage (live traffic below it is not delayed)
+CATCH_UP_BATCH = 50  # Messages published per pass, and the burst allowed above the rate
+MAX_INFLIGHT = 100  # Unacknowledged QoS 1/2 messages at a time
+
+# Record: magic, qos, topic length, payload length, crc32 of topic + payload; then topic and payload.
+# A zero magic byte ends a segment's records (segments are preallocated with zeros).
+_HEADER = struct.Struct("<BBHII")
+_MAGIC = 0xA7
+_CURSOR = struct.Struct("<QQ")  # Segment number and offset of the first unacknowledged record
+_SEGMENT_FILE = re.compile(r"^(\d{16})\.seg$")
+
+
+class Spool:
+    """Durable outbound queue: an append-only log of memory-mapped segment files, bounded at `max_bytes`.
+
+    Messages are appended, taken for sending in order, and acknowledged by
+    sequence number once the broker has them. The position of the first
+    unacknowledged message is kept in a mapped cursor file, so a restarted
+    publisher resends from there (at least once). Segments wholly before
+    the cursor are deleted; when appending would exceed `max_bytes` the
+    oldest segment is dropped, unsent messages included, and counted.
+    Sequence numbers only live as long as the Spool object.
+    """
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE, max_bytes=MAX_BYTES):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_segments = max(2, max_bytes // segment_size)
+        self.stats = {"appended": 0, "acked": 0, "dropped": 0}
+        self._maps = collections.OrderedDict()  # segment number -> mmap, oldest first
+        self._pending = collections.deque()  # (seq, segment, end offset) taken but not yet behind the cursor
+        self._acked = set()  # Acknowledged seqs the cursor has not reached yet
+        self._lock = threading.Lock()
+        self.not_empty = threading.Condition(self._lock)
+        os.makedirs(path, exist_ok=True)
+
+        with open(os.path.join(path, "cursor"), "a+b") as f:
+            if os.fstat(f.fileno()).st_size < _CURSOR.size:
+                f.truncate(_CURSOR.size)
+            self._cursor_map = mmap.mmap(f.fileno(), _CURSOR.size)
+        numbers = sorted(int(match.group(1)) for match in map(_SEGMENT_FILE.match, os.listdir(path)) if match)
+        segment, offset = _CURSOR.unpack(self._cursor_map)
+        if not numbers or segment < numbers[0]:
+            segment, offset = (numbers[0] if numbers else 0), 0  # Cursor lost, or its segment was dropped
+        for number in numbers:
+            if number < segment:
+                os.remove(self._segment_path(number))
+            else:
+                self._open(number)
+        if segment not in self._maps:
+            self._open(segment)  # Nothing stored yet, or the cursor moved on before its segment was created
+
+        # Recover the write position: records run up to a zero magic, or to a torn (bad crc) record
+        self.cursor = (segment, offset, 0)  # (segment, offset, seq) of the first unacknowledged record
+        self.next_seq = 0
+        position = (segment, offset)
+        while True:
+            record = self._read(*position)
+            if record is None:
+                later = [number for number in self._maps if number > position[0]]
+                if not later:
+                    break
+                position = (later[0], 0)
+                continue
+            position = (position[0], record[0])
+            self.next_seq += 1
+        self.write = position
+        self._maps[position[0]][position[1]:] = bytes(self.segment_size - position[1])  # Clear a torn tail
+        self.send = self.cursor  # (segment, offset, seq) of the next record to take
+
+    def _segment_path(self, number):
+        return os.path.join(self.path, f"{number:016d}.seg")
+
+    def _open(self, number):
+        with open(self._segment_path(number), "a+b") as f:
+            if os.fstat(f.fileno()).st_size < self.segment_size:
+                f.truncate(self.segment_size)
+            self._maps[number] = mmap.mmap(f.fileno(), self.segment_size)
+
+    def _read(self, segment, offset):
+        """(end offset, topic, payload, qos) of the record at `offset`, or None past the segment's last one."""
+        data = self._maps[segment]
+        if offset + _HEADER.size > self.segment_size:
+            return None
+        magic, qos, topic_length, payload_length, crc = _HEADER.unpack_from(data, offset)
+        end = offset + _HEADER.size + topic_length + payload_length
+        if magic != _MAGIC or end > self.segment_size:
+            return None
+        body = data[offset + _HEADER.size:end]
+        if zlib.crc32(body) != crc:
+            return None
+        return end, body[:topic_length].decode(), body[topic_length:], qos
+
+    def append(self, topic, payload, qos):
+        """Store a message; returns its seq. Raises ValueError if it can never fit in a segment."""
+        topic = topic.encode()
+        if isinstance(payload, str):
+            payload = payload.encode()
+        body = topic + payload
+        record = _HEADER.pack(_MAGIC, qos, len(topic), len(payload), zlib.crc32(body)) + body
+        if len(record) > self.segment_size:
+            raise ValueError(f"Message of {len(record)} bytes does not fit a {self.segment_size} byte spool segment")
+        with self._lock:
+            segment, offset = self.write
+            if offset + len(record) > self.segment_size:
+                segment, offset = self._roll()
+            self._maps[segment][offset:offset + len(record)] = record
+            self.write = (segment, offset + len(record))
+            seq = self.next_seq
+            self.next_seq += 1
+            self.stats["appended"] += 1
+            self.not_empty.notify_all()
+        return seq
+
+    def _roll(self):
+        """Start the next segment, first dropping the oldest if the spool is full (lock held)."""
+        number = self.write[0] + 1
+        if len(self._maps) >= self.max_segments:
+            oldest = next(iter(self._maps))
+            # Everything before the cursor is gone already, so the oldest segment is the cursor's
+            dropped = 0
+            offset = self.cursor[1]
+            while True:
+                record = self._read(oldest, offset)
+                if record is None:
+                    break
+                offset = record[0]
+                dropped += 1
+            self.stats["dropped"] += dropped
+            self.cursor = (oldest + 1, 0, self.cursor[2] + dropped)
+            if self.send[0] == oldest:
+                self.send = self.cursor
+            while self._pending and self._pending[0][1] == oldest:
+                self._pending.popleft()
+            self._acked = {seq for seq in self._acked if seq >= self.cursor[2]}
+            self._save_cursor()
+            self._maps.pop(oldest).close()
+            os.remove(self._segment_path(oldest))
+        self._open(number)
+        return number, 0
+
+    def take(self, limit):
+        """Up to `limit` (seq, topic, payload, qos) not taken yet, oldest first; they stay stored until acked."""
+        records = []
+        with self._lock:
+            segment, offset, seq = self.send
+            while len(records) < limit and seq < self.next_seq:
+                record = self._read(segment, offset)
+                if record is None:
+                    segment, offset = segment + 1, 0
+                    continue
+                offset, topic, payload, qos = record
+                records.append((seq, topic, payload, qos))
+                self._pending.append((seq, segment, offset))
+                seq += 1
+            self.send = (segment, offset, seq)
+        return records
+
+    def ack(self, seq):
+        """Mark a taken message as delivered; the cursor moves over every delivered message in front."""
+        with self._lock:
+            if seq < self.cursor[2]:
+                return  # Dropped with its segment meanwhile
+            self._acked.add(seq)
+            self.stats["acked"] += 1
+            moved = False
+            while self._pending and self._pending[0][0] in self._acked:
+                seq, segment, offset = self._pending.popleft()
+                self._acked.discard(seq)
+                self.cursor = (segment, offset, seq + 1)
+                moved = True
+            if not moved:
+                return
+            self._save_cursor()
+            while next(iter(self._maps)) < self.cursor[0]:
+                number, data = self._maps.popitem(last=False)
+                data.close()
+                os.remove(self._segment_path(number))
+
+    def _save_cursor(self):
+        self._cursor_map[:] = _CURSOR.pack(self.cursor[0], self.cursor[1])
+
+    def depth(self):
+        """Messages stored and not yet acknowledged."""
+        with self._lock:
+            return self.next_seq - self.cursor[2]
+
+    def sync(self):
+        """Flush the mapped segments and cursor to disk."""
+        with self._lock:
+            for data in self._maps.values():
+                data.flush()
+            self._cursor_map.flush()
+
+    def metrics(self):
+        with self._lock:
+            snapshot = dict(self.stats)
+            snapshot["depth"] = self.next_seq - self.cursor[2]
+            snapshot["inflight"] = self.send[2] - self.cursor[2]
+            snapshot["segments"] = len(self._maps)
+        return snapshot
+
+    def close(self):
+        self.sync()
+        with self._lock:
+            for data in self._maps.values():
+                data.close()
+            self._maps.clear()
+            self._cursor_map.close()
+
+
+class SpoolPublisher:
+    """Store-and-forward publishing through a paho client: messages go to a Spool, a thread sends them on.
+
+    While connected the thread publishes at up to `rate` messages per second
+    in passes of `batch`, with at most `max_inflight` unacknowledged, so a
+    backlog built up during an outage drains without flooding the broker.
+    QoS 0 messages count as delivered once paho accepts them, QoS 1/2 ones
+    when paho reports the broker's acknowledgement (on_publish). paho keeps
+    and resends its QoS 1/2 messages over a reconnect; a restarted publisher
+    resends whatever the spool's cursor was not past.
+    """
+
+    def __init__(self, client, spool, rate=CATCH_UP_RATE, batch=CATCH_UP_BATCH, max_inflight=MAX_INFLIGHT,
+                 sync_interval=SYNC_INTERVAL):
+        self.client = client
+        self.spool = spool
+        self.rate = rate
+        self.batch = batch
+        self.max_inflight = max_inflight
+        self.sync_interval = sync_interval
+        self.stats = {"published": 0, "retried": 0}
+        self._inflight = {}  # mid -> seq, or None for a QoS 0 message already counted as delivered
+        self._early = set()  # mids paho acknowledged while a publish() call of _send was in progress
+        self._publishing = False  # Only then can an unknown mid be ours; others are other publishers' (e.g. clock probes)
+        self._retry = collections.deque()  # QoS 0 records paho refused while disconnected
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        client.max_inflight_messages_set(max_inflight)
+        client.on_publish = self.on_publish
+        self._thread = threading.Thread(target=self._run, name="spool", daemon=True)
+        self._thread.start()
+
+    def publish(self, topic, payload, qos=0):
+        """Store the message; it is sent as soon as the connection and the rate limit allow."""
+        self.spool.append(topic, payload, qos)
+
+    def on_publish(self, client, userdata, mid):
+        with self._lock:
+            if mid not in self._inflight:
+                if self._publishing:
+                    self._early.add(mid)
+                return
+            seq = self._inflight.pop(mid)
+        if seq is not None:
+            self.spool.ack(seq)
+
+    def _send(self, seq, topic, payload, qos):
+        """Publish one record; False if it has to be tried again later."""
+        with self._lock:
+            self._publishing = True
+        try:
+            info = self.client.publish(topic, payload, qos=qos)
+        except Exception:
+            with self._lock:
+                self._publishing = False
+                self._early.clear()
+            raise
+        with self._lock:
+            # Still under the lock that on_publish takes, so an ack arriving from here on finds the mid in _inflight
+            self._publishing = False
+            early = info.mid in self._early
+            self._early.clear()
+            if qos == 0 and info.rc != mqtt.MQTT_ERR_SUCCESS:
+                return False  # paho does not keep QoS 0 messages it could not send
+            if not early:
+                self._inflight[info.mid] = seq if qos > 0 else None
+        self.stats["published"] += 1
+        if qos == 0 or early:
+            self.spool.ack(seq)
+        return True
+
+    def _run(self):
+        tokens = float(self.batch)
+        last = last_sync = time.monotonic()
+        while not self._stopping.is_set():
+            with self.spool.not_empty:
+                self.spool.not_empty.wait_for(lambda: self._retry or self.spool.next_seq > self.spool.send[2]
+                                              or self._stopping.is_set(), timeout=self.sync_interval)
+            now = time.monotonic()
+            tokens = min(self.batch, tokens + (now - last) * self.rate)
+            last = now
+            if now - last_sync >= self.sync_interval:
+                self.spool.sync()
+                last_sync = now
+            if not self.client.is_connected():
+                with self._lock:
+                    # QoS 0 messages written before the drop never get on_publish
+                    self._inflight = {mid: seq for mid, seq in self._inflight.items() if seq is not None}
+                self._stopping.wait(0.1)
+                continue
+
+            with self._lock:
+                room = self.max_inflight - len(self._inflight)
+            count = min(int(tokens), room)
+            if count <= 0:
+                self._stopping.wait(max(1 - tokens, 0) / self.rate if room > 0 else 0.01)
+                continue
+            records = [self._retry.popleft() for _ in range(min(count, len(self._retry)))]
+            records += self.spool.take(count - len(records))
+            for index, record in enumerate(records):
+                if not self._send(*record):
+                    self.stats["retried"] += len(records) - index
+                    self._retry.extendleft(reversed(records[index:]))
+                    break
+                tokens -= 1
+
+    def drain(self, timeout):
+        """Wait until every stored message is delivered; returns False on timeout."""
+        deadline = time.monotonic() + timeout
+        while self.spool.depth():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def metrics(self):
+        snapshot = self.spool.metrics()
+        snapshot.update(self.stats)
+        return snapshot
+
+    def close(self):
+        self._stopping.set()
+        with self.spool.not_empty:
+            self.spool.not_empty.notify_all()
+        self._thread.join()
+        self.spool.close()
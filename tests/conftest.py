@@ -0,0 +1,57 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import pytest
+
+# Every path setting follows DATABASE_DIR; point it at a scratch directory before app.config is imported
+os.environ["IOT_DATABASE_DIR"] = tempfile.mkdtemp(prefix="iot-tests-")
+
+from app import config  # noqa: E402
+
+
+def legacy_timestamp(epoch):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(epoch)) + f".{int(epoch % 1 * 1e6):06d}"
+
+
+def create_baseline(path, rows):
+    """A database as the app created it before schema versioning, holding `rows` of (topic, qos, received epoch)."""
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("""
+            CREATE TABLE mqtt_data (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                topic TEXT NOT NULL,
+                data TEXT NOT NULL,
+                qos_level INTEGER NOT NULL,
+                packet_size INTEGER NOT NULL,
+                sent_timestamp TEXT NOT NULL,
+                received_timestamp TEXT NOT NULL,
+                precise_received_time REAL,
+                latency REAL,
+                jitter REAL,
+                previous_latency REAL
+            )
+        """)
+        conn.execute("CREATE TABLE qos_stats (qos_level INTEGER PRIMARY KEY, received_packets INTEGER DEFAULT 0)")
+        conn.executemany("""
+            INSERT INTO mqtt_data (topic, data, qos_level, packet_size, sent_timestamp, received_timestamp, latency)
+            VALUES (?, '21.5', ?, 64, ?, ?, 0.02)
+        """, [(topic, qos, legacy_timestamp(received - 0.02), legacy_timestamp(received)) for topic, qos, received in rows])
+    return conn
+
+
+@pytest.fixture
+def database():
+    """An empty DATABASE_DIR for the test; the writer, reader pool and cache are reset afterwards."""
+    from app.database import close_db
+    from app.partitions import readers
+    from app.cache import query_cache
+
+    os.makedirs(config.DATABASE_DIR, exist_ok=True)
+    yield config.DATABASE_PATH
+    close_db(timeout=10)
+    readers.close()
+    query_cache.clear()
+    shutil.rmtree(config.DATABASE_DIR, ignore_errors=True)
@@ -0,0 +1,153 @@
+import math
+import numpy as np
+import pytest
+from app.analytics import RingBuffer, group_by, histogram, lttb, percentiles, rolling_mean, to_columns
+
+
+def lttb_lists(xs, ys, threshold):
+    """The list-based LTTB the graphs used before app.analytics, kept as the reference for the array version."""
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+
+    selected = [0]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # Average of the next bucket is the third triangle vertex
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        next_start = min(next_start, next_end - 1)
+        span = next_end - next_start
+        avg_x = sum(xs[next_start:next_end]) / span
+        avg_y = sum(ys[next_start:next_end]) / span
+
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        ax, ay = xs[a], ys[a]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        selected.append(best)
+        a = best
+    selected.append(n - 1)
+    return selected
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(7)
+
+
+def test_to_columns_reads_rows_into_typed_arrays():
+    rows = iter([(1.5, 0, None), (2.5, 2, 0.25)])
+    columns = to_columns(rows, {"time": np.float64, "qos": np.int8, "latency": np.float64})
+    assert columns["time"].tolist() == [1.5, 2.5]
+    assert columns["qos"].dtype == np.int8 and columns["qos"].tolist() == [0, 2]
+    assert math.isnan(columns["latency"][0]) and columns["latency"][1] == 0.25
+    assert all(column.flags["C_CONTIGUOUS"] for column in columns.values())
+
+
+def test_to_columns_empty():
+    columns = to_columns((), {"time": np.float64, "qos": np.int8})
+    assert len(columns["time"]) == 0 and columns["qos"].dtype == np.int8
+
+
+def test_group_by_matches_per_row_grouping(rng):
+    qos = rng.integers(0, 3, 1000)
+    latency = rng.random(1000)
+    expected = {0: [], 1: [], 2: []}
+    for level, value in zip(qos.tolist(), latency.tolist()):
+        expected[level].append(value)
+
+    groups = group_by(qos, latency=latency)
+    assert list(groups) == [0, 1, 2]
+    for level, values in expected.items():
+        assert groups[level]["latency"].tolist() == values  # Row order kept within a group
+
+
+def test_group_by_skips_absent_keys():
+    groups = group_by([2, 2, 0], value=[1, 2, 3])
+    assert list(groups) == [0, 2]
+    assert groups[2]["value"].tolist() == [1, 2]
+
+
+def test_rolling_mean_matches_list_mean(rng):
+    values = rng.random(500)
+    window = 25
+    expected = [sum(values[i - window + 1:i + 1]) / window for i in range(window - 1, len(values))]
+    result = rolling_mean(values, window)
+    assert np.isnan(result[:window - 1]).all()
+    assert np.allclose(result[window - 1:], expected)
+
+
+def test_rolling_mean_ignores_nan_and_short_input():
+    result = rolling_mean([1.0, np.nan, 3.0, 5.0], 2)
+    assert np.isnan(result[0])
+    assert result[1:].tolist() == [1.0, 3.0, 4.0]
+    assert np.isnan(rolling_mean([1.0, 2.0], 5)).all()
+
+
+def test_histogram_uses_shared_edges(rng):
+    groups = {0: rng.normal(0, 1, 300), 1: rng.normal(3, 1, 200), 2: np.array([])}
+    edges, counts = histogram(groups, bins=20)
+    assert len(edges) == 21
+    assert edges[0] == min(groups[0].min(), groups[1].min())
+    assert edges[-1] == max(groups[0].max(), groups[1].max())
+    assert counts[0].sum() == 300 and counts[1].sum() == 200 and counts[2].sum() == 0
+    assert np.array_equal(counts[1], np.histogram(groups[1], bins=edges)[0])
+
+
+def test_histogram_of_nothing():
+    edges, counts = histogram({0: np.array([])})
+    assert len(edges) == 0 and counts == {}
+
+
+def test_percentiles(rng):
+    values = rng.random(1001)
+    result = percentiles(np.append(values, np.nan), (50, 99))
+    assert result[50] == pytest.approx(np.percentile(values, 50))
+    assert result[99] == pytest.approx(np.percentile(values, 99))
+    assert percentiles([], (50,)) == {50: None}
+
+
+def test_lttb_matches_list_version(rng):
+    xs = np.arange(5000, dtype=np.float64) + 1.7e9
+    ys = rng.gamma(2.0, 0.02, 5000)
+    for threshold in (3, 100, 777, 4999):
+        assert lttb(xs, ys, threshold).tolist() == lttb_lists(xs.tolist(), ys.tolist(), threshold)
+
+
+def test_lttb_keeps_short_series_and_endpoints(rng):
+    xs, ys = np.arange(50.0), rng.random(50)
+    assert lttb(xs, ys, 50).tolist() == list(range(50))
+    assert lttb(xs, ys, 2).tolist() == list(range(50))
+    selected = lttb(xs, ys, 10)
+    assert len(selected) == 10 and selected[0] == 0 and selected[-1] == 49
+    assert (np.diff(selected) > 0).all()
+
+
+def test_ring_buffer_wraps_around():
+    buffer = RingBuffer(5)
+    buffer.extend([1, 2, 3])
+    assert buffer.values().tolist() == [1, 2, 3]
+    buffer.extend([4, 5, 6, 7])
+    assert len(buffer) == 5
+    assert buffer.values().tolist() == [3, 4, 5, 6, 7]
+    for value in range(8, 20):
+        buffer.extend([value])
+        assert buffer.values().tolist() == list(range(value - 4, value + 1))
+
+
+def test_ring_buffer_extend_past_capacity_and_clear():
+    buffer = RingBuffer(4, dtype=np.int64)
+    buffer.extend(range(10))
+    assert buffer.values().tolist() == [6, 7, 8, 9]
+    buffer.extend([])
+    assert buffer.values().tolist() == [6, 7, 8, 9]
+    buffer.clear()
+    assert len(buffer) == 0 and buffer.values().tolist() == []
+    buffer.extend([1])
+    assert buffer.values().tolist() == [1]
@@ -0,0 +1,23 @@
+import json
+import pytest
+from app.database import build_row
+
+RECEIVED_NS = 1_700_000_000_000_000_000
+
+
+@pytest.mark.parametrize("sent_ns", [10 ** 30, True, -5, 0, RECEIVED_NS - 10 ** 18, "1700000000000000000", 1.7e18])
+def test_unusable_sent_ns_counts_as_missing(sent_ns):
+    row = build_row("sensors/temp", json.dumps({"sent_ns": sent_ns, "data": 21.5}), 1, RECEIVED_NS, 64, 0.0)
+    assert (row["sent_ns"], row["sent_time"], row["latency"], row["sent_timestamp"]) == (None, None, None, "")
+    assert row["value"] == 21.5
+
+
+def test_sent_ns_gives_latency():
+    row = build_row("sensors/temp", json.dumps({"sent_ns": RECEIVED_NS - 20_000_000, "data": 21.5}), 1, RECEIVED_NS, 64, 0.0)
+    assert row["latency"] == pytest.approx(0.02)
+
+
+def test_payload_without_data_field_is_stored_as_text():
+    payload = json.dumps({"sent_ns": RECEIVED_NS - 10 ** 6, "reading": [1, 2]}).encode()
+    assert build_row("sensors/temp", payload, 1, RECEIVED_NS, 64, 0.0)["data"] == payload.decode()
+    assert build_row("sensors/temp", b"\xff not json", 1, RECEIVED_NS, 64, 0.0)["data"] == "� not json"
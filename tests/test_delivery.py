@@ -0,0 +1,89 @@
+import json
+import time
+import pytest
+from app.database import build_row, flush_data, get_delivery_stats, get_qos_comparison, run_backfills, save_data
+from app.delivery import DeliveryTracker, SequenceWindow
+from app.migrations import MIGRATIONS, migrate
+from app.payload import encode
+from app.stats import backfill_latency_stats
+from app.timeutil import format_timestamp_ns
+from conftest import create_baseline
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = create_baseline(str(tmp_path / "data.db"), [])
+    migrate(conn)
+    yield conn
+    conn.close()
+
+
+def struct_row(device, seq, sent_ns, topic="sensors/temp"):
+    payload = encode({"sent_ns": sent_ns, "data": 21.5, "device": device, "seq": seq}, "struct-seq")
+    return build_row(topic, payload, 1, sent_ns + 1000, len(payload), 0.0)
+
+
+def delivery_stats(conn):
+    return conn.execute("SELECT received, sequenced, duplicates, reordered, lost FROM delivery_stats").fetchone()
+
+
+def test_devices_on_one_topic_keep_separate_windows(conn):
+    tracker = DeliveryTracker(size=64)
+    # Two devices count from 0 independently and interleave on the same topic
+    rows = [struct_row(device, seq, 1_000_000 * (2 * seq + device)) for seq in range(5) for device in (1, 2)]
+    kept = tracker.before_insert(conn, rows)
+    assert len(kept) == 10
+    assert delivery_stats(conn) == (10, 10, 0, 0, 0)
+    assert set(tracker.windows) == {"device:1", "device:2"}
+
+    kept = tracker.before_insert(conn, [struct_row(1, 4, 8_000_000), struct_row(2, 5, 20_000_000)])
+    assert [row["device"] for row in kept] == [2]  # Device 1's seq 4 is a redelivery
+    assert delivery_stats(conn) == (11, 11, 1, 0, 0)
+
+
+def test_window_restarts_only_on_newer_send():
+    window = SequenceWindow.start(100, 1000)
+    assert window.accept(10, 500, 64) == ("duplicate", 0)  # Far behind and sent earlier: a stale redelivery
+    assert window.highest == 100
+    assert window.accept(10, 2000, 64) == ("restart", 0)
+    assert window.highest == 10
+
+
+def legacy_rows(now, count=300):
+    return [(f"sensors/{i % 3}", i % 3, now - 3600 + i) for i in range(count)]
+
+
+def ingest(topic, qos, count):
+    for _ in range(count):
+        sent_ns = time.time_ns()
+        save_data(topic, json.dumps({"sent_ns": sent_ns, "data": 21.5}), qos, format_timestamp_ns(sent_ns + 1_000_000), 64, 0.0)
+    assert flush_data(timeout=10)
+
+
+def received(stats):
+    return {stats["qos_level"]: stats["received"] for stats in stats}
+
+
+def test_upgrade_counts_legacy_rows_once_backfilled(database):
+    conn = create_baseline(database, legacy_rows(time.time()))
+    migrate(conn)
+    conn.close()
+
+    ingest("sensors/0", 0, 5)
+    assert received(get_qos_comparison()) == {0: 5}  # Legacy rows are counted by the background backfill
+
+    run_backfills()
+    assert received(get_qos_comparison()) == {0: 105, 1: 100, 2: 100}
+    assert [(stats["topic"], stats["received"]) for stats in get_delivery_stats("sensors/1")] == [("sensors/1", 100)]
+
+
+def test_upgrade_after_latency_backfill_does_not_count_rows_twice(database):
+    conn = create_baseline(database, legacy_rows(time.time()))
+    migrate(conn, MIGRATIONS[:7])
+    backfill_latency_stats(database)
+    migrate(conn)
+    conn.close()
+
+    assert received(get_qos_comparison()) == {0: 100, 1: 100, 2: 100}
+    run_backfills()
+    assert received(get_qos_comparison()) == {0: 100, 1: 100, 2: 100}
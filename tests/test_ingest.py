@@ -0,0 +1,27 @@
+import time
+import pytest
+from app.ingest import IngestPipeline
+
+
+def parse(topic, payload, qos, received_ns, precise_received_time):
+    if payload == b"bad":
+        raise ValueError("malformed payload")
+    return {"topic": topic, "payload": payload}
+
+
+@pytest.mark.parametrize("mode", ["thread", "process"])
+def test_one_bad_message_does_not_drop_the_rest_of_its_batch(mode):
+    stored = []
+
+    def sink(row):
+        if row["payload"] == b"unstorable":
+            raise RuntimeError("writer closed")
+        stored.append(row["payload"])
+
+    pipeline = IngestPipeline(parse, sink, workers=1, mode=mode, process_batch=10)
+    for payload in (b"first", b"bad", b"ok", b"unstorable", b"last"):
+        pipeline.submit("sensors/temp", payload, 0, 0, time.monotonic())
+    pipeline.stop(timeout=30)
+
+    assert stored == [b"first", b"ok", b"last"]
+    assert (pipeline.metrics()["processed"], pipeline.metrics()["errors"]) == (3, 2)
@@ -0,0 +1,34 @@
+import json
+import sqlite3
+import time
+import pytest
+from app.database import flush_data, save_data
+from app.migrations import backfill_time_columns, migrate
+from app.timeutil import format_timestamp_ns
+from conftest import create_baseline
+
+
+def test_time_backfill_after_partitioned_ingest_only_widens_topic_range(database):
+    now = time.time()
+    conn = create_baseline(database, [("sensors/temp", 0, now - 3600 + i) for i in range(10)])
+    migrate(conn)
+    conn.close()
+
+    for topic in ("sensors/temp", "new/topic"):
+        for _ in range(5):
+            sent_ns = time.time_ns()
+            save_data(topic, json.dumps({"sent_ns": sent_ns, "data": 1}), 0, format_timestamp_ns(sent_ns + 1_000_000), 64, 0.0)
+    assert flush_data(timeout=10)
+
+    conn = sqlite3.connect(database)
+    ingested = {topic: (first, last) for topic, first, last in conn.execute("SELECT topic, first_seen, last_seen FROM topics")}
+    backfill_time_columns(database)
+    topics = {topic: (count, first, last) for topic, count, first, last in
+              conn.execute("SELECT topic, message_count, first_seen, last_seen FROM topics")}
+    conn.close()
+
+    assert topics["new/topic"] == (5, *ingested["new/topic"])
+    count, first, last = topics["sensors/temp"]
+    assert count == 15
+    assert first == pytest.approx(now - 3600, abs=1e-3)
+    assert last == ingested["sensors/temp"][1]
@@ -0,0 +1,30 @@
+import json
+import sqlite3
+from app.database import INSERT_MQTT_DATA, build_row
+from app.partitions import DAY, MAX_ATTACHED, PartitionRouter, list_partition_days, partition_path
+from app.writer import BatchWriter
+
+
+def test_batch_spanning_more_days_than_can_be_attached(database, tmp_path):
+    start = 1_700_000_000 // DAY * DAY
+    days = MAX_ATTACHED + 2
+    rows = []
+    for day in range(days):
+        received_ns = (start + day * DAY + 60) * 10 ** 9
+        row = build_row("sensors/temp", json.dumps({"sent_ns": received_ns - 10 ** 6, "data": day}), 0, received_ns, 64, 0.0)
+        rows.append(dict(row, topic_id=None))
+
+    router = PartitionRouter(INSERT_MQTT_DATA)
+    writer = BatchWriter(router.insert, database_path=database, batch_size=days, flush_interval=1,
+                         spill_path=str(tmp_path / "spill.jsonl"), hooks=[router])
+    for row in rows:
+        writer.submit(row)
+    assert writer.flush(timeout=30)
+    writer.close(timeout=10)
+
+    assert writer.metrics()["written"] == days
+    assert writer.metrics()["commits"] == 2  # Not one per row
+    assert len(list_partition_days()) == days
+    for day in list_partition_days():
+        with sqlite3.connect(partition_path(day)) as conn:
+            assert conn.execute("SELECT COUNT(*) FROM mqtt_data").fetchone()[0] == 1
@@ -0,0 +1,26 @@
+import time
+from app.migrations import migrate
+from app.timesync import ClockSync
+from conftest import create_baseline
+
+
+def test_remembers_only_the_most_recent_loads(tmp_path):
+    conn = create_baseline(str(tmp_path / "data.db"), [])
+    migrate(conn)
+    now = time.time_ns()
+    with conn:
+        conn.execute("INSERT INTO clock_offsets VALUES ('stored', ?, 5e6, 0, 1e6, ?, 8)", (now, now))
+    sync = ClockSync(max_loaded=2)
+
+    assert sync.estimate("stored", now, conn) == (5e6, 1e6)
+    for client_id in (f"unsynced-{i}" for i in range(100)):
+        assert sync.estimate(client_id, now, conn) is None
+    assert list(sync.loaded) == ["unsynced-98", "unsynced-99"]
+    assert list(sync.models) == []  # Misses are not kept as models; the evicted stored one is read again later
+
+    sync.add_sample("probed", now, now + 10, now + 20, now + 30)
+    sync.estimate("stored", now, conn)
+    sync.estimate("unsynced-0", now, conn)
+    sync.estimate("unsynced-1", now, conn)
+    assert set(sync.models) == {"probed"}  # Live-probed models are never evicted
+    conn.close()
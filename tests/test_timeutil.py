@@ -0,0 +1,29 @@
+import os
+import time
+from datetime import datetime
+import pytest
+from app.timeutil import TIMESTAMP_FORMAT, _minute_start, parse_timestamp_ns
+
+
+@pytest.fixture
+def lord_howe():
+    """Local time in a zone whose daylight saving shift is 30 minutes."""
+    previous = os.environ.get("TZ")
+    os.environ["TZ"] = "Australia/Lord_Howe"
+    time.tzset()
+    _minute_start.cache_clear()
+    yield
+    if previous is None:
+        del os.environ["TZ"]
+    else:
+        os.environ["TZ"] = previous
+    time.tzset()
+    _minute_start.cache_clear()
+
+
+def test_half_hour_offset_change(lord_howe):
+    # Clocks go from 02:00 to 02:30 on 2024-10-06, half way through an hour
+    for value in ("2024-10-06 01:59:59.000001", "2024-10-06 02:45:00.500000", "2024-10-06 03:10:00.000000"):
+        parsed = datetime.strptime(value, TIMESTAMP_FORMAT)
+        expected = int(parsed.replace(microsecond=0).timestamp()) * 1_000_000_000 + parsed.microsecond * 1000
+        assert parse_timestamp_ns(value) == expected
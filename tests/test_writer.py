@@ -0,0 +1,39 @@
+import sqlite3
+from app.writer import BatchWriter, WriterHook
+
+
+def test_row_by_row_fallback_counts_each_commit(tmp_path):
+    path = str(tmp_path / "data.db")
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE readings (value INTEGER NOT NULL)")
+    writer = BatchWriter("INSERT INTO readings (value) VALUES (:value)", database_path=path,
+                         batch_size=3, flush_interval=1, spill_path=str(tmp_path / "spill.jsonl"))
+    for value in (1, None, 3):  # The NULL fails the batch, which is then retried row by row
+        writer.submit({"value": value})
+    assert writer.flush(timeout=10)
+    writer.close(timeout=10)
+
+    metrics = writer.metrics()
+    assert (metrics["written"], metrics["failed"], metrics["commits"]) == (2, 1, 2)
+
+
+class FailingHook(WriterHook):
+    def after_commit(self, rows):
+        raise RuntimeError("listener failed")
+
+
+def test_failing_after_commit_hook_does_not_write_rows_again(tmp_path):
+    path = str(tmp_path / "data.db")
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE readings (value INTEGER NOT NULL)")
+    writer = BatchWriter("INSERT INTO readings (value) VALUES (:value)", database_path=path, batch_size=3,
+                         flush_interval=1, spill_path=str(tmp_path / "spill.jsonl"), hooks=[FailingHook()])
+    for value in (1, 2, 3):
+        writer.submit({"value": value})
+    assert writer.flush(timeout=10)
+    writer.close(timeout=10)
+
+    metrics = writer.metrics()
+    assert (metrics["written"], metrics["failed"], metrics["commits"]) == (3, 0, 1)
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM readings").fetchone()[0] == 3